@@ -4,59 +4,2510 @@ Chat Log Combiner – WISMASS 内部版
 • 统一汇总指定群聊（企业微信 / 微信）聊天记录并与自定义模板拼接，粘贴到光标位置。
 • 支持无限群聊、无限模板，可勾选模板 -> 群聊映射。
 • Ctrl+M 一键粘贴＋发送。
+• 无界面模式：python chat.py render -t 模板名 [--from 日期 --to 日期] [-o 文件]
 
 依赖:
     pip install ttkbootstrap keyboard pyperclip requests
+    （无界面模式只需要 requests）
 
 作者: 2025-05-27
 """
 
 from __future__ import annotations
 
+import argparse
+import bisect
+import copy
+import difflib
+import gzip
+import io
+import heapq
 import json
+import math
+import mmap
 import os
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import sys
 import threading
 import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass, asdict, field
-from datetime import datetime
-from typing import List
-from urllib.parse import quote
-
-import keyboard
-import pyperclip
-import requests
-import ttkbootstrap as tb
-from ttkbootstrap.constants import *
+from datetime import date, datetime, timedelta
+from functools import lru_cache, partial
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Union,
+)
+from urllib.parse import quote, unquote, urlsplit
+
+if TYPE_CHECKING:
+    import requests
 
 # ---------------------------------------------------------------------------
 # 常量 & 工具函数
 # ---------------------------------------------------------------------------
 
 CONFIG_PATH = "config.json"
+CONFIG_SAVE_DELAY = 0.5    # 界面编辑后合并写盘的延迟，秒
 API_URL = "http://127.0.0.1:5030/api/v1/chatlog"   # 固定后端接口
 
-session = requests.Session()
-session.headers.update({"User-Agent": "ChatLogCombiner/1.0"})
+FETCH_WORKERS = 8          # 并发抓取的最大线程数
+FETCH_TIMEOUT = (3, 8)     # 单个请求的 (连接, 读取) 超时，秒
+FETCH_DEADLINE = 20        # 一次汇总所有群聊的总时限，秒
+BATCH_FETCH_DEADLINE = 0   # 批量渲染（无人值守）的抓取总时限，秒，0 = 不限
+FETCH_RETRIES = 2          # 连接失败或 5xx 时的重试次数
+FETCH_BACKOFF = 0.25       # 重试退避基数，第 n 次在 [0, 基数 × 2^n) 内随机等待，秒
+FETCH_MAX_RESTARTS = 2     # 分页续抓校验失败后最多从头重抓几次，超过视为分页结果不稳定
+BREAKER_THRESHOLD = 3      # 同一后端 / 群聊连续失败多少次后熔断
+BREAKER_COOLDOWN = 60      # 熔断持续时间，期间直接使用缓存，秒
+
+PAGE_SIZE = 500            # 分页抓取时每页消息条数，0 表示不分页（整段纯文本）
+STREAM_CHUNK = 16 * 1024   # 流式读取纯文本响应的块大小，字节
+
+PASTE_CLIPBOARD_WAIT = 1.0  # 等待剪贴板内容就绪的最长时间，秒
+PASTE_CHARS_PER_SEC = 40000  # 估算目标输入框处理粘贴内容的速度，用于自适应等待
+PASTE_MAX_SETTLE = 2.0       # 粘贴后到按回车之间的最长等待，秒
+PASTE_CHUNK_INTERVAL = 1.0   # 分段粘贴时两段之间的间隔，秒
+
+RUN_STATS_SIZE = 200  # 内存中保留最近多少次运行的分阶段耗时
+
+CACHE_PATH = "chatlog_cache.db"
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # 本地缓存上限，超出后按最近最少使用淘汰
+CACHE_MAX_DAYS = 366                # 超过该天数的时间范围不按天缓存，直接整段请求
+SHARD_DAYS = 7      # 缓存中没有的连续日期最多几天合并为一个分片请求
+SHARD_WORKERS = 4   # 分片抓取线程数，所有群聊共用，限制对后端的并发
+CACHE_SETTLE_SECONDS = 3600         # 某天结束后再过多久才视为不会再变（后端同步有延迟）
+ARCHIVE_DIR = "chatlog_archive"     # 已稳定日期的压缩归档，不随缓存淘汰，长期保留
+
+INDEX_PATH = "chat_index.json"  # 群聊/联系人索引，用于自动补全与名称 -> ID 解析
+INDEX_TTL = 6 * 3600            # 索引超过该时长视为过期，使用前在后台刷新，秒
+INDEX_PAGE_SIZE = 1000          # 拉取联系人/群聊列表时每页条数
+
+SEARCH_TOP_K = 20    # 模板设置了检索词但未指定 top_k 时，保留的消息窗口数
+SEARCH_CONTEXT = 2   # 每条命中消息前后各带几条上下文
+
+WATCH_INTERVAL = 30       # 监听模式下新加入群聊的初始轮询间隔，秒
+WATCH_MIN_INTERVAL = 5    # 活跃群聊的最短轮询间隔，秒
+WATCH_MAX_INTERVAL = 300  # 安静群聊的最长轮询间隔，秒
+WATCH_BUFFER = 5000       # 每个群聊在内存中保留的最近新消息条数
+
+_session: Optional["requests.Session"] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> "requests.Session":
+    """进程内共享的 HTTP 会话，首次使用时才导入 requests，命令行 list 等无需联网的操作更快启动。"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            sess = requests.Session()
+            sess.headers.update({"User-Agent": "ChatLogCombiner/1.0"})
+            # 连接池覆盖所有可能同时发请求的线程：单任务群聊由抓取线程直接请求，
+            # 分片另有 SHARD_WORKERS 个线程，再留 2 个给实时监听与群聊索引刷新；
+            # 池子偏小时 urllib3 会丢弃多出来的连接（"Connection pool is full"）
+            sess.mount(
+                "http://",
+                HTTPAdapter(
+                    pool_connections=1, pool_maxsize=FETCH_WORKERS + SHARD_WORKERS + 2
+                ),
+            )
+            _session = sess
+        return _session
+
+
+def atomic_write(path: str, text: str) -> None:
+    """先写同目录临时文件再 os.replace，中途崩溃不会留下写了一半的文件。"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
 
 
 def today_str() -> str:
     return datetime.now().strftime("%Y-%m-%d")
 
 
+def day_range(date_from: str, date_to: str) -> Optional[List[date]]:
+    """把 YYYY-MM-DD 起止日期展开为逐日列表；格式不符或跨度过大时返回 None。"""
+    try:
+        start = datetime.strptime(date_from.strip(), "%Y-%m-%d").date()
+        end = datetime.strptime(date_to.strip(), "%Y-%m-%d").date()
+    except ValueError:
+        return None
+    n_days = (end - start).days + 1
+    if n_days < 1 or n_days > CACHE_MAX_DAYS:
+        return None
+    return [start + timedelta(days=i) for i in range(n_days)]
+
+
+def build_url(
+    chat_name: str,
+    date_from: str,
+    date_to: str,
+    limit: int = 0,
+    offset: int = 0,
+    fmt: str = "",
+) -> str:
+    started = time.perf_counter()
+    url = f"{API_URL}?time={date_from}~{date_to}&talker={quote(chat_name)}"
+    if limit:
+        url += f"&limit={limit}&offset={offset}"
+    if fmt:
+        url += f"&format={fmt}"
+    timing = _metering()
+    if timing is not None:
+        timing.url_seconds += time.perf_counter() - started
+    return url
+
+
+@dataclass
+class ChatLog:
+    """单个群聊的抓取结果。"""
+    text: str
+    dropped: int = 0  # 因字数预算被省略的较早内容字数
+    timing: Optional[FetchTiming] = None  # 抓取计量，由 fetch_chat_logs 填入
+    error: str = ""     # 抓取失败的原因，只在界面 / 日志中提示，不会拼进粘贴内容
+    stale: bool = False  # text 来自请求失败后兜底的本地缓存，可能不是最新
+
+
+def truncate_oldest(text: str, limit: int) -> tuple[str, int]:
+    """只保留最后 limit 字左右的内容，从消息边界（空行）处截断，返回 (文本, 丢弃字数)。"""
+    if limit <= 0 or len(text) <= limit:
+        return text, 0
+    cut = len(text) - limit
+    boundary = text.find("\n\n", cut)
+    if boundary != -1:
+        cut = boundary + 2
+    return text[cut:], cut
+
+
+def read_text_stream(r: requests.Response, budget: int = 0) -> tuple[str, int]:
+    """逐行消费后端的纯文本流（后端每条消息后 flush），而不是整体缓冲 r.text。
+
+    按空行把行聚成消息块；budget > 0 时只保留最新的消息，内存占用不超过预算，
+    返回 (文本, 丢弃字数)。收到的字节数计入当前线程的抓取计量。
+    """
+    encoding = r.encoding or "utf-8"
+    nbytes = 0
+    blocks: deque[str] = deque()
+    lines: List[str] = []
+    total = dropped = 0
+
+    def _flush():
+        nonlocal total, dropped
+        block = "\n".join(lines)
+        lines.clear()
+        blocks.append(block)
+        total += len(block) + 2
+        while budget and total > budget and len(blocks) > 1:
+            old = len(blocks.popleft()) + 2
+            total -= old
+            dropped += old
+
+    # 按字节切行再逐行解码：UTF-8 的换行不会落在多字节字符中间
+    for raw in r.iter_lines(chunk_size=STREAM_CHUNK):
+        nbytes += len(raw) + 1
+        line = raw.decode(encoding, errors="replace")
+        if line:
+            lines.append(line)
+        elif lines:
+            _flush()
+    if lines:
+        _flush()
+    timing = _metering()
+    if timing is not None:
+        timing.bytes += nbytes
+
+    text = "\n\n".join(blocks)
+    if budget and len(text) > budget:
+        # 单条消息本身超长
+        text, extra = truncate_oldest(text, budget)
+        dropped += extra
+    return text, dropped
+
+
+def fetch_chatlog(url: str, budget: int = 0, talker: str = "") -> ChatLog:
+    try:
+        with guarded_get(url, talker, stream=True) as r:
+            r.raise_for_status()
+            text, dropped = read_text_stream(r, budget)
+            _record_response(r)
+        return ChatLog(text.strip() or "[空]", dropped)
+    except Exception as e:
+        return ChatLog("", error=str(e))
+
+
+def fetch_many(
+    fetch: Callable[[str], ChatLog],
+    items: Sequence[str],
+    workers: int = FETCH_WORKERS,
+    deadline: float = FETCH_DEADLINE,
+    on_done: Optional[Callable[[int, ChatLog], None]] = None,
+    cancel: Optional[threading.Event] = None,
+    fallback: Optional[Callable[[str], Optional[ChatLog]]] = None,
+) -> List[ChatLog]:
+    """并发执行 fetch(item)，结果按 items 原顺序返回。
+
+    每完成一项回调 on_done(下标, 结果)；超过总时限或被 cancel 时不再等待，
+    未完成的项改用 fallback(item) 的结果（如本地缓存），没有则为只带 error 的空结果。
+    deadline <= 0 时不限总时长。
+    """
+    if not items:
+        return []
+
+    pool = ThreadPoolExecutor(
+        max_workers=max(1, min(workers, len(items))),
+        thread_name_prefix="chatlog-fetch",
+    )
+    try:
+        futures = {pool.submit(fetch, item): i for i, item in enumerate(items)}
+        results: List[Optional[ChatLog]] = [None] * len(items)
+        pending = set(futures)
+        stop_at = time.monotonic() + deadline if deadline > 0 else math.inf
+
+        while pending:
+            remaining = stop_at - time.monotonic()
+            if remaining <= 0 or (cancel is not None and cancel.is_set()):
+                break
+            # 分片等待，便于及时响应取消
+            done, pending = wait(
+                pending, timeout=min(remaining, 0.2), return_when=FIRST_COMPLETED
+            )
+            for fut in done:
+                idx = futures[fut]
+                results[idx] = fut.result()
+                if on_done is not None:
+                    on_done(idx, results[idx])
+
+        reason = "已取消" if cancel is not None and cancel.is_set() else (
+            f"超过总时限 {deadline}s 未返回"
+        )
+        for fut in pending:
+            fut.cancel()
+            log = fallback(items[futures[fut]]) if fallback is not None else None
+            if log is None:
+                log = ChatLog("")
+            log.error = reason
+            results[futures[fut]] = log
+        return results  # type: ignore[return-value]
+    finally:
+        # 不等待超时的线程，它们会在各自的请求超时后自行退出
+        pool.shutdown(wait=False)
+
+
+# ---------------------------------------------------------------------------
+# 请求容错
+# ---------------------------------------------------------------------------
+
+class CircuitOpenError(RuntimeError):
+    """熔断期间直接拒绝请求，不再等待超时。"""
+
+
+class CircuitBreaker:
+    """连续失败 threshold 次后熔断 cooldown 秒；到期后只放行一个试探请求，成功即恢复。"""
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._failures < self.threshold:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._probing = True  # 半开：放行这一个请求
+            return True
+
+    def release(self) -> None:
+        """放行后并未真正发出请求时调用，让下一个请求继续试探。"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def _breaker(key: str) -> CircuitBreaker:
+    with _breakers_lock:
+        b = _breakers.get(key)
+        if b is None:
+            b = _breakers[key] = CircuitBreaker()
+        return b
+
+
+def _http_get(url: str, **kwargs) -> requests.Response:
+    """GET，连接失败与 5xx 时按带抖动的指数退避重试；读超时不重试，以免成倍拖长等待。"""
+    import requests
+
+    kwargs.setdefault("timeout", FETCH_TIMEOUT)
+    for attempt in range(FETCH_RETRIES + 1):
+        last = attempt == FETCH_RETRIES
+        try:
+            r = get_session().get(url, **kwargs)
+        except requests.ConnectionError:
+            if last:
+                raise
+        else:
+            if r.status_code < 500 or last:
+                return r
+            r.close()
+        time.sleep(random.uniform(0, FETCH_BACKOFF * 2 ** attempt))
+    raise AssertionError("unreachable")
+
+
+@contextmanager
+def guarded_get(url: str, talker: str = "", **kwargs) -> Iterator[requests.Response]:
+    """带重试与熔断的 GET，按后端地址和 talker 各设一个熔断器。
+
+    with 块内读取响应体时出现的异常（如读超时、raise_for_status）同样计为失败；
+    熔断期间直接抛出 CircuitOpenError。
+    """
+    breakers = [_breaker(f"host:{urlsplit(url).netloc}")]
+    if talker:
+        breakers.insert(0, _breaker(f"talker:{talker}"))
+    for i, b in enumerate(breakers):
+        if not b.allow():
+            for allowed in breakers[:i]:
+                allowed.release()
+            raise CircuitOpenError(f"后端连续失败，{int(b.cooldown)}s 内暂停请求")
+
+    try:
+        with _http_get(url, **kwargs) as r:
+            yield r
+    except Exception:
+        for b in breakers:
+            b.record_failure()
+        raise
+    for b in breakers:
+        b.record_success()
+
+
+# ---------------------------------------------------------------------------
+# 运行统计
+# ---------------------------------------------------------------------------
+
+@dataclass
+class FetchTiming:
+    """单个群聊一次抓取的计量，由抓取所在线程在请求处累加。"""
+    seconds: float = 0.0      # 整个群聊的抓取耗时（含读缓存与渲染）
+    ttfb: float = 0.0         # 第一个请求从发出到收到响应头
+    url_seconds: float = 0.0  # 构造请求 URL 的累计耗时
+    requests: int = 0
+    bytes: int = 0            # 从连接上读到的响应体字节数
+
+    def merge(self, other: "FetchTiming") -> None:
+        """并入另一线程（如分片）的计量；耗时由外层自己统计，不累加。"""
+        if other.ttfb and (not self.ttfb or other.ttfb < self.ttfb):
+            self.ttfb = other.ttfb
+        self.url_seconds += other.url_seconds
+        self.requests += other.requests
+        self.bytes += other.bytes
+
+
+_meter = threading.local()  # 当前线程正在计量的 FetchTiming，未计量时为 None
+
+
+def _metering() -> Optional[FetchTiming]:
+    return getattr(_meter, "timing", None)
+
+
+def _record_response(r: requests.Response, nbytes: int = 0) -> None:
+    """在响应体读完后调用；流式读取的字节数由 read_text_stream 自行计入。
+
+    未处于计量中时几乎没有开销。
+    """
+    timing = _metering()
+    if timing is None:
+        return
+    timing.requests += 1
+    if not timing.ttfb:
+        timing.ttfb = r.elapsed.total_seconds()
+    timing.bytes += nbytes
+
+
+@contextmanager
+def metered() -> Iterator[FetchTiming]:
+    """在当前线程上挂一个 FetchTiming，with 块内的请求都计入其中。"""
+    timing, prev = FetchTiming(), _metering()
+    _meter.timing = timing
+    started = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        timing.seconds = time.perf_counter() - started
+        _meter.timing = prev
+
+
+def _in_meter(timing: Optional[FetchTiming], fn: Callable[[], Any]) -> Any:
+    """在其他线程中执行 fn，期间的请求计入 timing。
+
+    timing 只能由这一个线程累加（字段的 += 不是原子操作），并发的任务各用一个，
+    完成后再由调用方 merge。
+    """
+    prev, _meter.timing = _metering(), timing
+    try:
+        return fn()
+    finally:
+        _meter.timing = prev
+
+
+@dataclass
+class RunRecord:
+    """一次汇总粘贴的分阶段耗时。"""
+    started_at: str
+    template: str
+    outcome: str = "done"  # done / cancelled / error
+    # url_build / fetch / assemble / clipboard / keystrokes / total -> 秒
+    stages: Dict[str, float] = field(default_factory=dict)
+    chats: Dict[str, FetchTiming] = field(default_factory=dict)  # 群聊名 -> 抓取计量
+    chars: int = 0
+
+    @property
+    def bytes(self) -> int:
+        return sum(t.bytes for t in distinct_timings(self.chats.values()))
+
+
+def distinct_timings(timings: Iterable[FetchTiming]) -> List[FetchTiming]:
+    """合并请求时多个群聊共用同一个 FetchTiming，汇总前按对象去重。"""
+    return list({id(t): t for t in timings}.values())
+
+
+class RunStats:
+    """最近 maxlen 次运行的环形缓冲，常驻开启；可追加导出为 JSON Lines。"""
+
+    def __init__(self, maxlen: int = RUN_STATS_SIZE):
+        self._runs: deque[RunRecord] = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, record: RunRecord) -> None:
+        with self._lock:
+            self._runs.append(record)
+
+    def records(self) -> List[RunRecord]:
+        with self._lock:
+            return list(self._runs)
+
+    def percentile(self, stage: str, p: float) -> float:
+        values = sorted(r.stages.get(stage, 0.0) for r in self.records())
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    def export_jsonl(self, path: str) -> int:
+        records = self.records()
+        with open(path, "a", encoding="utf-8") as f:
+            for r in records:
+                f.write(json.dumps(asdict(r), ensure_ascii=False) + "\n")
+        return len(records)
+
+
+run_stats = RunStats()
+
+
+# ---------------------------------------------------------------------------
+# 消息模型（format=json）
+# ---------------------------------------------------------------------------
+
+API_HOST = urlsplit(API_URL).netloc
+
+
+def _parse_time(value: str) -> datetime:
+    """解析 Go time.Time 的 RFC3339(Nano) JSON 表示。"""
+    value = value.replace("Z", "+00:00")
+    dot = value.find(".")
+    if dot != -1:
+        # 纳秒精度截到微秒，兼容 datetime.fromisoformat
+        end = dot + 1
+        while end < len(value) and value[end].isdigit():
+            end += 1
+        value = value[:dot] + value[dot:end][:7] + value[end:]
+    return datetime.fromisoformat(value)
+
+
+def _record_info_text(info: Dict[str, Any], title: str = "") -> str:
+    """对应 Go RecordInfo.String：合并转发的逐条展开。"""
+    buf = [f"[合并转发|{title or info.get('Title', '')}]\n"]
+    for item in (info.get("DataList") or {}).get("DataItems") or []:
+        buf.append(f"  {item.get('SourceName', '')} {item.get('SourceTime', '')}\n")
+        record_xml = item.get("RecordXML")
+        if item.get("DataType") == "17" and record_xml:
+            nested = _record_info_text(
+                record_xml.get("RecordInfo") or {}, item.get("DataTitle", "")
+            )
+            for line in nested.split("\n"):
+                buf.append(f"  {line}\n")
+            continue
+        if item.get("DataFmt") in ("pic", "jpg"):
+            buf.append(f"  ![图片](http://{API_HOST}/image/{item.get('FullMD5', '')})\n")
+        else:
+            for line in item.get("DataDesc", "").split("\n"):
+                buf.append(f"  {line}\n")
+        buf.append("\n")
+    return "".join(buf)
+
+
+class Message:
+    """/api/v1/chatlog?format=json 中的一条消息，渲染逻辑与后端纯文本输出一致。"""
+
+    __slots__ = (
+        "seq",
+        "time",
+        "talker",
+        "talker_name",
+        "is_chatroom",
+        "sender",
+        "sender_name",
+        "is_self",
+        "type",
+        "sub_type",
+        "content",
+        "contents",
+    )
+
+    def __init__(self, raw: Dict[str, Any]):
+        self.seq: int = raw.get("seq", 0)
+        self.time: datetime = _parse_time(raw["time"])
+        self.talker: str = raw.get("talker", "")
+        self.talker_name: str = raw.get("talkerName", "")
+        self.is_chatroom: bool = raw.get("isChatRoom", False)
+        self.sender: str = raw.get("sender", "")
+        self.sender_name: str = raw.get("senderName", "")
+        self.is_self: bool = raw.get("isSelf", False)
+        self.type: int = raw.get("type", 0)
+        self.sub_type: int = raw.get("subType", 0)
+        self.content: str = raw.get("content", "")
+        self.contents: Dict[str, Any] = raw.get("contents") or {}
+
+    def to_json(self) -> Dict[str, Any]:
+        raw = {
+            "seq": self.seq,
+            "time": self.time.isoformat(),
+            "talker": self.talker,
+            "talkerName": self.talker_name,
+            "isChatRoom": self.is_chatroom,
+            "sender": self.sender,
+            "senderName": self.sender_name,
+            "isSelf": self.is_self,
+            "type": self.type,
+            "subType": self.sub_type,
+            "content": self.content,
+        }
+        if self.contents:
+            raw["contents"] = self.contents
+        return raw
+
+    def plain_text(self, time_fmt: str = "%m-%d %H:%M:%S", show_chatroom: bool = False) -> str:
+        sender = "我" if self.is_self else self.sender
+        head = f"{self.sender_name}({sender})" if self.sender_name else sender
+        if self.is_chatroom and show_chatroom:
+            room = (
+                f"{self.talker_name}({self.talker})" if self.talker_name else self.talker
+            )
+            head += f" [{room}]"
+        return f"{head} {self.time.strftime(time_fmt)}\n{self.plain_text_content()}\n"
+
+    def plain_text_content(self) -> str:
+        c = self.contents
+        if self.type == 1:
+            return self.content
+        if self.type == 3:
+            keys = [c[k] for k in ("md5", "imgfile", "thumb") if isinstance(c.get(k), str)]
+            return f"![图片](http://{API_HOST}/image/{','.join(keys)})"
+        if self.type == 34:
+            return f"[语音](http://{API_HOST}/voice/{c['voice']})" if "voice" in c else "[语音]"
+        if self.type == 42:
+            return "[名片]"
+        if self.type == 43:
+            keys = [
+                c[k]
+                for k in ("md5", "rawmd5", "videofile", "thumb")
+                if isinstance(c.get(k), str)
+            ]
+            return f"![视频](http://{API_HOST}/video/{','.join(keys)})"
+        if self.type == 47:
+            return "[动画表情]"
+        if self.type == 49:
+            return self._app_content()
+        if self.type == 50:
+            return "[语音通话]"
+        if self.type == 10000:
+            return self.content
+        content = self.content
+        if len(content) > 120:
+            content = content[:120] + "<...>"
+        return f"Type: {self.type} Content: {content}"
+
+    def _app_content(self) -> str:
+        c, sub = self.contents, self.sub_type
+        if sub == 5:
+            return f"[链接|{c.get('title', '')}]({c.get('url', '')})"
+        if sub == 6:
+            return f"[文件|{c.get('title', '')}](http://{API_HOST}/file/{c.get('md5', '')})"
+        if sub == 8:
+            return "[GIF表情]"
+        if sub == 19:
+            info = c.get("recordInfo")
+            return _record_info_text(info) if isinstance(info, dict) else "[合并转发]"
+        if sub in (33, 36):
+            return f"[小程序|{c['title']}]({c.get('url', '')})" if c.get("title") else "[小程序]"
+        if sub == 51:
+            return f"[视频号|{c['title']}]({c.get('url', '')})" if c.get("title") else "[视频号]"
+        if sub == 57:
+            refer = c.get("refer")
+            if not isinstance(refer, dict):
+                return "> [引用]\n" + self.content if self.content else "[引用]"
+            lines = Message(refer).plain_text().split("\n")
+            return "".join(f"> {line}\n" for line in lines if line) + self.content
+        if sub in (62, 2000):
+            return self.content
+        return {
+            63: "[视频号]",
+            87: "[群公告]",
+            2001: "[红包]",
+            2003: "[红包封面]",
+        }.get(sub, "[分享]")
+
+
+def render_messages(messages: Sequence[Message], time_fmt: str = "%m-%d %H:%M:%S") -> str:
+    """与后端纯文本接口相同的格式：每条消息后空一行。"""
+    return "".join(m.plain_text(time_fmt) + "\n" for m in messages).strip()
+
+
+# ---------------------------------------------------------------------------
+# 消息过滤
+# ---------------------------------------------------------------------------
+
+@dataclass
+class FilterOptions:
+    # 丢弃的消息类型：整数为 type（如 47 动画表情、3 图片、34 语音），
+    # "type:subType" 字符串精确到子类型（如 "49:8" GIF 表情）
+    drop_types: List[Union[int, str]] = field(default_factory=list)
+    sender_blocklist: List[str] = field(default_factory=list)  # 微信 ID 或昵称
+    dedupe_window: int = 0    # 最近 N 条内出现过的相同内容不再重复，0 = 不去重
+    short_reply_len: int = 0  # 连续不超过该字数的文字消息折叠为一条，0 = 不折叠
+
+
+class MessageFilter:
+    """把 FilterOptions 编译成过滤流水线：类型/发送者 → 去重 → 折叠短回复。
+
+    类型与发送者直接在 JSON dict 上判断，被丢弃的消息不会构造 Message、不解析时间。
+    """
+
+    def __init__(self, opts: FilterOptions):
+        self.opts = opts
+        self._drop_types: set[int] = set()
+        self._drop_sub_types: set[tuple[int, int]] = set()
+        for t in opts.drop_types:
+            if isinstance(t, str) and ":" in t:
+                main, sub = t.split(":", 1)
+                self._drop_sub_types.add((int(main), int(sub)))
+            else:
+                self._drop_types.add(int(t))
+        self._blocked = frozenset(opts.sender_blocklist)
+
+    @property
+    def active(self) -> bool:
+        return bool(
+            self._drop_types
+            or self._drop_sub_types
+            or self._blocked
+            or self.opts.dedupe_window
+            or self.opts.short_reply_len
+        )
+
+    def keep_raw(self, raw: Dict[str, Any]) -> bool:
+        t = raw.get("type", 0)
+        if t in self._drop_types or (t, raw.get("subType", 0)) in self._drop_sub_types:
+            return False
+        if self._blocked and (
+            raw.get("sender") in self._blocked or raw.get("senderName") in self._blocked
+        ):
+            return False
+        return True
+
+    def apply(self, raws: Iterable[Dict[str, Any]]) -> List[Message]:
+        return self.compact([Message(raw) for raw in raws if self.keep_raw(raw)])
+
+    def compact(self, messages: List[Message]) -> List[Message]:
+        """去重与折叠短回复（不再判断类型/发送者）。"""
+        if self.opts.dedupe_window:
+            messages = self._dedupe(messages)
+        if self.opts.short_reply_len:
+            messages = self._collapse_short(messages)
+        return messages
+
+    def _dedupe(self, messages: List[Message]) -> List[Message]:
+        window = self.opts.dedupe_window
+        last_seen: Dict[tuple[int, str], int] = {}
+        kept = []
+        for m in messages:
+            if not m.content:
+                kept.append(m)
+                continue
+            key = (m.type, m.content)
+            prev = last_seen.get(key)
+            last_seen[key] = len(kept)
+            if prev is not None and len(kept) - prev <= window:
+                continue
+            kept.append(m)
+        return kept
+
+    def _collapse_short(self, messages: List[Message]) -> List[Message]:
+        limit = self.opts.short_reply_len
+        out: List[Message] = []
+        run: List[Message] = []
+
+        def _flush():
+            if len(run) == 1:
+                out.append(run[0])
+            elif run:
+                # 用第一条消息承载整段短回复，保留时间顺序
+                head = copy.copy(run[0])
+                senders = list(dict.fromkeys(m.sender_name or m.sender for m in run))
+                if len(senders) > 1:
+                    head.sender_name = "、".join(senders[:3]) + ("等" if len(senders) > 3 else "")
+                    head.sender = "多人"
+                    head.is_self = False
+                contents = list(dict.fromkeys(m.content for m in run))
+                head.content = " / ".join(contents[:5]) + f"（{len(run)} 条简短回复）"
+                out.append(head)
+            run.clear()
+
+        for m in messages:
+            if m.type == 1 and len(m.content.strip()) <= limit:
+                run.append(m)
+            else:
+                _flush()
+                out.append(m)
+        _flush()
+        return out
+
+
+# ---------------------------------------------------------------------------
+# 本地缓存
+# ---------------------------------------------------------------------------
+
+CACHE_SCHEMA_VERSION = 2
+
+
+@dataclass
+class CacheEntry:
+    body: str
+    final: bool         # 该天已结束且稳定，可直接使用无需再请求
+    etag: str = ""
+    kind: str = "text"  # text: 后端纯文本；json: 每行一条消息 JSON（分页抓取）
+    msg_count: int = 0  # json 时为已抓取条数，即下次续抓的 offset
+    last_seq: int = 0   # json 时为最后一条消息的 seq，用于校验续抓位置
+
+
+class MessageCache:
+    """按 (talker, 日期) 存放聊天记录的 SQLite 缓存，总大小超限时按 LRU 淘汰。
+
+    多个抓取线程共用同一连接，所有访问都在锁内完成。
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._total = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # 首次使用时才建库，未启用缓存的运行不会落地文件
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            if conn.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA_VERSION:
+                # 缓存可随时重建，结构变化时直接丢弃旧表
+                conn.execute("DROP TABLE IF EXISTS day_cache")
+                conn.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS day_cache (
+                    talker      TEXT NOT NULL,
+                    day         TEXT NOT NULL,
+                    body        TEXT NOT NULL,
+                    bytes       INTEGER NOT NULL,
+                    final       INTEGER NOT NULL,
+                    etag        TEXT NOT NULL DEFAULT '',
+                    kind        TEXT NOT NULL DEFAULT 'text',
+                    msg_count   INTEGER NOT NULL DEFAULT 0,
+                    last_seq    INTEGER NOT NULL DEFAULT 0,
+                    fetched_at  REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (talker, day)
+                )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_day_cache_lru ON day_cache (accessed_at)"
+            )
+            conn.commit()
+            self._total = conn.execute(
+                "SELECT COALESCE(SUM(bytes), 0) FROM day_cache"
+            ).fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get(self, talker: str, day: str) -> Optional[CacheEntry]:
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT body, final, etag, kind, msg_count, last_seq FROM day_cache"
+                " WHERE talker = ? AND day = ?",
+                (talker, day),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE day_cache SET accessed_at = ? WHERE talker = ? AND day = ?",
+                (time.time(), talker, day),
+            )
+            db.commit()
+            return CacheEntry(
+                body=row[0],
+                final=bool(row[1]),
+                etag=row[2],
+                kind=row[3],
+                msg_count=row[4],
+                last_seq=row[5],
+            )
+
+    def put(self, talker: str, day: str, entry: CacheEntry) -> None:
+        size = len(entry.body.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            old = db.execute(
+                "SELECT bytes FROM day_cache WHERE talker = ? AND day = ?",
+                (talker, day),
+            ).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO day_cache"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    talker,
+                    day,
+                    entry.body,
+                    size,
+                    int(entry.final),
+                    entry.etag,
+                    entry.kind,
+                    entry.msg_count,
+                    entry.last_seq,
+                    now,
+                    now,
+                ),
+            )
+            self._total += size - (old[0] if old else 0)
+            self._evict_locked()
+            db.commit()
+
+    def _evict_locked(self) -> None:
+        if self._total <= self.max_bytes:
+            return
+        db = self._db()
+        for talker, day, size in db.execute(
+            "SELECT talker, day, bytes FROM day_cache ORDER BY accessed_at"
+        ).fetchall():
+            if self._total <= self.max_bytes:
+                break
+            db.execute(
+                "DELETE FROM day_cache WHERE talker = ? AND day = ?", (talker, day)
+            )
+            self._total -= size
+
+    def size(self) -> int:
+        with self._lock:
+            self._db()
+            return self._total
+
+    def clear(self) -> int:
+        """清空缓存，返回释放的字节数。"""
+        with self._lock:
+            db = self._db()
+            freed = self._total
+            db.execute("DELETE FROM day_cache")
+            db.commit()
+            db.execute("VACUUM")
+            self._total = 0
+            return freed
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+cache = MessageCache()
+
+
+# ---------------------------------------------------------------------------
+# 归档
+# ---------------------------------------------------------------------------
+
+class ChatArchive:
+    """已稳定日期的消息归档：按群聊分目录、按月分段，只追加不改写。
+
+    每天的消息按列（字段 -> 值列表）序列化后单独压缩为一个 gzip 成员，追加到
+    <root>/<talker>/<YYYY-MM>.gz；同名 .idx 逐行记录 {day, offset, length, count, last_seq}，
+    同一天重复归档时以最后一行为准。读取某天只需按索引 mmap 出对应字节解压，不必解压整个分段。
+    """
+
+    def __init__(self, root: str = ARCHIVE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self._indexes: Dict[tuple[str, str], Dict[str, Dict[str, Any]]] = {}
+
+    def _paths(self, talker: str, month: str) -> tuple[str, str]:
+        base = os.path.join(self.root, quote(talker, safe=""), month)
+        return base + ".gz", base + ".idx"
+
+    def _index(self, talker: str, month: str) -> Dict[str, Dict[str, Any]]:
+        key = (talker, month)
+        index = self._indexes.get(key)
+        if index is None:
+            index = {}
+            _, idx_path = self._paths(talker, month)
+            if os.path.exists(idx_path):
+                with open(idx_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            rec = json.loads(line)
+                        except ValueError:
+                            continue  # 写到一半中断的行
+                        index[rec["day"]] = rec
+            self._indexes[key] = index
+        return index
+
+    def append(self, talker: str, day: str, raws: Sequence[Dict[str, Any]]) -> bool:
+        """归档某天的全部消息；与已归档内容一致（条数与最后 seq 相同）时跳过，返回是否写入。"""
+        last_seq = raws[-1].get("seq", 0) if raws else 0
+        month = day[:7]
+        with self._lock:
+            index = self._index(talker, month)
+            old = index.get(day)
+            seg_path, idx_path = self._paths(talker, month)
+            if (
+                old is not None
+                and (old["count"], old["last_seq"]) == (len(raws), last_seq)
+                and self._intact(seg_path, old)
+            ):
+                return False
+
+            keys: Dict[str, None] = {}
+            for raw in raws:
+                keys.update(dict.fromkeys(raw))
+            columns = {k: [raw.get(k) for raw in raws] for k in keys}
+            blob = gzip.compress(
+                json.dumps(columns, ensure_ascii=False, separators=(",", ":")).encode(
+                    "utf-8"
+                ),
+                mtime=0,
+            )
+
+            os.makedirs(os.path.dirname(seg_path), exist_ok=True)
+            with open(seg_path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(blob)
+                f.flush()
+                os.fsync(f.fileno())
+            # 先写数据再写索引：中途失败只会留下没有索引指向的字节
+            rec = {
+                "day": day,
+                "offset": offset,
+                "length": len(blob),
+                "count": len(raws),
+                "last_seq": last_seq,
+            }
+            with open(idx_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(rec) + "\n")
+            index[day] = rec
+            return True
+
+    @staticmethod
+    def _intact(seg_path: str, rec: Dict[str, Any]) -> bool:
+        """索引指向的字节是否仍在分段文件里（分段被删除或截断时为 False）。"""
+        try:
+            return os.path.getsize(seg_path) >= rec["offset"] + rec["length"]
+        except OSError:
+            return False
+
+    def discard(self, talker: str, day: str) -> None:
+        """读取失败后忘掉某天的索引记录，下次 append 会重新写入而不是按条数跳过。"""
+        with self._lock:
+            self._index(talker, day[:7]).pop(day, None)
+
+    def get(self, talker: str, day: str) -> Optional[List[Dict[str, Any]]]:
+        """读取某天归档的消息，未归档返回 None（已归档但当天没有消息时为空列表）。"""
+        with self._lock:
+            rec = self._index(talker, day[:7]).get(day)
+        if rec is None:
+            return None
+        if not rec["length"]:
+            return []
+        seg_path, _ = self._paths(talker, day[:7])
+        with open(seg_path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            blob = mm[rec["offset"] : rec["offset"] + rec["length"]]
+        columns = json.loads(gzip.decompress(blob))
+        names = list(columns)
+        return [
+            {k: v for k, v in zip(names, values) if v is not None}
+            for values in zip(*columns.values())
+        ]
+
+    def days(self, talker: str) -> Dict[str, int]:
+        """已归档的日期 -> 消息条数。"""
+        talker_dir = os.path.join(self.root, quote(talker, safe=""))
+        if not os.path.isdir(talker_dir):
+            return {}
+        out: Dict[str, int] = {}
+        with self._lock:
+            for name in sorted(os.listdir(talker_dir)):
+                if name.endswith(".idx"):
+                    for day, rec in sorted(self._index(talker, name[:-4]).items()):
+                        out[day] = rec["count"]
+        return out
+
+    def clear(self) -> int:
+        """删除全部归档，返回释放的字节数。"""
+        with self._lock:
+            freed = self.size()
+            shutil.rmtree(self.root, ignore_errors=True)
+            self._indexes.clear()
+            return freed
+
+    def talkers(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(unquote(name) for name in os.listdir(self.root))
+
+    def size(self, talker: str = "") -> int:
+        """归档占用的磁盘字节数；指定 talker 时只统计该群聊。"""
+        top = os.path.join(self.root, quote(talker, safe="")) if talker else self.root
+        total = 0
+        for dirpath, _, files in os.walk(top):
+            total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in files)
+        return total
+
+
+archive = ChatArchive()
+
+
+# ---------------------------------------------------------------------------
+# 抓取
+# ---------------------------------------------------------------------------
+
+def _is_settled(day: date, fetched_at: datetime) -> bool:
+    day_end = datetime.combine(day + timedelta(days=1), datetime.min.time())
+    return (fetched_at - day_end).total_seconds() >= CACHE_SETTLE_SECONDS
+
+
+def _cached_day(talker: str, key: str) -> Optional[CacheEntry]:
+    """读取某天的缓存；缓存没有（或未稳定）时从归档恢复并回填缓存，不必再请求后端。"""
+    entry = cache.get(talker, key)
+    if entry is not None and entry.final:
+        return entry
+    try:
+        raws = archive.get(talker, key)
+    except (OSError, EOFError, ValueError):
+        # 分段文件被删除或损坏时当作未归档，并丢掉索引记录，重新抓取后会再次归档
+        archive.discard(talker, key)
+        raws = None
+    if raws is None:
+        return entry
+    entry = CacheEntry(
+        "\n".join(json.dumps(m, ensure_ascii=False) for m in raws),
+        True,
+        kind="json",
+        msg_count=len(raws),
+        last_seq=raws[-1].get("seq", 0) if raws else 0,
+    )
+    cache.put(talker, key, entry)
+    return entry
+
+
+def _store_day(talker: str, key: str, entry: CacheEntry) -> None:
+    """写入缓存；已稳定的结构化记录同时归档（纯文本没有结构化字段，不归档）。"""
+    cache.put(talker, key, entry)
+    if not (entry.final and entry.kind == "json"):
+        return
+    raws = [json.loads(line) for line in entry.body.split("\n")] if entry.body else []
+    try:
+        archive.append(talker, key, raws)
+    except OSError:
+        pass  # 归档失败（如磁盘已满）不影响本次汇总，下次抓取该天时会再尝试
+
+
+def _fetch_day(talker: str, day: date, cached: Optional[CacheEntry]) -> str:
+    """以纯文本请求某个群聊某一天的记录并写入缓存。"""
+    key = day.isoformat()
+    headers = {}
+    if cached is not None and cached.kind == "text" and cached.etag:
+        headers["If-None-Match"] = cached.etag
+
+    fetched_at = datetime.now()
+    with guarded_get(
+        build_url(talker, key, key), talker, headers=headers, stream=True
+    ) as r:
+        if r.status_code == 304 and cached is not None:
+            body, etag = cached.body, cached.etag
+        elif r.status_code == 404:
+            # 该天没有对应的数据库文件，即没有记录
+            body, etag = "", ""
+        else:
+            r.raise_for_status()
+            # 缓存需要完整内容，这里不设预算，预算在拼接时统一处理
+            body, _ = read_text_stream(r)
+            body, etag = body.strip(), r.headers.get("ETag", "")
+        _record_response(r)
+
+    cache.put(
+        talker, key, CacheEntry(body, _is_settled(day, fetched_at), etag=etag)
+    )
+    return body
+
+
+def fetch_pages(
+    talker: str,
+    date_from: str,
+    date_to: str,
+    page_size: int,
+    offset: int = 0,
+    last_seq: int = 0,
+    on_page: Optional[Callable[[List[Dict[str, Any]], bool], None]] = None,
+) -> None:
+    """以 format=json 按 limit/offset 逐页抓取，每页通过 on_page(消息列表, 是否重抓) 交出。
+
+    offset > 0 时从上次的高水位续抓：多取前一条与 last_seq 比对，
+    不一致说明历史记录有变化，此时回到 offset 0 重抓（on_page 第二个参数为 True）。
+    重抓超过 FETCH_MAX_RESTARTS 次仍对不上时抛出 RuntimeError，而不是无限重试。
+    """
+    page_size = max(page_size, 2)  # 续抓要多取一条做校验
+    restart = False
+    restarts = 0
+    while True:
+        start = offset - 1 if offset > 0 else 0
+        with guarded_get(
+            build_url(talker, date_from, date_to, page_size, start, "json"), talker
+        ) as r:
+            if r.status_code == 404:
+                page: List[Dict[str, Any]] = []
+            else:
+                r.raise_for_status()
+                page = r.json() or []
+            _record_response(r, len(r.content))
+
+        full = len(page) == page_size
+        if offset > 0:
+            if not page or page[0].get("seq") != last_seq:
+                restarts += 1
+                if restarts > FETCH_MAX_RESTARTS:
+                    raise RuntimeError(
+                        f"{talker} 分页结果不稳定，已重抓 {FETCH_MAX_RESTARTS} 次"
+                    )
+                offset, last_seq, restart = 0, 0, True
+                continue
+            page = page[1:]
+
+        if page or restart:
+            if on_page is not None:
+                on_page(page, restart)
+            restart = False
+        if not full:
+            return
+        offset += len(page)
+        if page:
+            last_seq = page[-1].get("seq", 0)
+
+
+def fetch_json(talker: str, date_from: str, date_to: str) -> List[Dict[str, Any]]:
+    """不分页，一次请求取回时间范围内的全部 JSON 消息。
+
+    多个 talker（逗号分隔）时后端只对已收集到的消息排序并提前返回，limit/offset
+    在请求之间并不稳定，因此合并请求只能整段获取。
+    """
+    with guarded_get(build_url(talker, date_from, date_to, fmt="json"), talker) as r:
+        if r.status_code == 404:
+            return []
+        r.raise_for_status()
+        messages = r.json() or []
+        _record_response(r, len(r.content))
+    return messages
+
+
+def _fetch_day_paged(
+    talker: str,
+    day: date,
+    cached: Optional[CacheEntry],
+    page_size: int = PAGE_SIZE,
+    filt: Optional[MessageFilter] = None,
+) -> str:
+    """分页抓取某天的记录，每完成一页即写入缓存。
+
+    当天或上次中断的日期从缓存记录的条数（高水位）继续，只拉取新增消息。
+    """
+    key = day.isoformat()
+    fetched_at = datetime.now()
+    if cached is not None and cached.kind == "json":
+        entry = cached
+    else:
+        entry = CacheEntry("", False, kind="json")
+    lines = entry.body.split("\n") if entry.body else []
+
+    def _on_page(page: List[Dict[str, Any]], restart: bool):
+        if restart:
+            lines.clear()
+            entry.msg_count = 0
+        lines.extend(json.dumps(m, ensure_ascii=False) for m in page)
+        entry.body = "\n".join(lines)
+        entry.msg_count += len(page)
+        if page:
+            entry.last_seq = page[-1].get("seq", 0)
+        # 逐页落盘，失败后下次从最后完成的 offset 续抓
+        cache.put(talker, key, entry)
+
+    fetch_pages(
+        talker, key, key, page_size, entry.msg_count, entry.last_seq, on_page=_on_page
+    )
+    entry.final = _is_settled(day, fetched_at)
+    _store_day(talker, key, entry)
+    return _render_entry(entry, filt)
+
+
+def _render_entry(entry: CacheEntry, filt: Optional[MessageFilter] = None) -> str:
+    if entry.kind != "json":
+        return entry.body
+    if not entry.body:
+        return ""
+    raws = map(json.loads, entry.body.split("\n"))
+    if filt is not None and filt.active:
+        messages = filt.apply(raws)
+    else:
+        messages = [Message(raw) for raw in raws]
+    return render_messages(messages, "%H:%M:%S")
+
+
+def _usable(entry: Optional[CacheEntry], filt: Optional[MessageFilter]) -> bool:
+    """缓存项可直接使用：已稳定，且需要过滤时必须是结构化（json）内容。"""
+    if entry is None or not entry.final:
+        return False
+    return entry.kind == "json" or filt is None or not filt.active
+
+
+def _join_days(parts: Sequence[tuple[str, str]], n_days: int) -> str:
+    if not parts:
+        return "[空]"
+    if n_days == 1:
+        return parts[0][1]
+    # 按天请求时后端只输出时分秒，跨天时补上日期分隔
+    return "\n\n".join(f"—— {key} ——\n{body}" for key, body in parts)
+
+
+_shard_pool: Optional[ThreadPoolExecutor] = None
+_shard_pool_lock = threading.Lock()
+
+
+def _shard_executor() -> ThreadPoolExecutor:
+    # 与 fetch_many 的群聊线程池分开：群聊线程在这里等待分片，不会互相占满
+    global _shard_pool
+    with _shard_pool_lock:
+        if _shard_pool is None:
+            _shard_pool = ThreadPoolExecutor(
+                SHARD_WORKERS, thread_name_prefix="chatlog-shard"
+            )
+        return _shard_pool
+
+
+def _split_shards(days: Sequence[date], size: int) -> List[List[date]]:
+    """把日期切成分片：只合并相邻的日期，每片最多 size 天。"""
+    shards: List[List[date]] = []
+    for day in days:
+        if (
+            shards
+            and len(shards[-1]) < size
+            and day - shards[-1][-1] == timedelta(days=1)
+        ):
+            shards[-1].append(day)
+        else:
+            shards.append([day])
+    return shards
+
+
+def _fetch_shard(
+    talker: str,
+    days: Sequence[date],
+    page_size: int,
+    filt: Optional[MessageFilter] = None,
+) -> Dict[str, str]:
+    """一次分页请求连续几天的记录，按消息日期拆回逐日缓存，返回 日期 -> 渲染文本。
+
+    翻页期间有新消息插入时同一条消息可能出现在相邻两页，按 seq 去重。
+    """
+    fetched_at = datetime.now()
+    by_day: Dict[str, Dict[int, Dict[str, Any]]] = {d.isoformat(): {} for d in days}
+
+    def _on_page(page: List[Dict[str, Any]], restart: bool):
+        if restart:
+            for bucket in by_day.values():
+                bucket.clear()
+        for m in page:
+            bucket = by_day.get(str(m.get("time", ""))[:10])
+            if bucket is not None:
+                bucket.setdefault(m.get("seq", 0), m)
+
+    fetch_pages(
+        talker, days[0].isoformat(), days[-1].isoformat(), page_size, on_page=_on_page
+    )
+    bodies = {}
+    for day in days:
+        key = day.isoformat()
+        msgs = list(by_day[key].values())
+        entry = CacheEntry(
+            "\n".join(json.dumps(m, ensure_ascii=False) for m in msgs),
+            _is_settled(day, fetched_at),
+            kind="json",
+            msg_count=len(msgs),
+            last_seq=msgs[-1].get("seq", 0) if msgs else 0,
+        )
+        _store_day(talker, key, entry)
+        bodies[key] = _render_entry(entry, filt)
+    return bodies
+
+
+def _fetch_days(
+    talker: str,
+    days: Sequence[date],
+    entries: Dict[date, Optional[CacheEntry]],
+    page_size: int,
+    filt: Optional[MessageFilter] = None,
+    cancel: Optional[threading.Event] = None,
+) -> tuple[Dict[str, str], Dict[str, str]]:
+    """并行抓取缓存不可用的日期，返回 (日期 -> 渲染文本, 日期 -> 失败原因)。
+
+    分页模式下缓存里没有结构化记录的相邻日期合并为分片（最多 SHARD_DAYS 天）各请求一次，
+    已有部分记录的日期仍按天续抓；纯文本模式逐天请求。每个分片完成即写入缓存，
+    失败重试时只需补抓缺失的分片。只有一个任务时直接在当前线程执行。
+    cancel 被置位后尚未开始的分片直接记为失败，不再请求。
+    """
+    tasks: List[tuple[List[str], Callable[[], Dict[str, str]]]] = []
+
+    def _single(day: date) -> Dict[str, str]:
+        if page_size:
+            body = _fetch_day_paged(talker, day, entries[day], page_size, filt)
+        else:
+            body = _fetch_day(talker, day, entries[day])
+        return {day.isoformat(): body}
+
+    if page_size:
+        fresh = [d for d in days if entries[d] is None or entries[d].kind != "json"]
+        for shard in _split_shards(fresh, SHARD_DAYS):
+            keys = [d.isoformat() for d in shard]
+            tasks.append((keys, partial(_fetch_shard, talker, shard, page_size, filt)))
+        resume = [d for d in days if d not in fresh]
+    else:
+        resume = list(days)
+    tasks.extend(([d.isoformat()], partial(_single, d)) for d in resume)
+
+    def _unless_cancelled(fn: Callable[[], Dict[str, str]]) -> Dict[str, str]:
+        if cancel is not None and cancel.is_set():
+            raise RuntimeError("已取消")
+        return fn()
+
+    bodies: Dict[str, str] = {}
+    errors: Dict[str, str] = {}
+    timings: List[FetchTiming] = []
+    if len(tasks) == 1:
+        outcomes = [(tasks[0][0], partial(_unless_cancelled, tasks[0][1]))]
+    else:
+        pool = _shard_executor()
+        outcomes = []
+        for keys, fn in tasks:
+            timings.append(FetchTiming())
+            fut = pool.submit(_in_meter, timings[-1], partial(_unless_cancelled, fn))
+            outcomes.append((keys, fut.result))
+    for keys, result in outcomes:
+        try:
+            bodies.update(result())
+        except Exception as e:
+            errors.update(dict.fromkeys(keys, str(e)))
+    timing = _metering()
+    if timing is not None:
+        for shard_timing in timings:
+            timing.merge(shard_timing)
+    return bodies, errors
+
+
+def fetch_talker(
+    talker: str,
+    date_from: str,
+    date_to: str,
+    page_size: int = PAGE_SIZE,
+    budget: int = 0,
+    filt: Optional[MessageFilter] = None,
+    cancel: Optional[threading.Event] = None,
+) -> ChatLog:
+    """获取某个群聊在时间范围内的记录。
+
+    范围按天拆分：已稳定的过去日期直接读本地缓存（或归档），其余日期经 _fetch_days
+    分片并行请求后端。page_size > 0 时按页抓取并记住每天的高水位，下次只拉新增部分。
+    日期无法解析时退回整段请求、不走缓存。budget > 0 时只保留最新的 budget 字：
+    从最新一天往前拼，预算用满后更早的日期不再渲染，也不再请求。
+    filt 生效时强制走 JSON，过滤后再渲染。cancel 被置位后不再发起新的分片请求。
+    """
+    if filt is not None and filt.active:
+        page_size = page_size or PAGE_SIZE
+    days = day_range(date_from, date_to)
+    if days is None:
+        if not page_size:
+            # 不走缓存的整段请求：边读边按预算丢弃旧消息，内存占用有上限
+            return fetch_chatlog(build_url(talker, date_from, date_to), budget, talker)
+        messages: deque[Message] = deque()
+        kept = dropped = 0
+
+        def _on_page(page: List[Dict[str, Any]], restart: bool):
+            nonlocal kept, dropped
+            if restart:
+                messages.clear()
+                kept = dropped = 0
+            for raw in page:
+                if filt is not None and not filt.keep_raw(raw):
+                    continue
+                m = Message(raw)
+                messages.append(m)
+                kept += len(m.content)
+            while budget and kept > budget and len(messages) > 1:
+                old = len(messages.popleft().content)
+                kept -= old
+                dropped += old
+
+        try:
+            fetch_pages(talker, date_from, date_to, page_size, on_page=_on_page)
+        except Exception as e:
+            return ChatLog("", error=str(e))
+        if filt is not None and filt.active:
+            # keep_raw 已在逐页时执行，这里只做去重/折叠
+            messages = filt.compact(list(messages))
+        text, extra = truncate_oldest(render_messages(messages), budget)
+        return ChatLog(text or "[空]", dropped + extra)
+
+    today = date.today()
+    past = [day for day in days if day <= today]
+    entries = {day: _cached_day(talker, day.isoformat()) for day in past}
+
+    # 从最新的一天往前拼，预算用满即停：更早的日期既不渲染也不请求
+    newest_first = past[::-1]
+    bodies: Dict[str, str] = {}
+    failed: List[str] = []
+    stale = False
+    total = 0
+    i = 0
+    while i < len(newest_first) and not (budget and total >= budget):
+        # 连续一段缓存不可用的日期一起交给 _fetch_days 分片并行。有预算时按已拼日期的
+        # 平均字数估算还需要几天（起步一个分片，最多 SHARD_DAYS * SHARD_WORKERS 天）
+        run = 0
+        if not budget:
+            limit = len(newest_first)
+        elif total:
+            limit = min(math.ceil((budget - total) * i / total), SHARD_DAYS * SHARD_WORKERS)
+        else:
+            limit = SHARD_DAYS
+        while (
+            i + run < len(newest_first)
+            and run < limit
+            and not _usable(entries[newest_first[i + run]], filt)
+        ):
+            run += 1
+        if run:
+            batch = newest_first[i : i + run]
+            fetched, errors = _fetch_days(
+                talker, batch[::-1], entries, page_size, filt, cancel
+            )
+        else:
+            batch, fetched, errors = newest_first[i : i + 1], {}, {}
+        for day in batch:
+            key = day.isoformat()
+            if key in errors:
+                failed.append(f"{key}：{errors[key]}")
+                # 分页抓取会逐页落盘，重新读取以拿到失败前已完成的部分
+                entry = cache.get(talker, key)
+                if entry is None or not entry.body:
+                    continue
+                body, stale = _render_entry(entry, filt), True
+            elif key in fetched:
+                body = fetched[key]
+            else:
+                body = _render_entry(entries[day], filt)
+            if body:
+                bodies[key] = body
+                total += len(body) + 2
+        i += len(batch)
+
+    error = ""
+    if failed:
+        failed.sort()
+        error = failed[0] + (f" 等 {len(failed)} 天" if len(failed) > 1 else "")
+        if not bodies:
+            return ChatLog("", error=error)
+    parts = [(key, bodies[key]) for key in (d.isoformat() for d in past) if key in bodies]
+    text, dropped = truncate_oldest(_join_days(parts, len(days)), budget)
+    if i < len(newest_first):
+        # 没有拼入的更早日期按已拼日期的平均字数估算省略量
+        dropped += (len(newest_first) - i) * (total // max(i, 1))
+    return ChatLog(text, dropped, error=error, stale=stale)
+
+
+def cached_talker(
+    talker: str,
+    date_from: str,
+    date_to: str,
+    budget: int = 0,
+    filt: Optional[MessageFilter] = None,
+) -> Optional[ChatLog]:
+    """只用本地缓存（含尚未稳定的日期）拼出记录，作为超时群聊的陈旧兜底；没有缓存时返回 None。"""
+    days = day_range(date_from, date_to)
+    if days is None:
+        return None
+    parts = []
+    for day in days:
+        entry = cache.get(talker, day.isoformat())
+        if entry is not None and entry.body:
+            parts.append((day.isoformat(), _render_entry(entry, filt)))
+    if not parts:
+        return None
+    text, dropped = truncate_oldest(_join_days(parts, len(days)), budget)
+    return ChatLog(text, dropped, stale=True)
+
+
+class _TalkerSplitter:
+    """把多 talker 合并请求返回的消息按群聊名拆开。
+
+    后端返回的 talker 是微信 ID，talkerName 是显示名，群聊名与两者之一相同即可匹配；
+    剩下唯一一个未匹配的名称与唯一一个未知 ID 也可配对，其余无法确定的名称交给调用方
+    回退为单独请求。配对结果跨天复用。
+    """
+
+    def __init__(self, names: Sequence[str]):
+        self.names = list(names)
+        self.id_to_name: Dict[str, str] = {}
+        self.unresolved: set[str] = set()
+
+    def split(self, messages: Sequence[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        by_name: Dict[str, List[Dict[str, Any]]] = {n: [] for n in self.names}
+        unknown: Dict[str, List[Dict[str, Any]]] = {}
+        for m in messages:
+            talker = m.get("talker", "")
+            name = self.id_to_name.get(talker)
+            if name is None:
+                for key in (talker, m.get("talkerName", "")):
+                    if key in by_name:
+                        name = self.id_to_name[talker] = key
+                        break
+            if name is None:
+                unknown.setdefault(talker, []).append(m)
+            else:
+                by_name[name].append(m)
+
+        if unknown:
+            empty = [
+                n for n in self.names
+                if not by_name[n] and n not in self.id_to_name.values()
+            ]
+            if len(empty) == 1 and len(unknown) == 1:
+                talker, msgs = unknown.popitem()
+                self.id_to_name[talker] = empty[0]
+                by_name[empty[0]] = msgs
+            else:
+                self.unresolved.update(empty)
+        return by_name
+
+
+def fetch_talkers_batched(
+    names: Sequence[str],
+    date_from: str,
+    date_to: str,
+    page_size: int = PAGE_SIZE,
+    budget: int = 0,
+    filt: Optional[MessageFilter] = None,
+    cancel: Optional[threading.Event] = None,
+) -> List[ChatLog]:
+    """一次请求带上全部群聊（talker 以逗号分隔），再在本地按群聊拆分。
+
+    缓存规则与 fetch_talker 一致：每天只为缓存未命中（或未稳定）的群聊发起一次合并请求；
+    合并请求不分页（见 fetch_json），page_size 只用于回退的单独请求。
+    名称含逗号或无法与返回结果对应的群聊回退为单独请求。结果按 names 顺序返回。
+    cancel 被置位后不再发起新的请求，直接返回已拿到的部分。
+    """
+    batch = [n for n in names if "," not in n]
+    splitter = _TalkerSplitter(batch)
+    texts: Dict[str, List[tuple[str, str]]] = {n: [] for n in batch}
+    days = day_range(date_from, date_to)
+
+    try:
+        if days is None:
+            messages = fetch_json(",".join(batch), date_from, date_to)
+            for name, msgs in splitter.split(messages).items():
+                if filt is not None and filt.active:
+                    rendered = render_messages(filt.apply(msgs))
+                else:
+                    rendered = render_messages([Message(m) for m in msgs])
+                texts[name].append(("", rendered))
+        else:
+            today = date.today()
+            for day in days:
+                if day > today or (cancel is not None and cancel.is_set()):
+                    break
+                key = day.isoformat()
+                missing = []
+                for name in batch:
+                    entry = _cached_day(name, key)
+                    if _usable(entry, filt):
+                        texts[name].append((key, _render_entry(entry, filt)))
+                    else:
+                        missing.append(name)
+                if not missing:
+                    continue
+
+                fetched_at = datetime.now()
+                by_name = splitter.split(fetch_json(",".join(missing), key, key))
+                for name in missing:
+                    if name in splitter.unresolved:
+                        continue
+                    msgs = by_name[name]
+                    entry = CacheEntry(
+                        "\n".join(json.dumps(m, ensure_ascii=False) for m in msgs),
+                        _is_settled(day, fetched_at),
+                        kind="json",
+                        msg_count=len(msgs),
+                        last_seq=msgs[-1].get("seq", 0) if msgs else 0,
+                    )
+                    _store_day(name, key, entry)
+                    texts[name].append((key, _render_entry(entry, filt)))
+    except Exception:
+        # 合并请求失败时逐个群聊单独抓取，由 fetch_talker 负责重试、熔断与缓存兜底
+        return [
+            fetch_talker(name, date_from, date_to, page_size, budget, filt, cancel)
+            for name in names
+        ]
+
+    if cancel is not None and cancel.is_set():
+        # 取消或超时后不再为单独回退的群聊发请求
+        return [ChatLog("", error="已取消") for _ in names]
+
+    results = []
+    for name in names:
+        if name not in texts or name in splitter.unresolved:
+            results.append(
+                fetch_talker(name, date_from, date_to, page_size, budget, filt, cancel)
+            )
+            continue
+        parts = [(key, body) for key, body in texts[name] if body]
+        text = _join_days(parts, 1 if days is None else len(days))
+        results.append(ChatLog(*truncate_oldest(text, budget)))
+    return results
+
+
+# ---------------------------------------------------------------------------
+# 群聊 / 联系人索引
+# ---------------------------------------------------------------------------
+
+API_BASE = API_URL.rsplit("/", 1)[0]
+
+
+@dataclass
+class IndexEntry:
+    id: str     # userName / xxx@chatroom，即 talker
+    name: str   # 显示名：备注 > 昵称 > ID
+    kind: str   # "chatroom" | "contact"
+    keys: List[str] = field(default_factory=list)  # 可用于查找的全部名称（含 ID、微信号）
+
+
+def _list_items(endpoint: str) -> Iterator[Dict[str, Any]]:
+    """按 limit/offset 分页读取 /api/v1/<endpoint>?format=json 的 items。"""
+    offset = 0
+    while True:
+        r = get_session().get(
+            f"{API_BASE}/{endpoint}",
+            params={"format": "json", "limit": INDEX_PAGE_SIZE, "offset": offset},
+            timeout=FETCH_TIMEOUT,
+        )
+        r.raise_for_status()
+        items = (r.json() or {}).get("items") or []
+        yield from items
+        if len(items) < INDEX_PAGE_SIZE:
+            return
+        offset += len(items)
+
+
+class ChatIndex:
+    """后端群聊与联系人的本地索引，持久化到 chat_index.json。
+
+    名称按小写排序存放，前缀查找用 bisect，找不到时再做子串 / 近似匹配，
+    供输入框自动补全和把群聊显示名解析为 talker ID。
+    """
+
+    def __init__(self, path: str = INDEX_PATH, ttl: float = INDEX_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.updated_at = 0.0
+        self._entries: Dict[str, IndexEntry] = {}
+        self._sorted: List[tuple[str, str]] = []  # (小写名称, ID)，按名称排序
+        self._loaded = False
+        self._lock = threading.Lock()  # 保护 _entries/_sorted 的整体替换
+        self._refresh_lock = threading.Lock()  # 同一时间只跑一次刷新
+
+    # ---- 读写 ----
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not os.path.exists(self.path):
+                return
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    raw = json.load(f)
+                entries = {e["id"]: IndexEntry(**e) for e in raw.get("entries", [])}
+            except (OSError, ValueError, TypeError, KeyError):
+                return  # 索引损坏就当不存在，下次刷新重建
+            # 内容没变的刷新只更新文件修改时间（见 refresh），取两者较新的一个
+            self.updated_at = max(raw.get("updated_at", 0.0), os.path.getmtime(self.path))
+            self._install(entries)
+
+    def _install(self, entries: Dict[str, IndexEntry]) -> None:
+        self._entries = entries
+        self._sorted = sorted(
+            (key.casefold(), e.id) for e in entries.values() for key in e.keys if key
+        )
+
+    def _save(self) -> None:
+        atomic_write(
+            self.path,
+            json.dumps(
+                {
+                    "updated_at": self.updated_at,
+                    "entries": [asdict(e) for e in self._entries.values()],
+                },
+                ensure_ascii=False,
+            ),
+        )
+
+    # ---- 刷新 ----
+
+    @property
+    def stale(self) -> bool:
+        self._ensure_loaded()
+        return time.time() - self.updated_at > self.ttl
+
+    def refresh(self, force: bool = False) -> int:
+        """从后端重新拉取群聊与联系人，返回新增或变化的条目数。
+
+        未过期且非 force 时直接返回 0；内容没有变化时不重建排序表也不重写文件，
+        只更新索引文件的修改时间记下这次刷新，重启后不会因过期而立刻再拉一遍。
+        """
+        if not force and not self.stale:
+            return 0
+        with self._refresh_lock:
+            entries: Dict[str, IndexEntry] = {}
+            for item in _list_items("contact"):
+                uid = item.get("userName", "")
+                if uid:
+                    entries[uid] = IndexEntry(
+                        uid,
+                        item.get("remark") or item.get("nickName") or uid,
+                        "contact",
+                        _unique_keys(
+                            item.get("remark"), item.get("nickName"), item.get("alias"), uid
+                        ),
+                    )
+            # 群聊放在后面，同一 ID 以群聊信息为准
+            for item in _list_items("chatroom"):
+                uid = item.get("name", "")
+                if uid:
+                    entries[uid] = IndexEntry(
+                        uid,
+                        item.get("remark") or item.get("nickName") or uid,
+                        "chatroom",
+                        _unique_keys(item.get("remark"), item.get("nickName"), uid),
+                    )
+
+            self._ensure_loaded()
+            changed = sum(1 for uid, e in entries.items() if self._entries.get(uid) != e)
+            removed = len(self._entries.keys() - entries.keys())
+            with self._lock:
+                self.updated_at = time.time()
+                if changed or removed:
+                    self._install(entries)
+            if changed or removed or not os.path.exists(self.path):
+                self._save()
+            else:
+                os.utime(self.path, (self.updated_at, self.updated_at))
+            return changed
+
+    # ---- 查找 ----
+
+    def get(self, uid: str) -> Optional[IndexEntry]:
+        self._ensure_loaded()
+        return self._entries.get(uid)
+
+    def resolve(self, name: str) -> Optional[str]:
+        """名称（备注/昵称/微信号/ID，忽略大小写）精确匹配唯一条目时返回其 ID。"""
+        self._ensure_loaded()
+        key = name.strip().casefold()
+        if not key:
+            return None
+        sorted_keys = self._sorted
+        i = bisect.bisect_left(sorted_keys, (key, ""))
+        ids = set()
+        while i < len(sorted_keys) and sorted_keys[i][0] == key:
+            ids.add(sorted_keys[i][1])
+            i += 1
+        if len(ids) == 1:
+            return ids.pop()
+        return None  # 找不到或同名多个，交给用户在补全列表里选
+
+    def lookup(self, text: str, limit: int = 10) -> List[IndexEntry]:
+        """自动补全：先前缀匹配，不足 limit 条再补子串匹配与近似匹配。"""
+        self._ensure_loaded()
+        key = text.strip().casefold()
+        if not key:
+            return []
+        entries, sorted_keys = self._entries, self._sorted
+        found: Dict[str, None] = {}
+
+        i = bisect.bisect_left(sorted_keys, (key, ""))
+        while i < len(sorted_keys) and len(found) < limit:
+            name, uid = sorted_keys[i]
+            if not name.startswith(key):
+                break
+            found[uid] = None
+            i += 1
+
+        if len(found) < limit:
+            for name, uid in sorted_keys:
+                if key in name:
+                    found[uid] = None
+                    if len(found) >= limit:
+                        break
+
+        if len(found) < limit:
+            names = {name: uid for name, uid in sorted_keys}
+            for name in difflib.get_close_matches(key, list(names), n=limit, cutoff=0.6):
+                found[names[name]] = None
+                if len(found) >= limit:
+                    break
+
+        return [entries[uid] for uid in found]
+
+
+def _unique_keys(*keys: Optional[str]) -> List[str]:
+    return list(dict.fromkeys(k for k in keys if k))
+
+
+chat_index = ChatIndex()
+
+
+# ---------------------------------------------------------------------------
+# 全文检索
+# ---------------------------------------------------------------------------
+
+_SEARCH_TOKEN_RE = re.compile(r"[0-9a-z_]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """检索分词：英文数字按单词（小写），中日韩文字按相邻二字切分，单独一个字时保留单字。"""
+    tokens = []
+    for run in _SEARCH_TOKEN_RE.findall(text.lower()):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+@dataclass
+class _IndexedDay:
+    talker: str
+    day: str
+    seqs: List[int] = field(default_factory=list)  # 按消息顺序，下标即组内位置
+    msg_count: int = -1  # 上次同步时缓存项的条数与最后 seq，都没变时不必重读
+    last_seq: int = 0
+    final: bool = False  # 缓存已稳定，之后不再读取
+
+
+@dataclass
+class SearchWindow:
+    """一段命中的消息窗口：同一群聊同一天内 [start, end) 位置的消息。"""
+
+    talker: str
+    day: str
+    start: int
+    end: int
+    score: float
+
+
+class SearchIndex:
+    """基于本地缓存（分页抓取的 JSON 消息）的内存倒排索引。
+
+    按 (talker, 日期) 增量索引，已稳定的日期只读取一次，同一条消息按 (talker, seq) 去重；
+    倒排表只存消息编号，渲染命中窗口时再从缓存取原文。纯文本缓存没有结构化消息，不参与检索。
+    缓存项被重抓改写后整天重新扫描，已不在缓存里的消息标记为删除（所在组记为 -1）。
+    """
+
+    def __init__(self, source: Optional[MessageCache] = None):
+        self._cache = source
+        self._lock = threading.Lock()
+        self._days: List[_IndexedDay] = []
+        self._day_ids: Dict[tuple[str, str], int] = {}
+        self._doc_day: List[int] = []   # 消息编号 -> 所在 _days 下标，已删除为 -1
+        self._doc_pos: List[int] = []   # 消息编号 -> 组内位置
+        self._postings: Dict[str, List[int]] = {}
+        self._seen: Dict[tuple[str, int], int] = {}  # (talker, seq) -> 消息编号
+        self._removed = 0
+
+    @property
+    def size(self) -> int:
+        return len(self._doc_day) - self._removed
+
+    def add(self, talker: str, day: str, raws: Iterable[Dict[str, Any]]) -> int:
+        """把一批消息加入索引，返回新增条数。"""
+        with self._lock:
+            return self._add(self._day(talker, day), raws)
+
+    def _day(self, talker: str, day: str) -> int:
+        key = (talker, day)
+        gid = self._day_ids.get(key)
+        if gid is None:
+            gid = self._day_ids[key] = len(self._days)
+            self._days.append(_IndexedDay(talker, day))
+        return gid
+
+    def _add(self, gid: int, raws: Iterable[Dict[str, Any]]) -> int:
+        group = self._days[gid]
+        added = 0
+        for raw in raws:
+            if (group.talker, raw.get("seq", 0)) not in self._seen:
+                self._new_doc(gid, raw)
+                added += 1
+        return added
+
+    def _new_doc(self, gid: int, raw: Dict[str, Any]) -> None:
+        group = self._days[gid]
+        seq = raw.get("seq", 0)
+        doc = self._seen[(group.talker, seq)] = len(self._doc_day)
+        self._doc_day.append(gid)
+        self._doc_pos.append(len(group.seqs))
+        group.seqs.append(seq)
+        text = f"{raw.get('senderName', '')} {raw.get('content', '')}"
+        for token in set(tokenize(text)):
+            self._postings.setdefault(token, []).append(doc)
+
+    def _rescan(self, gid: int, raws: Iterable[Dict[str, Any]]) -> int:
+        """按缓存项的完整内容重建某天的消息顺序，返回新增条数。
+
+        已索引的消息只更新组内位置，新消息加入索引，不再出现的消息标记为删除。
+        """
+        group = self._days[gid]
+        old, group.seqs = group.seqs, []
+        kept: Set[int] = set()
+        added = 0
+        for raw in raws:
+            key = (group.talker, raw.get("seq", 0))
+            doc = self._seen.get(key)
+            if doc is None:
+                self._new_doc(gid, raw)
+                added += 1
+            elif self._doc_day[doc] == gid and key[1] not in kept:
+                self._doc_pos[doc] = len(group.seqs)
+                group.seqs.append(key[1])
+            kept.add(key[1])
+        for seq in old:
+            if seq not in kept:
+                doc = self._seen.pop((group.talker, seq))
+                self._doc_day[doc] = -1
+                self._removed += 1
+        return added
+
+    def sync(self, talkers: Iterable[str], days: Iterable[str]) -> int:
+        """从缓存补齐这些群聊在这些日期的新消息，返回新增条数。"""
+        source = self._cache if self._cache is not None else cache
+        added = 0
+        with self._lock:
+            for talker in talkers:
+                for day in days:
+                    gid = self._day_ids.get((talker, day))
+                    if gid is not None and self._days[gid].final:
+                        continue
+                    entry = source.get(talker, day)
+                    if entry is None or entry.kind != "json" or not entry.body:
+                        continue
+                    gid = self._day(talker, day)
+                    group = self._days[gid]
+                    if (group.msg_count, group.last_seq) != (entry.msg_count, entry.last_seq):
+                        # 条数或最后 seq 变了：可能是追加，也可能是重抓改写了前面的记录，
+                        # 整天重新扫描，已索引的消息靠 _seen 去重
+                        raws = map(json.loads, entry.body.split("\n"))
+                        added += self._rescan(gid, raws)
+                        group.msg_count, group.last_seq = entry.msg_count, entry.last_seq
+                    group.final = entry.final
+        return added
+
+    def search(
+        self,
+        query: str,
+        talkers: Iterable[str],
+        days: Iterable[str],
+        top_k: int = SEARCH_TOP_K,
+        context: int = SEARCH_CONTEXT,
+    ) -> List[SearchWindow]:
+        """在指定群聊与日期内检索，返回得分最高的 top_k 个消息窗口（按得分降序）。
+
+        消息得分为命中词的 IDF 之和；命中消息前后各扩展 context 条，重叠或相邻的窗口合并、得分相加。
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        talkers, days = set(talkers), set(days)
+        with self._lock:
+            allowed = {
+                gid
+                for (talker, day), gid in self._day_ids.items()
+                if talker in talkers and day in days
+            }
+            doc_day = self._doc_day
+            n_docs = len(doc_day) or 1
+            everything = len(allowed) == len(self._days) and not self._removed
+            scores: Dict[int, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                weight = math.log(1 + n_docs / len(postings))
+                if not everything:
+                    postings = [doc for doc in postings if doc_day[doc] in allowed]
+                if not scores:
+                    scores = dict.fromkeys(postings, weight)
+                    continue
+                get = scores.get
+                for doc in postings:
+                    scores[doc] = get(doc, 0.0) + weight
+
+            # 常见词会命中大量消息，只为得分最高的一批构造窗口；同分时取较新的消息
+            best = heapq.nlargest(
+                top_k * (2 * context + 2), scores.items(), key=lambda kv: (kv[1], kv[0])
+            )
+            hits = sorted((doc_day[d], self._doc_pos[d], s) for d, s in best)
+            windows: List[SearchWindow] = []
+            for gid, pos, score in hits:
+                group = self._days[gid]
+                start = max(0, pos - context)
+                end = min(len(group.seqs), pos + context + 1)
+                last = windows[-1] if windows else None
+                if (
+                    last is not None
+                    and (last.talker, last.day) == (group.talker, group.day)
+                    and start <= last.end
+                ):
+                    last.end = max(last.end, end)
+                    last.score += score
+                else:
+                    windows.append(
+                        SearchWindow(group.talker, group.day, start, end, score)
+                    )
+            return heapq.nlargest(top_k, windows, key=lambda w: w.score)
+
+    def excerpt(
+        self, windows: Iterable[SearchWindow], filt: Optional[MessageFilter] = None
+    ) -> Dict[str, str]:
+        """把窗口按群聊、时间顺序渲染为文本，返回 talker -> 文本。
+
+        原文从缓存读取；已被缓存淘汰的消息跳过。
+        """
+        source = self._cache if self._cache is not None else cache
+        by_talker: Dict[str, List[SearchWindow]] = {}
+        for w in sorted(windows, key=lambda w: (w.day, w.start)):
+            by_talker.setdefault(w.talker, []).append(w)
+
+        out = {}
+        for talker, wins in by_talker.items():
+            parts: List[str] = []
+            last_day = ""
+            raws_by_day: Dict[str, Dict[int, Dict[str, Any]]] = {}
+            for w in wins:
+                if w.day not in raws_by_day:
+                    entry = source.get(talker, w.day)
+                    raws = (
+                        map(json.loads, entry.body.split("\n"))
+                        if entry is not None and entry.kind == "json" and entry.body
+                        else ()
+                    )
+                    raws_by_day[w.day] = {raw.get("seq", 0): raw for raw in raws}
+                with self._lock:
+                    group = self._days[self._day_ids[(talker, w.day)]]
+                    seqs = group.seqs[w.start : w.end]
+                found = [raws_by_day[w.day][s] for s in seqs if s in raws_by_day[w.day]]
+                if filt is not None and filt.active:
+                    messages = filt.apply(found)
+                else:
+                    messages = [Message(raw) for raw in found]
+                body = render_messages(messages, "%H:%M:%S")
+                if not body:
+                    continue
+                # 同一天的多个窗口之间用省略号隔开
+                head = f"—— {w.day} ——" if w.day != last_day else "……"
+                parts.append(f"{head}\n{body}")
+                last_day = w.day
+            out[talker] = "\n\n".join(parts)
+        return out
+
+
+search_index = SearchIndex()
+
+
+# ---------------------------------------------------------------------------
+# Token 估算 & 粘贴
+# ---------------------------------------------------------------------------
+
+_CJK_RE = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 LLM token 数：中日韩字符约 1 字 1 token，其余约 4 字符 1 token。"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_for_paste(text: str, token_budget: int) -> List[str]:
+    """按消息边界（空行）把文本切成每段不超过 token_budget 的若干段。
+
+    单条消息本身超出预算时再按行、最后按字硬切。多于一段时每段加上“第 i/n 部分”。
+    """
+    if token_budget <= 0 or estimate_tokens(text) <= token_budget:
+        return [text]
+    token_budget = max(token_budget - 16, 1)  # 为“第 i/n 部分”抬头预留
+
+    def _pieces(block: str) -> Iterable[tuple[str, str]]:
+        """逐个给出 (片段, 与前一片段的分隔)：块之间空行，同一块的行之间换行，硬切的同一行不加。"""
+        if estimate_tokens(block) <= token_budget:
+            yield block, "\n\n"
+            return
+        sep = "\n\n"
+        for line in block.split("\n"):
+            while estimate_tokens(line) > token_budget:
+                # token_budget 个字符的 token 数一定不超过 token_budget
+                yield line[:token_budget], sep
+                line, sep = line[token_budget:], ""
+            yield line, sep
+            sep = "\n"
+
+    chunks: List[str] = []
+    current: List[str] = []
+    used = 0
+    for block in text.split("\n\n"):
+        for piece, sep in _pieces(block):
+            cost = estimate_tokens(piece) + 1
+            if current and used + cost > token_budget:
+                chunks.append("".join(current))
+                current, used = [], 0
+            current.append(sep + piece if current else piece)
+            used += cost
+    if current:
+        chunks.append("".join(current))
+
+    n = len(chunks)
+    return [f"【第 {i}/{n} 部分】\n{chunk}" for i, chunk in enumerate(chunks, 1)]
+
+
+def paste_and_send(text: str, stages: Optional[Dict[str, float]] = None) -> None:
+    """复制到剪贴板，模拟 Ctrl+V 粘贴到当前光标处并回车发送。
+
+    先确认剪贴板已更新，再按内容长度自适应等待粘贴完成后才回车，
+    避免大段文本尚未落入输入框就被发送。传入 stages 时累加
+    clipboard（复制并确认）与 keystrokes（按键及其间等待）两段耗时。
+    """
+    # 仅界面模式需要，延迟导入以免拖慢命令行启动
+    import keyboard
+    import pyperclip
+
+    started = time.perf_counter()
+    pyperclip.copy(text)
+    deadline = time.monotonic() + PASTE_CLIPBOARD_WAIT
+    while pyperclip.paste() != text and time.monotonic() < deadline:
+        time.sleep(0.02)
+    copied = time.perf_counter()
+    time.sleep(0.15)
+    keyboard.press_and_release("ctrl+v")
+    time.sleep(min(PASTE_MAX_SETTLE, 0.05 + len(text) / PASTE_CHARS_PER_SEC))
+    keyboard.press_and_release("enter")
+
+    if stages is not None:
+        stages["clipboard"] = stages.get("clipboard", 0.0) + copied - started
+        stages["keystrokes"] = (
+            stages.get("keystrokes", 0.0) + time.perf_counter() - copied
+        )
+
+
+def paste_chunks(
+    chunks: Sequence[str],
+    cancel: Optional[threading.Event] = None,
+    stages: Optional[Dict[str, float]] = None,
+) -> int:
+    """依次粘贴并发送各段，返回实际发送的段数（被取消时提前停止）。"""
+    for i, chunk in enumerate(chunks):
+        if cancel is not None and cancel.is_set():
+            return i
+        if i:
+            time.sleep(PASTE_CHUNK_INTERVAL)
+        paste_and_send(chunk, stages)
+    return len(chunks)
+
+
+# ---------------------------------------------------------------------------
+# 模板引擎
+# ---------------------------------------------------------------------------
+
+# 模板级占位符；{content} 为模板正文，正文中同样可以使用占位符
+LAYOUT_VARS = frozenset(
+    {
+        "template_name",
+        "content",
+        "date_range",
+        "date_from",
+        "date_to",
+        "chat_count",
+        "message_count",
+    }
+)
+# {#chats}…{/chats} 块内额外可用的占位符，同名时覆盖模板级（如 message_count）
+CHAT_VARS = frozenset(
+    {"chat_name", "text", "message_count", "tokens", "truncated", "stale", "partial"}
+)
+
+# 默认布局，输出与固定格式时代完全一致
+DEFAULT_LAYOUT = (
+    "{template_name}\n\n{content}"
+    "{#chats}\n\n========\n【群聊：{chat_name}】\n========\n"
+    "{?stale}[后端暂不可用，部分记录来自本地缓存]\n{/stale}"
+    "{?partial}[部分记录获取失败，可能不完整]\n{/partial}"
+    "{?truncated}[已截断：省略较早的 {truncated} 字]\n{/truncated}"
+    "{text}{/chats}"
+)
+
+_TAG_RE = re.compile(r"\{([#?/]?)([a-z_]+)\}")
+
+# 与后端纯文本格式一致的消息头：发送者 + 时间（时分秒，可能带月日或年月日）
+_MESSAGE_HEAD_RE = re.compile(
+    r"^\S[^\n]* (?:\d{4}-)?(?:\d\d-\d\d )?\d\d:\d\d:\d\d$", re.MULTILINE
+)
+
+
+def count_messages(text: str) -> int:
+    """按消息头行数估算渲染后文本中的消息条数。"""
+    return len(_MESSAGE_HEAD_RE.findall(text))
+
+
+class CompiledTemplate:
+    """编译后的模板：文本片段与占位符组成的节点树，渲染时一次遍历写入同一个缓冲区。
+
+    节点为 ("text", 字符串) / ("var", 名称) / ("if", 名称, 子节点) / ("chats", 子节点)。
+    无法识别的花括号（未知名称、作用域不对、未闭合或多余的结束标记）原样保留。
+    """
+
+    __slots__ = ("source", "nodes")
+
+    def __init__(self, source: str):
+        self.source = source
+        literal: Set[int] = set()
+        while True:
+            nodes, unclosed = self._parse(source, literal)
+            if unclosed is None:
+                break
+            # 未闭合的块：开始标记按原文处理后重新解析，块内占位符按外层作用域判断
+            literal.add(unclosed)
+        self.nodes = nodes
+
+    @staticmethod
+    def _parse(source: str, literal: Set[int]) -> tuple[tuple, Optional[int]]:
+        """返回 (节点, 最内层未闭合开始标记的位置)。"""
+        # 栈帧：(块类型, 名称, 开始标记位置, 子节点列表)
+        stack: List[tuple[str, str, int, list]] = [("root", "", -1, [])]
+
+        def emit(node: tuple) -> None:
+            nodes = stack[-1][3]
+            if node[0] == "text" and nodes and nodes[-1][0] == "text":
+                nodes[-1] = ("text", nodes[-1][1] + node[1])
+            elif node[0] != "text" or node[1]:
+                nodes.append(node)
+
+        def in_chats() -> bool:
+            return any(frame[0] == "chats" for frame in stack)
+
+        pos = 0
+        for m in _TAG_RE.finditer(source):
+            emit(("text", source[pos : m.start()]))
+            pos = m.end()
+            sigil, name = m.groups()
+            known = name in LAYOUT_VARS or (name in CHAT_VARS and in_chats())
+            if m.start() in literal:
+                emit(("text", m.group()))
+            elif sigil == "#" and name == "chats" and not in_chats():
+                stack.append(("chats", name, m.start(), []))
+            elif sigil == "?" and known:
+                stack.append(("if", name, m.start(), []))
+            elif sigil == "/" and len(stack) > 1 and stack[-1][1] == name:
+                kind, _, _, body = stack.pop()
+                emit((kind, tuple(body)) if kind == "chats" else (kind, name, tuple(body)))
+            elif not sigil and known:
+                emit(("var", name))
+            else:
+                emit(("text", m.group()))
+        emit(("text", source[pos:]))
+        if len(stack) > 1:
+            return (), stack[-1][2]
+        return tuple(stack[0][3]), None
+
+    def render(
+        self,
+        context: Dict[str, Any],
+        chats: Sequence[Dict[str, Any]] = (),
+        out: Optional[io.StringIO] = None,
+    ) -> str:
+        """渲染到 out（默认新建），返回 out 的全部内容。
+
+        context 中值为 CompiledTemplate 的占位符（如 content）以同一上下文就地渲染。
+        """
+        if out is None:
+            out = io.StringIO()
+        self._render(self.nodes, context, chats, out.write)
+        return out.getvalue()
+
+    def _render(self, nodes, scope, chats, write) -> None:
+        for node in nodes:
+            op = node[0]
+            if op == "text":
+                write(node[1])
+            elif op == "var":
+                value = scope.get(node[1], "")
+                if isinstance(value, CompiledTemplate):
+                    # 嵌套模板里再引用自身时按空值处理，避免无限递归
+                    value._render(value.nodes, {**scope, node[1]: ""}, chats, write)
+                else:
+                    write(str(value))
+            elif op == "if":
+                if scope.get(node[1]):
+                    self._render(node[2], scope, chats, write)
+            else:  # chats
+                for chat in chats:
+                    self._render(node[1], {**scope, **chat}, chats, write)
+
+
+@lru_cache(maxsize=256)
+def compile_template(source: str) -> CompiledTemplate:
+    """编译并缓存模板；同一段文本只解析一次。"""
+    return CompiledTemplate(source)
+
+
 # ---------------------------------------------------------------------------
 # 数据结构
 # ---------------------------------------------------------------------------
 
+LOCAL_ID_PREFIX = "local:"  # 尚未解析出后端 ID 的群聊使用的本地 ID 前缀
+
+
+def new_local_id() -> str:
+    return LOCAL_ID_PREFIX + uuid.uuid4().hex[:12]
+
+
 @dataclass
 class Chat:
     name: str
+    id: str = ""  # 稳定 ID：后端的 wxid / xxx@chatroom，未解析时为本地 ID
+
+    def __post_init__(self):
+        if not self.id:
+            self.id = new_local_id()
+
+    @property
+    def resolved(self) -> bool:
+        return not self.id.startswith(LOCAL_ID_PREFIX)
+
+    @property
+    def talker(self) -> str:
+        """请求后端时使用的 talker：已解析用 ID，改显示名不影响抓取；否则退回名称。"""
+        return self.id if self.resolved else self.name
 
 
 @dataclass
 class Template:
     name: str
     content: str
-    enabled_chats: List[bool] = field(default_factory=list)
+    chat_ids: Set[str] = field(default_factory=set)  # 启用群聊的 Chat.id，只存启用的
+    char_budget: int = 0  # 所有群聊记录合计的字数上限，0 = 不限
+    token_budget: int = 0  # 输出的 token 上限（估算），0 = 不限
+    split_paste: bool = False  # 超出 token_budget 时按消息边界分段依次发送
+    layout: str = ""  # 输出布局，可用占位符见 LAYOUT_VARS / CHAT_VARS，空 = DEFAULT_LAYOUT
+    query: str = ""   # 检索词（空格分隔），设置后各群聊只保留最相关的消息窗口
+    top_k: int = 0    # 所有群聊合计保留的窗口数，0 = SEARCH_TOP_K
+    context: int = SEARCH_CONTEXT  # 每条命中消息前后各带几条上下文
+
+    def compiled(self) -> tuple[CompiledTemplate, CompiledTemplate]:
+        """(布局, 正文) 的编译结果；按文本缓存，编辑后自动重新编译。"""
+        return (
+            compile_template(self.layout or DEFAULT_LAYOUT),
+            compile_template(self.content.strip()),
+        )
+
+    def enabled_chats(self, chats: Sequence[Chat]) -> List[Chat]:
+        """按 chats 的顺序返回启用的群聊；已删除群聊残留的 ID 自然被忽略。"""
+        return [c for c in chats if c.id in self.chat_ids]
 
 
 @dataclass
@@ -66,27 +2517,34 @@ class AppConfig:
     current_template: int = 0
     global_date_from: str = today_str()
     global_date_to: str = today_str()
+    page_size: int = PAGE_SIZE  # 0 = 不分页，整段请求纯文本
+    batch_talkers: bool = False  # 多个群聊合并为一次请求（talker 逗号分隔）
+    chat_char_budget: int = 0  # 单个群聊记录的字数上限，超出只保留最新消息，0 = 不限
+    filters: FilterOptions = field(default_factory=FilterOptions)  # 生效时改走 JSON
+    watch: bool = False  # 启动后在后台监听模板启用群聊的新消息
+    watch_interval: int = WATCH_INTERVAL  # 监听的初始轮询间隔，之后按群聊活跃度自适应，秒
 
     # ----------------------- 读写 -----------------------
 
     @staticmethod
     def _default() -> "AppConfig":
+        chat_a, chat_b = Chat("群聊A"), Chat("群聊B")
         return AppConfig(
-            chats=[Chat("群聊A"), Chat("群聊B")],
+            chats=[chat_a, chat_b],
             custom_templates=[
-                Template("模板A", "这是A正文", [True, False]),
-                Template("模板B", "这是B正文", [True, True]),
+                Template("模板A", "这是A正文", {chat_a.id}),
+                Template("模板B", "这是B正文", {chat_a.id, chat_b.id}),
             ],
             current_template=0,
         )
 
     @classmethod
-    def load(cls) -> "AppConfig":
+    def load(cls, path: str = CONFIG_PATH) -> "AppConfig":
         """读取 config.json，若不存在则返回默认配置。"""
-        if not os.path.exists(CONFIG_PATH):
+        if not os.path.exists(path):
             return cls._default()
 
-        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             raw = json.load(f)
 
         chats = [Chat(**c) for c in raw.get("chats", [])]
@@ -95,20 +2553,33 @@ class AppConfig:
 
         templates = []
         for tpl in raw.get("custom_templates", []):
-            tpl_enabled = tpl.get("enabled_chats", [])
-            # 自动补全/裁剪 enabled_chats 长度
-            if len(tpl_enabled) < len(chats):
-                tpl_enabled += [False] * (len(chats) - len(tpl_enabled))
+            if "chat_ids" in tpl:
+                chat_ids = set(tpl["chat_ids"])
+            else:
+                # 旧配置：enabled_chats 是与 chats 按位置对齐的布尔列表
+                chat_ids = {
+                    chat.id
+                    for chat, on in zip(chats, tpl.get("enabled_chats", []))
+                    if on
+                }
             templates.append(
                 Template(
                     name=tpl.get("name", "未命名模板"),
                     content=tpl.get("content", ""),
-                    enabled_chats=tpl_enabled[: len(chats)],
+                    chat_ids=chat_ids,
+                    char_budget=tpl.get("char_budget", 0),
+                    token_budget=tpl.get("token_budget", 0),
+                    split_paste=tpl.get("split_paste", False),
+                    layout=tpl.get("layout", ""),
+                    query=tpl.get("query", ""),
+                    top_k=tpl.get("top_k", 0),
+                    context=tpl.get("context", SEARCH_CONTEXT),
                 )
             )
+            templates[-1].compiled()  # 预编译，渲染时直接命中缓存
 
         if not templates:
-            templates.append(Template("默认模板", "", [False] * len(chats)))
+            templates.append(Template("默认模板", ""))
 
         return AppConfig(
             chats=chats,
@@ -118,478 +2589,1042 @@ class AppConfig:
             ),
             global_date_from=raw.get("global_date_from", today_str()),
             global_date_to=raw.get("global_date_to", today_str()),
+            page_size=raw.get("page_size", PAGE_SIZE),
+            batch_talkers=raw.get("batch_talkers", False),
+            chat_char_budget=raw.get("chat_char_budget", 0),
+            filters=FilterOptions(**raw.get("filters", {})),
+            watch=raw.get("watch", False),
+            watch_interval=raw.get("watch_interval", WATCH_INTERVAL),
         )
 
-    def save(self) -> None:
-        """保存到 config.json（确保文件简单易读）。"""
-        def serialize(obj):
-            if isinstance(obj, AppConfig):
-                d = asdict(obj)
-                # dataclass 默认会把 dataclass 对象也递归转 dict
-                return d
-            raise TypeError(obj)
-
-        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-            json.dump(self, f, indent=2, ensure_ascii=False, default=serialize)
+    def find_template(self, name: str) -> int:
+        """按名称查找模板下标，找不到返回 -1。"""
+        for i, tpl in enumerate(self.custom_templates):
+            if tpl.name == name:
+                return i
+        return -1
+
+    def set_chat_id(self, chat: Chat, new_id: str) -> None:
+        """更换群聊 ID，并把引用旧 ID 的模板一并改过去。"""
+        old_id, chat.id = chat.id, new_id
+        for tpl in self.custom_templates:
+            if old_id in tpl.chat_ids:
+                tpl.chat_ids.discard(old_id)
+                tpl.chat_ids.add(new_id)
+
+    def reresolve_chat(self, chat: Chat, index: "ChatIndex") -> bool:
+        """改名确认后调用：新名称唯一解析到另一个后端 ID 时改用该 ID，返回 ID 是否改变。
+
+        解析不出或仍是原 ID 时保留原 ID，改显示名不影响抓取。
+        """
+        if not chat.resolved:
+            return False
+        uid = index.resolve(chat.name)
+        if uid is None or uid == chat.id:
+            return False
+        self.set_chat_id(chat, uid)
+        return True
+
+    def watched_talkers(self) -> List[str]:
+        """监听模式需要关注的群聊：任一模板启用过的群聊。"""
+        ids = set().union(*(tpl.chat_ids for tpl in self.custom_templates))
+        return [chat.talker for chat in self.chats if chat.id in ids]
+
+    def resolve_chat_ids(self, index: "ChatIndex") -> int:
+        """用索引把仍是本地 ID 的群聊升级为后端 ID，返回升级的个数。"""
+        upgraded = 0
+        for chat in self.chats:
+            if chat.resolved:
+                continue
+            uid = index.resolve(chat.name)
+            if uid is not None:
+                self.set_chat_id(chat, uid)
+                upgraded += 1
+        return upgraded
+
+    def to_json(self) -> str:
+        """序列化为 config.json 的内容（确保文件简单易读）。"""
+        # dataclass 默认会把 dataclass 对象也递归转 dict
+        d = asdict(self)
+        # 集合转为有序列表；删除群聊时不回写模板，这里顺便剔除失效 ID
+        ids = {chat.id for chat in self.chats}
+        for tpl_d in d["custom_templates"]:
+            tpl_d["chat_ids"] = sorted(tpl_d["chat_ids"] & ids)
+        return json.dumps(d, indent=2, ensure_ascii=False)
+
+    def save(self, path: str = CONFIG_PATH) -> None:
+        """同步保存到 config.json。"""
+        atomic_write(path, self.to_json())
+
+
+class ConfigStore:
+    """config.json 的异步持久化。
+
+    save_async 在调用线程（GUI 主线程）里生成快照，后台线程不会读到正在编辑的对象；
+    与上次写盘内容相同则跳过，delay 秒内的多次保存合并为一次写盘。
+    """
+
+    def __init__(self, path: str = CONFIG_PATH, delay: float = CONFIG_SAVE_DELAY):
+        self.path = path
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._pending: Optional[str] = None  # 等待写盘的最新快照
+        self._written: Optional[str] = None  # 最近一次写盘的内容
+        self._timer: Optional[threading.Timer] = None
+
+    def save_async(self, cfg: AppConfig) -> None:
+        text = cfg.to_json()
+        with self._lock:
+            latest = self._pending if self._pending is not None else self._written
+            if text == latest:
+                return
+            self._pending = text
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self) -> bool:
+        """立即写出待保存的快照（退出前调用），返回是否真的写了盘。"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            text, self._pending = self._pending, None
+            if text is None or text == self._written:
+                return False
+            atomic_write(self.path, text)
+            self._written = text
+            return True
 
 
 # ---------------------------------------------------------------------------
-# 主应用类
+# 汇总 & 后台任务
 # ---------------------------------------------------------------------------
 
-class ChatCombinerApp(tb.Window):
-    """Tk/ttkbootstrap GUI 封装。"""
-
-    # -------------------- 初始化 --------------------
-
-    def __init__(self, cfg: AppConfig):
-        super().__init__(themename="cosmo")
-        self.title("信息汇总 - WISMASS内部版")
-        self.geometry("1450x900")
-        self.resizable(False, False)
-        self.configure(bg="#f4f8fc")
-
-        self.cfg = cfg  # AppConfig 对象
-
-        # gui 状态变量
-        self.global_date_from_var = tb.StringVar(value=self.cfg.global_date_from)
-        self.global_date_to_var = tb.StringVar(value=self.cfg.global_date_to)
-
-        # 每个 chat、template 在 UI 中对应的行信息
-        self._chat_rows: list[dict] = []
-        self._template_frames: list[dict] = []
-
-        self._build_ui()
-        self._load_config_into_ui()
-        self._register_hotkey()
-
-    # -------------------- 布局 --------------------
-
-    def _build_ui(self):
-        # ---------- 顶部全局日期 ----------
-        date_fr = tb.Frame(self)
-        date_fr.pack(fill="x", padx=18, pady=(10, 0))
-
-        tb.Label(date_fr, text="全局起始日期：").pack(side="left")
-        tb.Entry(date_fr, textvariable=self.global_date_from_var, width=14).pack(
-            side="left", padx=(0, 16)
-        )
-        tb.Label(date_fr, text="全局结束日期：").pack(side="left")
-        tb.Entry(date_fr, textvariable=self.global_date_to_var, width=14).pack(
-            side="left", padx=(0, 16)
+@dataclass
+class CombineResult:
+    text: str
+    truncated: Dict[str, int] = field(default_factory=dict)  # 群聊名 -> 省略字数
+    tokens: Dict[str, int] = field(default_factory=dict)     # 群聊名 -> 估算 token 数
+    stages: Dict[str, float] = field(default_factory=dict)   # url_build / fetch / assemble -> 秒
+    timings: Dict[str, FetchTiming] = field(default_factory=dict)  # 群聊名 -> 抓取计量
+    errors: Dict[str, str] = field(default_factory=dict)     # 群聊名 -> 抓取失败原因
+    stale: List[str] = field(default_factory=list)           # 使用了本地缓存兜底的群聊
+    included: int = 0  # 实际拼入文本的群聊数
+
+    @property
+    def total_tokens(self) -> int:
+        return estimate_tokens(self.text)
+
+
+def _allocate_budget(sizes: Sequence[int], total: int) -> List[int]:
+    """在各群聊间分配总预算：小于平均份额的群聊全额保留，余量均分给其余群聊。"""
+    alloc = [0] * len(sizes)
+    remaining = total
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for k, i in enumerate(order):
+        share = remaining // (len(sizes) - k)
+        alloc[i] = min(sizes[i], share)
+        remaining -= alloc[i]
+    return alloc
+
+
+def fetch_chat_logs(
+    cfg: AppConfig,
+    names: Sequence[str],
+    on_done: Optional[Callable[[int, ChatLog], None]] = None,
+    cancel: Optional[threading.Event] = None,
+    deadline: float = FETCH_DEADLINE,
+) -> List[ChatLog]:
+    """按 cfg 的抓取设置获取一组群聊的记录，结果与 names 顺序一致。
+
+    deadline 为所有群聊的总时限（秒），<= 0 时不限；超时的群聊退回本地缓存。
+    """
+    filt = MessageFilter(cfg.filters)
+
+    def _fallback(name: str) -> Optional[ChatLog]:
+        return cached_talker(
+            name,
+            cfg.global_date_from,
+            cfg.global_date_to,
+            cfg.chat_char_budget,
+            filt,
         )
 
-        # ---------- 中间双栏 ----------
-        main_fr = tb.Frame(self)
-        main_fr.pack(fill="both", expand=True, padx=18, pady=14)
-        main_fr.grid_rowconfigure(0, weight=1)
-        main_fr.grid_columnconfigure(0, weight=2, minsize=650)
-        main_fr.grid_columnconfigure(1, weight=3, minsize=800)
-
-        # -- 左：群聊列表 --
-        self._build_left(main_fr)
-
-        # -- 右：模板管理 --
-        self._build_right(main_fr)
-
-        # ---------- 底部提示 ----------
-        tb.Label(
-            self,
-            text="将光标放在目标输入框，点击按钮或按 Ctrl+M 可自动粘贴+发送",
-        ).pack(pady=(4, 2))
-        tb.Label(self, text="—— WISMASS内部版 ——").pack(pady=(0, 8))
-
-    def _build_left(self, parent):
-        lf = tb.Labelframe(
-            parent,
-            text="群聊设置（全局共享）",
-            bootstyle=PRIMARY,
-            padding=(16, 12),
-        )
-        lf.grid(row=0, column=0, sticky="nsew", padx=(0, 24))
-        lf.grid_rowconfigure(0, weight=1)
-        lf.grid_columnconfigure(0, weight=1)
-
-        # 滚动区
-        self.chat_canvas = tb.Canvas(lf, width=600, height=470, highlightthickness=0)
-        sb = tb.Scrollbar(lf, orient="vertical", command=self.chat_canvas.yview)
-        self.chat_canvas.grid(row=0, column=0, sticky="nsew")
-        sb.grid(row=0, column=1, sticky="ns")
-
-        self.chat_inner = tb.Frame(self.chat_canvas)
-        self.chat_inner.bind(
-            "<Configure>",
-            lambda e: self.chat_canvas.configure(scrollregion=self.chat_canvas.bbox("all")),
-        )
-        self.chat_canvas.create_window((0, 0), window=self.chat_inner, anchor="nw")
-        self.chat_canvas.configure(yscrollcommand=sb.set)
+    if cfg.batch_talkers and len(names) > 1:
+        # 合并请求按消息的 talker 拆分，固定走 JSON；计量无法按群聊拆分，各群聊共用。
+        # 与 fetch_many 相同的总时限与取消：到点后通知工作线程停止，各群聊退回本地缓存
+        stop = threading.Event()
+
+        def _batched() -> tuple[List[ChatLog], FetchTiming]:
+            with metered() as timing:
+                logs = fetch_talkers_batched(
+                    names,
+                    cfg.global_date_from,
+                    cfg.global_date_to,
+                    cfg.page_size or PAGE_SIZE,
+                    cfg.chat_char_budget,
+                    filt,
+                    cancel=stop,
+                )
+            return logs, timing
 
-        # 表头
-        for i, tx in enumerate(("群聊名称", "起始日期", "结束日期", "")):
-            tb.Label(self.chat_inner, text=tx).grid(
-                row=0, column=i, padx=3, pady=2, sticky="ew"
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chatlog-fetch")
+        try:
+            fut = pool.submit(_batched)
+            stop_at = time.monotonic() + deadline if deadline > 0 else math.inf
+            while not fut.done():
+                remaining = stop_at - time.monotonic()
+                if remaining <= 0 or (cancel is not None and cancel.is_set()):
+                    break
+                wait([fut], timeout=min(remaining, 0.2))
+            if fut.done():
+                logs, timing = fut.result()
+                for log in logs:
+                    log.timing = timing
+            else:
+                stop.set()
+                reason = "已取消" if cancel is not None and cancel.is_set() else (
+                    f"超过总时限 {deadline}s 未返回"
+                )
+                logs = [_fallback(name) or ChatLog("") for name in names]
+                for log in logs:
+                    log.error = reason
+        finally:
+            pool.shutdown(wait=False)
+        if on_done is not None:
+            for idx, log in enumerate(logs):
+                on_done(idx, log)
+        return logs
+
+    def _fetch(name: str) -> ChatLog:
+        with metered() as timing:
+            log = fetch_talker(
+                name,
+                cfg.global_date_from,
+                cfg.global_date_to,
+                cfg.page_size,
+                cfg.chat_char_budget,
+                filt,
+                stop,
             )
-
-        # + 添加群聊 按钮
-        tb.Button(
-            lf,
-            text="＋ 添加群聊",
-            command=self._add_chat_row,
-            bootstyle="primary-outline",
-            width=22,
-        ).grid(row=1, column=0, pady=(12, 0), sticky="we", padx=8)
-
-    def _build_right(self, parent):
-        rf = tb.Labelframe(parent, text="模板管理", padding=(16, 12))
-        rf.grid(row=0, column=1, sticky="nsew")
-        rf.grid_rowconfigure(1, weight=1)
-        rf.grid_columnconfigure(0, weight=1)
-
-        # 模板选择 & 新建
-        top = tb.Frame(rf)
-        top.grid(row=0, column=0, sticky="ew", pady=(0, 10))
-        tb.Label(top, text="模板选择：").pack(side="left")
-        self.template_select = tb.Combobox(top, state="readonly", width=28)
-        self.template_select.pack(side="left", padx=6)
-        self.template_select.bind("<<ComboboxSelected>>", self._on_select_template)
-        tb.Button(top, text="新建模板", command=self._add_template).pack(
-            side="left", padx=14
+        log.timing = timing
+        return log
+
+    # 各群聊并发抓取，总耗时约等于最慢的那个群聊；超时的群聊退回本地缓存。
+    # fetch_many 返回后不再等待的群聊线程仍在跑，置位 stop 让它们排队中的分片不再请求
+    stop = threading.Event()
+    try:
+        return fetch_many(
+            _fetch,
+            names,
+            deadline=deadline,
+            on_done=on_done,
+            cancel=cancel,
+            fallback=_fallback,
         )
-
-        # 模板滚动区
-        self.tpl_canvas = tb.Canvas(rf, height=500, highlightthickness=0)
-        sb = tb.Scrollbar(rf, orient="vertical", command=self.tpl_canvas.yview)
-        self.tpl_canvas.grid(row=1, column=0, sticky="nsew")
-        sb.grid(row=1, column=1, sticky="ns")
-
-        self.tpl_inner = tb.Frame(self.tpl_canvas)
-        self.tpl_canvas.create_window((0, 0), window=self.tpl_inner, anchor="nw", width=820)
-        self.tpl_inner.bind(
-            "<Configure>",
-            lambda e: self.tpl_canvas.configure(scrollregion=self.tpl_canvas.bbox("all")),
+    finally:
+        stop.set()
+
+
+def search_chat_logs(
+    cfg: AppConfig, tpl: Template, talkers: Sequence[str], logs: Sequence[ChatLog]
+) -> List[ChatLog]:
+    """模板设置了检索词时，把各群聊的完整记录换成命中的消息窗口（窗口数为所有群聊合计）。
+
+    抓取时已写入缓存，这里从缓存增量更新索引；失败信息与抓取计量原样保留。
+    时间范围超出按天缓存的上限时没有可检索的消息，返回原记录。
+    """
+    days = day_range(cfg.global_date_from, cfg.global_date_to)
+    if days is None:
+        return list(logs)
+    keys = [d.isoformat() for d in days]
+    search_index.sync(talkers, keys)
+    windows = search_index.search(
+        tpl.query, talkers, keys, tpl.top_k or SEARCH_TOP_K, tpl.context
+    )
+    texts = search_index.excerpt(windows, MessageFilter(cfg.filters))
+    return [
+        ChatLog(
+            (texts.get(talker) or "[无相关消息]") if log.text else "",
+            timing=log.timing,
+            error=log.error,
+            stale=log.stale,
         )
-        self.tpl_canvas.configure(yscrollcommand=sb.set)
+        for talker, log in zip(talkers, logs)
+    ]
+
+
+def render_combined(
+    tpl: Template,
+    names: Sequence[str],
+    logs: Sequence[ChatLog],
+    date_from: str = "",
+    date_to: str = "",
+    mark_missing: bool = False,
+) -> CombineResult:
+    """按模板布局把标题、正文与各群聊记录渲染为最终文本。
+
+    超出模板字数预算时，各群聊按 _allocate_budget 分到的额度保留最新消息。
+    抓取失败且没有缓存可用的群聊默认不拼入文本，只记录在 errors 中；
+    mark_missing 为 True 时（如写入文件的批量渲染）保留该群聊，正文为一行失败说明。
+    """
+    errors = {name: log.error for name, log in zip(names, logs) if log.error}
+    stale = [name for name, log in zip(names, logs) if log.stale]
+    missing = {name for name, log in zip(names, logs) if not log.text and log.error}
+    if mark_missing:
+        logs = [
+            ChatLog(f"[未获取到记录：{log.error}]") if name in missing else log
+            for name, log in zip(names, logs)
+        ]
+    kept = [(name, log) for name, log in zip(names, logs) if log.text]
+    names = [name for name, _ in kept]
+    logs = [log for _, log in kept]
+
+    texts = [log.text for log in logs]
+    truncated = {name: log.dropped for name, log in zip(names, logs) if log.dropped}
+    if tpl.char_budget and sum(map(len, texts)) > tpl.char_budget:
+        limits = _allocate_budget([len(t) for t in texts], tpl.char_budget)
+        for i, limit in enumerate(limits):
+            texts[i], dropped = truncate_oldest(texts[i], limit)
+            if dropped:
+                truncated[names[i]] = truncated.get(names[i], 0) + dropped
+
+    tokens = {name: estimate_tokens(text) for name, text in zip(names, texts)}
+
+    chats = [
+        {
+            "chat_name": name,
+            "text": text,
+            "message_count": count_messages(text),
+            "tokens": tokens[name],
+            "truncated": truncated.get(name, 0),
+            "stale": name in stale,
+            "partial": name in errors and name not in stale and name not in missing,
+        }
+        for name, text in zip(names, texts)
+    ]
+    layout, content = tpl.compiled()
+    context = {
+        "template_name": tpl.name.strip(),
+        "content": content,
+        "date_from": date_from,
+        "date_to": date_to,
+        "date_range": date_from if date_from == date_to else f"{date_from} ~ {date_to}",
+        "chat_count": len(chats),
+        "message_count": sum(c["message_count"] for c in chats),
+    }
+    return CombineResult(
+        layout.render(context, chats),
+        truncated,
+        tokens,
+        errors=errors,
+        stale=stale,
+        included=len(names),
+    )
+
+
+def combine_template(
+    cfg: AppConfig,
+    tpl_idx: int,
+    on_chat_done: Optional[Callable[[str, int, int], None]] = None,
+    cancel: Optional[threading.Event] = None,
+) -> CombineResult:
+    """抓取模板启用的群聊并拼接为最终文本。
+
+    on_chat_done(群聊名, 已完成数, 总数) 在每个群聊抓取完成后回调（工作线程中）。
+    """
+    tpl = cfg.custom_templates[tpl_idx]
+    chats = tpl.enabled_chats(cfg.chats)
+    names = [chat.name for chat in chats]
+    talkers = [chat.talker for chat in chats]
+    if tpl.query and not cfg.page_size:
+        # 检索依赖分页抓取缓存下来的结构化消息
+        cfg = copy.copy(cfg)
+        cfg.page_size = PAGE_SIZE
+
+    finished = 0
+
+    def _on_done(idx: int, _log: ChatLog):
+        nonlocal finished
+        finished += 1
+        if on_chat_done is not None:
+            on_chat_done(names[idx], finished, len(names))
+
+    started = time.perf_counter()
+    logs = fetch_chat_logs(cfg, talkers, on_done=_on_done, cancel=cancel)
+    fetched = time.perf_counter()
+    if tpl.query:
+        logs = search_chat_logs(cfg, tpl, talkers, logs)
+    result = render_combined(tpl, names, logs, cfg.global_date_from, cfg.global_date_to)
+
+    result.timings = {
+        name: log.timing for name, log in zip(names, logs) if log.timing is not None
+    }
+    result.stages = {
+        "url_build": sum(
+            t.url_seconds for t in distinct_timings(result.timings.values())
+        ),
+        "fetch": fetched - started,
+        "assemble": time.perf_counter() - fetched,
+    }
+    return result
 
-        # 鼠标滚轮同步
-        self.tpl_canvas.bind_all(
-            "<MouseWheel>", lambda e: self.tpl_canvas.yview_scroll(int(-e.delta / 120), "units")
-        )
 
-        # 底部按钮
-        btn_row = tb.Frame(rf)
-        btn_row.grid(row=2, column=0, sticky="ew", pady=(16, 0), padx=4)
-        tb.Button(btn_row, text="💾 保存配置", width=14, command=self._save_config).pack(
-            side="left", padx=16
-        )
-        tb.Button(
-            btn_row,
-            text="🚀 立即粘贴并发送 (Ctrl+M)",
-            width=26,
-            command=self._combine_and_paste,
-        ).pack(side="left", padx=24)
-
-    # -------------------- Chat 行 --------------------
-
-    def _add_chat_row(self, chat: Chat | None = None):
-        """在左侧列表新增一行群聊。"""
-        if chat is None:
-            chat = Chat("")
-            self.cfg.chats.append(chat)  # 仅新增才写入 cfg
-
-        idx = len(self._chat_rows)
-        name_var = tb.StringVar(value=chat.name)
-
-        row_fr = tb.Frame(self.chat_inner)
-        row_fr.grid(row=idx + 1, column=0, columnspan=4, sticky="ew", pady=1)
-        row_fr.grid_columnconfigure(0, weight=1)
-
-        tb.Entry(row_fr, width=22, textvariable=name_var).grid(
-            row=0, column=0, padx=(2, 6), pady=2, sticky="ew"
-        )
-        tb.Label(row_fr, textvariable=self.global_date_from_var, width=12).grid(
-            row=0, column=1, padx=2, pady=2
-        )
-        tb.Label(row_fr, textvariable=self.global_date_to_var, width=12).grid(
-            row=0, column=2, padx=2, pady=2
-        )
-        tb.Button(
-            row_fr,
-            text="✖",
-            width=3,
-            command=lambda i=idx: self._del_chat_row(i),
-        ).grid(row=0, column=3, padx=(6, 2), pady=2)
-
-        # 名称变动 → 刷新所有模板复选框
-        name_var.trace_add("write", lambda *_: self._refresh_template_checks())
-
-        self._chat_rows.append(
-            {"frame": row_fr, "name_var": name_var}
+# ---------------------------------------------------------------------------
+# 批量运行
+# ---------------------------------------------------------------------------
+
+_RANGE_LAST_RE = re.compile(r"^last-(\d+)d$")
+
+
+def resolve_range(spec: str, today: Optional[date] = None) -> tuple[str, str]:
+    """把 today / yesterday / last-Nd / 起~止 解析为具体的 YYYY-MM-DD 起止日期。
+
+    批量任务在运行时刻换算成绝对日期，便于命中按天缓存。
+    """
+    today = today or date.today()
+    spec = spec.strip()
+    if spec == "today":
+        return today.isoformat(), today.isoformat()
+    if spec == "yesterday":
+        d = (today - timedelta(days=1)).isoformat()
+        return d, d
+    m = _RANGE_LAST_RE.match(spec)
+    if m:
+        # 与后端 last-Nd 一致：从 N 天前到今天
+        return (today - timedelta(days=int(m.group(1)))).isoformat(), today.isoformat()
+    if "~" in spec:
+        date_from, date_to = spec.split("~", 1)
+        return date_from.strip(), date_to.strip()
+    raise ValueError(f"无法识别的时间范围：{spec}")
+
+
+def _safe_filename(name: str) -> str:
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", name).strip("_") or "template"
+
+
+def run_batch(
+    cfg: AppConfig,
+    tpl_indices: Sequence[int],
+    date_from: str,
+    date_to: str,
+    out_dir: str,
+    deadline: float = BATCH_FETCH_DEADLINE,
+) -> Dict[str, Any]:
+    """一次渲染多个模板：先求所有模板启用群聊的并集，每个群聊只抓取一次，再分别渲染。
+
+    输出写到 out_dir/<运行时间>/<模板名>.txt，并在 out_dir/stats.jsonl 追加本次统计。
+    无人值守运行不套用界面的 FETCH_DEADLINE，抓取总时限由 deadline 指定（<= 0 不限）；
+    没有拿到记录的群聊在输出文件里保留一行失败说明，不会被悄悄略去。
+    """
+    started_at = datetime.now()
+    started = time.perf_counter()
+    cfg = copy.copy(cfg)
+    cfg.global_date_from, cfg.global_date_to = date_from, date_to
+
+    per_template = []
+    union: Dict[str, None] = {}  # talker，保持首次出现的顺序
+    for idx in tpl_indices:
+        tpl = cfg.custom_templates[idx]
+        chats = tpl.enabled_chats(cfg.chats)
+        per_template.append((tpl, chats))
+        union.update(dict.fromkeys(chat.talker for chat in chats))
+        if tpl.query and not cfg.page_size:
+            cfg.page_size = PAGE_SIZE  # 检索依赖分页抓取缓存下来的结构化消息
+
+    fetch_started = time.perf_counter()
+    talkers = list(union)
+    logs = dict(zip(talkers, fetch_chat_logs(cfg, talkers, deadline=deadline)))
+    fetch_seconds = time.perf_counter() - fetch_started
+
+    run_dir = os.path.join(out_dir, started_at.strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(run_dir, exist_ok=True)
+
+    templates = []
+    for tpl, chats in per_template:
+        t0 = time.perf_counter()
+        tpl_talkers = [c.talker for c in chats]
+        tpl_logs = [logs[t] for t in tpl_talkers]
+        if tpl.query:
+            tpl_logs = search_chat_logs(cfg, tpl, tpl_talkers, tpl_logs)
+        result = render_combined(
+            tpl, [c.name for c in chats], tpl_logs, date_from, date_to, mark_missing=True
         )
-        self._sync_template_enabled_lengths()
-        self._refresh_template_checks()
-
-    def _del_chat_row(self, idx: int):
-        if idx >= len(self._chat_rows) or len(self._chat_rows) <= 1:
-            return  # 至少留一行
-
-        # 移除 UI
-        self._chat_rows[idx]["frame"].destroy()
-        # 移除数据
-        self._chat_rows.pop(idx)
-        self.cfg.chats.pop(idx)
-
-        # 重新布局剩余行
-        for i, row in enumerate(self._chat_rows):
-            row["frame"].grid(row=i + 1, column=0, columnspan=4, sticky="ew", pady=1)
-
-        self._sync_template_enabled_lengths()
-        self._refresh_template_checks()
-
-    # -------------------- Template --------------------
-
-    def _add_template(self, tpl: Template | None = None):
-        """右侧新增一个模板编辑框。"""
-        if tpl is None:
-            tpl = Template("新模板", "", [False] * len(self._chat_rows))
-            self.cfg.custom_templates.append(tpl)
-
-        idx = len(self._template_frames)
-
-        fr = tb.Labelframe(self.tpl_inner, text="模板编辑", padding=(16, 12))
-        fr.pack(fill="x", padx=12, pady=(8, 16))
-
-        # 标题
-        name_var = tb.StringVar(value=tpl.name)
-        tb.Label(fr, text="模板标题：").pack(anchor="w")
-        tb.Entry(fr, width=50, textvariable=name_var).pack(anchor="w", fill="x", pady=(0, 6))
-
-        # 正文
-        tb.Label(fr, text="正文内容 / 提示词：").pack(anchor="w")
-        text_box = tb.Text(fr, width=85, height=7)
-        text_box.insert(tb.END, tpl.content)
-        text_box.pack(anchor="w", fill="x", expand=True, pady=(0, 8))
-
-        # 群聊复选框
-        checks_fr = tb.Frame(fr)
-        checks_fr.pack(anchor="w", pady=(2, 6))
-        enabled_vars: list[tb.BooleanVar] = []
-        for i, chat_row in enumerate(self._chat_rows):
-            v = tb.BooleanVar(value=tpl.enabled_chats[i])
-            enabled_vars.append(v)
-            tb.Checkbutton(
-                checks_fr,
-                text=chat_row["name_var"].get() or f"群聊{i + 1}",
-                variable=v,
-            ).grid(row=i, column=0, sticky="w")
-
-        # 删除模板
-        tb.Button(
-            fr,
-            text="🗑 删除该模板",
-            command=lambda i=idx: self._del_template(i),
-        ).pack(anchor="e", pady=(8, 0))
-
-        # 绑定变量到 cfg
-        def _on_title_change(*_):
-            tpl.name = name_var.get()
-            self._refresh_template_select()
-
-        name_var.trace_add("write", _on_title_change)
-
-        text_box.bind("<<Modified>>", lambda e, t=text_box: self._on_content_change(tpl, t))
-
-        self._template_frames.append(
+        path = os.path.join(run_dir, f"{_safe_filename(tpl.name)}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(result.text)
+        templates.append(
             {
-                "frame": fr,
-                "name_var": name_var,
-                "text_box": text_box,
-                "checks_fr": checks_fr,
-                "enabled_vars": enabled_vars,
+                "template": tpl.name,
+                "file": path,
+                "chats": len(chats),
+                "chars": len(result.text),
+                "tokens": result.total_tokens,
+                "truncated": result.truncated,
+                "missing": [c.name for c, log in zip(chats, tpl_logs) if not log.text],
+                "render_seconds": round(time.perf_counter() - t0, 4),
             }
         )
-        self._refresh_template_select()
-
-    def _del_template(self, idx: int):
-        if idx >= len(self._template_frames) or len(self._template_frames) <= 1:
-            return  # 至少留一个模板
-
-        self._template_frames[idx]["frame"].destroy()
-        self._template_frames.pop(idx)
-        self.cfg.custom_templates.pop(idx)
-
-        self._refresh_template_select()
-        self.template_select.current(0)
-        self._show_template(0)
-
-    # ---- 模板辅助 ----
-
-    def _on_content_change(self, tpl: Template, textbox: tb.Text):
-        if textbox.edit_modified():
-            tpl.content = textbox.get("1.0", tb.END).rstrip()
-            textbox.edit_modified(False)
-
-    def _refresh_template_checks(self):
-        """聊天名称变化后，刷新所有模板里的复选框标签。"""
-        for tpl_idx, tpl_fr in enumerate(self._template_frames):
-            for i, chat_row in enumerate(self._chat_rows):
-                cb: tb.Checkbutton = tpl_fr["checks_fr"].grid_slaves(row=i, column=0)[0]  # type: ignore
-                cb.configure(text=chat_row["name_var"].get() or f"群聊{i + 1}")
-
-    def _sync_template_enabled_lengths(self):
-        """增删群聊时同步 enabled_chats 长度。"""
-        n_chat = len(self._chat_rows)
-        for tpl, fr in zip(self.cfg.custom_templates, self._template_frames):
-            # 扩/裁 enabled_chats
-            if len(tpl.enabled_chats) < n_chat:
-                tpl.enabled_chats += [False] * (n_chat - len(tpl.enabled_chats))
-            elif len(tpl.enabled_chats) > n_chat:
-                tpl.enabled_chats = tpl.enabled_chats[:n_chat]
-
-            # UI 侧变量也同步
-            vars_ = fr["enabled_vars"]
-            if len(vars_) < n_chat:
-                for i in range(len(vars_), n_chat):
-                    v = tb.BooleanVar(value=tpl.enabled_chats[i])
-                    vars_.append(v)
-                    tb.Checkbutton(
-                        fr["checks_fr"],
-                        text=self._chat_rows[i]["name_var"].get() or f"群聊{i + 1}",
-                        variable=v,
-                    ).grid(row=i, column=0, sticky="w")
-            elif len(vars_) > n_chat:
-                for v in vars_[n_chat:]:
-                    # 删除多余复选框
-                    cb = v._variable._widgets[0]  # type: ignore
-                    cb.destroy()
-                del vars_[n_chat:]
-
-    def _refresh_template_select(self):
-        """刷新顶部下拉列表。"""
-        names = [tpl.name for tpl in self.cfg.custom_templates]
-        self.template_select["values"] = names
-        if not names:
-            return
-        if self.template_select.current() == -1:
-            self.template_select.current(0)
-
-    def _on_select_template(self, *_):
-        self._show_template(self.template_select.current())
-
-    def _show_template(self, idx: int):
-        for i, fr in enumerate(self._template_frames):
-            fr["frame"].pack_forget()
-            if i == idx:
-                fr["frame"].pack(fill="x", padx=12, pady=(0, 16))
-                fr["text_box"].focus_set()
-
-        self.cfg.current_template = idx
-
-    # -------------------- Config <-> UI --------------------
-
-    def _load_config_into_ui(self):
-        """把 AppConfig 数据渲染进 UI。"""
-        # 先清空任何旧行
-        for row in self._chat_rows:
-            row["frame"].destroy()
-        self._chat_rows.clear()
-
-        for tpl in self._template_frames:
-            tpl["frame"].destroy()
-        self._template_frames.clear()
-
-        # 重新加载
-        for chat in self.cfg.chats:
-            self._add_chat_row(chat)
-
-        for tpl in self.cfg.custom_templates:
-            self._add_template(tpl)
-
-        # 同步下拉
-        self._refresh_template_select()
-        self.template_select.current(self.cfg.current_template)
-        self._show_template(self.cfg.current_template)
-
-    def _save_config(self):
-        """从 UI 读取所有变量 -> cfg -> 写盘。"""
-        # 群聊
-        self.cfg.chats = [
-            Chat(row["name_var"].get()) for row in self._chat_rows
-        ]
-        # 模板
-        for tpl, fr in zip(self.cfg.custom_templates, self._template_frames):
-            tpl.name = fr["name_var"].get()
-            tpl.content = fr["text_box"].get("1.0", tb.END).rstrip()
-            tpl.enabled_chats = [v.get() for v in fr["enabled_vars"]]
 
-        self.cfg.global_date_from = self.global_date_from_var.get()
-        self.cfg.global_date_to = self.global_date_to_var.get()
+    stats = {
+        "started_at": started_at.isoformat(timespec="seconds"),
+        "date_from": date_from,
+        "date_to": date_to,
+        "templates": templates,
+        "talkers": len(talkers),
+        # 各模板单独运行时需要的抓取次数 - 实际抓取次数
+        "fetches_saved": sum(len(n) for _, n in per_template) - len(talkers),
+        "errors": {n: log.error for n, log in logs.items() if log.error},
+        "stale": [n for n, log in logs.items() if log.stale],
+        "fetch_seconds": round(fetch_seconds, 4),
+        "total_seconds": round(time.perf_counter() - started, 4),
+    }
+    with open(os.path.join(out_dir, "stats.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(stats, ensure_ascii=False) + "\n")
+    return stats
+
+
+def next_daily_run(at: str, now: Optional[datetime] = None) -> datetime:
+    """下一次 HH:MM 的时刻（今天已过则为明天）。"""
+    now = now or datetime.now()
+    hour, minute = map(int, at.split(":", 1))
+    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return target
+
+
+class CombineJob(threading.Thread):
+    """在后台线程执行一次“抓取 → 拼接 → 粘贴”。
+
+    进度通过线程安全的 events 队列回传给 UI，元素为 (事件类型, 数据 dict)：
+    progress / done / empty / cancelled / error，除 progress 外数据中带有本次的 run（RunRecord）。
+
+    delta 为 True 时只粘贴 watcher 监听到的、该模板上次发送之后的新消息（没有则为 empty）；
+    传入 watcher 时，发送成功后会更新该模板的已发送位置。
+    """
+
+    def __init__(
+        self,
+        cfg: AppConfig,
+        events: "queue.Queue[tuple[str, dict]]",
+        watcher: Optional["ChatWatcher"] = None,
+        delta: bool = False,
+    ):
+        super().__init__(name="chatlog-combine", daemon=True)
+        self.cfg = cfg  # 调用方传入快照，任务内不会再读取 UI
+        self.events = events
+        self.watcher = watcher
+        self.delta = delta and watcher is not None
+        self._cancel = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def _emit(self, kind: str, **data) -> None:
+        self.events.put((kind, data))
+
+    def _finish(self, record: RunRecord, kind: str, **data) -> None:
+        """记录本次运行的耗时后再发出结束事件，界面收到事件时统计已可读取。"""
+        record.outcome = kind
+        record.stages["total"] = time.perf_counter() - self._started
+        run_stats.add(record)
+        self._emit(kind, run=record, **data)
+
+    def run(self) -> None:
+        self._started = time.perf_counter()
+        tpl = self.cfg.custom_templates[self.cfg.current_template]
+        record = RunRecord(datetime.now().isoformat(timespec="seconds"), tpl.name)
+        try:
+            def _on_chat_done(name: str, finished: int, total: int):
+                self._emit("progress", chat=name, finished=finished, total=total)
 
-        self.cfg.save()
-        tb.Messagebox.show_info("配置已保存到 config.json！", "保存成功")
+            marks: Dict[str, int] = {}
+            if self.delta:
+                result, marks = combine_delta(
+                    self.cfg, self.cfg.current_template, self.watcher
+                )
+                if not result.included:
+                    self._finish(record, "empty")
+                    return
+            else:
+                if self.watcher is not None:
+                    # 完整汇总同样算一次发送，抓取开始前已监听到的消息都包含在内
+                    marks = self.watcher.positions(
+                        c.talker for c in tpl.enabled_chats(self.cfg.chats)
+                    )
+                result = combine_template(
+                    self.cfg,
+                    self.cfg.current_template,
+                    on_chat_done=_on_chat_done,
+                    cancel=self._cancel,
+                )
+            record.stages.update(result.stages)
+            record.chats = result.timings
+            record.chars = len(result.text)
+            # 粘贴前最后一次检查，取消后不再操作键盘
+            if self.cancelled:
+                self._finish(record, "cancelled")
+                return
+            if result.errors and not result.included:
+                # 所有群聊都失败且没有缓存，粘贴只剩模板正文没有意义
+                self._finish(
+                    record,
+                    "error",
+                    message="全部群聊获取失败：" + "；".join(
+                        f"{name}：{err}" for name, err in result.errors.items()
+                    ),
+                )
+                return
+
+            total_tokens = result.total_tokens
+            if tpl.split_paste:
+                chunks = split_for_paste(result.text, tpl.token_budget)
+            else:
+                chunks = [result.text]
+
+            sent = paste_chunks(chunks, self._cancel, record.stages)
+            if sent < len(chunks):
+                self._finish(record, "cancelled")
+                return
+            if self.watcher is not None:
+                self.watcher.mark_sent(tpl.name, marks)
+            self._finish(
+                record,
+                "done",
+                chars=len(result.text),
+                truncated=result.truncated,
+                tokens=result.tokens,
+                total_tokens=total_tokens,
+                over_budget=bool(tpl.token_budget and total_tokens > tpl.token_budget),
+                chunks=len(chunks),
+                errors=result.errors,
+                stale=result.stale,
+            )
+        except Exception as e:
+            self._finish(record, "error", message=str(e))
 
-    # -------------------- 粘贴逻辑 --------------------
 
-    def _build_url(self, chat_name: str) -> str:
-        return (
-            f"{API_URL}?time={self.global_date_from_var.get()}~"
-            f"{self.global_date_to_var.get()}&talker={quote(chat_name)}"
-        )
+# ---------------------------------------------------------------------------
+# 实时监听
+# ---------------------------------------------------------------------------
 
-    def _fetch_chatlog(self, url: str) -> str:
-        try:
-            r = session.get(url, timeout=8)
-            r.raise_for_status()
-            return r.text.strip() or "[空]"
-        except Exception as e:
-            return f"[ERROR] {e}"
-
-    def _combine_and_paste(self):
-        # 确保 cfg 最新
-        self._save_config()
-
-        tpl_idx = self.cfg.current_template
-        tpl = self.cfg.custom_templates[tpl_idx]
-
-        result_parts = [tpl.name.strip(), "", tpl.content.strip()]
-        for enabled, chat in zip(tpl.enabled_chats, self.cfg.chats):
-            if enabled:
-                url = self._build_url(chat.name)
-                content = self._fetch_chatlog(url)
-                result_parts.extend(
-                    [
-                        "",
-                        "========",
-                        f"【群聊：{chat.name}】",
-                        "========",
-                        content,
-                    ]
+@dataclass
+class WatchCursor:
+    """单个群聊的监听状态：已见到的最后一条消息，及自适应的轮询间隔。"""
+
+    talker: str
+    since: int      # 下次从该 Unix 秒开始拉取（含），同一秒的消息靠 last_seq 去重
+    last_seq: int = 0
+    interval: float = WATCH_INTERVAL
+    next_poll: float = 0.0  # time.monotonic()
+    buffer: deque = field(default_factory=lambda: deque(maxlen=WATCH_BUFFER))
+
+
+class ChatWatcher(threading.Thread):
+    """后台轮询被监听群聊的新消息并留在内存中，供增量汇总使用。
+
+    每个群聊按游标请求 time=<上次最后一条消息的秒>~now，逐个串行请求，不给后端并发压力；
+    有新消息的群聊缩短轮询间隔，安静的群聊逐步拉长（WATCH_MIN_INTERVAL ~ WATCH_MAX_INTERVAL）。
+    “已发送”位置按模板记录：delta 汇总只取该模板上次发送之后到达的消息。
+    """
+
+    def __init__(self, interval: float = WATCH_INTERVAL, page_size: int = PAGE_SIZE):
+        super().__init__(name="chatlog-watch", daemon=True)
+        self.interval = interval
+        self.page_size = page_size or PAGE_SIZE
+        self._cursors: Dict[str, WatchCursor] = {}
+        self._sent: Dict[str, Dict[str, int]] = {}  # 模板名 -> talker -> 已发送的最大 seq
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def set_talkers(self, talkers: Iterable[str]) -> None:
+        """更新监听的群聊；新加入的群聊从当前时刻开始监听。"""
+        talkers = set(talkers)
+        now = int(time.time())
+        with self._lock:
+            for talker in list(self._cursors):
+                if talker not in talkers:
+                    del self._cursors[talker]
+            for talker in talkers - self._cursors.keys():
+                self._cursors[talker] = WatchCursor(talker, now, interval=self.interval)
+        self._wake.set()
+
+    def run(self) -> None:
+        while not self._stop.is_set():
+            with self._lock:
+                now = time.monotonic()
+                due = [c for c in self._cursors.values() if c.next_poll <= now]
+                wait_for = min(
+                    (c.next_poll - now for c in self._cursors.values()), default=1.0
                 )
+            for cursor in due:
+                if self._stop.is_set():
+                    return
+                self._poll(cursor)
+            if not due:
+                self._wake.wait(max(0.05, min(wait_for, 1.0)))
+                self._wake.clear()
 
-        final_text = "\n".join(part for part in result_parts if part != "" or part == "")
-        pyperclip.copy(final_text)
-        time.sleep(0.15)
-        keyboard.press_and_release("ctrl+v")
-        time.sleep(0.05)
-        keyboard.press_and_release("enter")
+    def _poll(self, cursor: WatchCursor) -> None:
+        fresh: List[Dict[str, Any]] = []
 
-    # -------------------- 全局热键 --------------------
+        def _on_page(page: List[Dict[str, Any]], _restart: bool) -> None:
+            fresh.extend(m for m in page if m.get("seq", 0) > cursor.last_seq)
 
-    def _register_hotkey(self):
-        def _worker():
-            keyboard.add_hotkey("ctrl+m", lambda: self.after(0, self._combine_and_paste))
-            keyboard.wait()
+        try:
+            fetch_pages(
+                cursor.talker, str(cursor.since), "now", self.page_size, on_page=_on_page
+            )
+        except Exception:
+            # 后端不可用时按安静群聊处理，间隔逐步拉长，熔断器会拦下多余的请求
+            fresh = []
+        with self._lock:
+            if fresh:
+                cursor.buffer.extend(fresh)
+                cursor.last_seq = fresh[-1].get("seq", cursor.last_seq)
+                cursor.since = int(_parse_time(fresh[-1]["time"]).timestamp())
+                cursor.interval = max(WATCH_MIN_INTERVAL, cursor.interval / 2)
+            else:
+                cursor.interval = min(WATCH_MAX_INTERVAL, cursor.interval * 1.5)
+            cursor.next_poll = time.monotonic() + cursor.interval
+
+    def pending(
+        self, template: str, talkers: Sequence[str]
+    ) -> tuple[List[List[Dict[str, Any]]], Dict[str, int]]:
+        """该模板上次发送之后各群聊到达的新消息（与 talkers 顺序一致），及对应的发送位置。
+
+        发送成功后把第二个返回值交给 mark_sent；发送期间到达的消息留到下一次。
+        """
+        out, marks = [], {}
+        with self._lock:
+            sent = self._sent.get(template, {})
+            for talker in talkers:
+                cursor = self._cursors.get(talker)
+                if cursor is None:
+                    out.append([])
+                    continue
+                after = sent.get(talker, 0)
+                out.append([m for m in cursor.buffer if m.get("seq", 0) > after])
+                marks[talker] = cursor.last_seq
+        return out, marks
+
+    def positions(self, talkers: Iterable[str]) -> Dict[str, int]:
+        """各群聊当前已见到的最后一条消息的 seq，用作发送位置。"""
+        with self._lock:
+            return {
+                t: self._cursors[t].last_seq for t in talkers if t in self._cursors
+            }
 
-        threading.Thread(target=_worker, daemon=True).start()
+    def mark_sent(self, template: str, marks: Dict[str, int]) -> None:
+        with self._lock:
+            self._sent.setdefault(template, {}).update(marks)
+
+
+def combine_delta(
+    cfg: AppConfig, tpl_idx: int, watcher: ChatWatcher
+) -> tuple[CombineResult, Dict[str, int]]:
+    """只汇总监听到的、该模板上次发送之后的新消息；没有新消息的群聊不出现在结果中。
+
+    返回 (结果, 发送位置)，粘贴成功后调用 watcher.mark_sent(模板名, 发送位置)。
+    """
+    tpl = cfg.custom_templates[tpl_idx]
+    chats = tpl.enabled_chats(cfg.chats)
+    started = time.perf_counter()
+    pending, marks = watcher.pending(tpl.name, [chat.talker for chat in chats])
+    filt = MessageFilter(cfg.filters)
+    logs = []
+    for raws in pending:
+        if filt.active:
+            messages = filt.apply(raws)
+        else:
+            messages = [Message(raw) for raw in raws]
+        logs.append(ChatLog(render_messages(messages)))
+    fetched = time.perf_counter()
+    result = render_combined(
+        tpl, [chat.name for chat in chats], logs, cfg.global_date_from, cfg.global_date_to
+    )
+    result.stages = {"fetch": fetched - started, "assemble": time.perf_counter() - fetched}
+    return result, marks
 
 
 # ---------------------------------------------------------------------------
 # 入口
 # ---------------------------------------------------------------------------
 
-def main():
+def _resolve_with_index(cfg: AppConfig) -> None:
+    """索引过期时尽力刷新，再把能解析的群聊名换成后端 ID；后端不可用不影响后续按名称抓取。"""
+    try:
+        chat_index.refresh()
+    except Exception as e:
+        print(f"群聊索引刷新失败，沿用本地索引：{e}", file=sys.stderr)
+    cfg.resolve_chat_ids(chat_index)
+
+
+def _cmd_render(args: argparse.Namespace) -> int:
+    """渲染一个或多个模板并输出到 stdout / 文件，不需要 Tk、键盘与剪贴板。"""
+    cfg = AppConfig.load(args.config)
+    _resolve_with_index(cfg)
+    if args.date_from:
+        cfg.global_date_from = args.date_from
+    if args.date_to:
+        cfg.global_date_to = args.date_to
+
+    indices = []
+    for name in args.template:
+        idx = cfg.find_template(name)
+        if idx == -1:
+            print(f"找不到模板：{name}", file=sys.stderr)
+            return 1
+        indices.append(idx)
+
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    outputs = []
+    for idx in indices:
+        tpl = cfg.custom_templates[idx]
+        result = combine_template(cfg, idx)
+        print(
+            f"[{tpl.name}] {len(result.text)} 字，约 {result.total_tokens} tokens"
+            + (f"，截断：{result.truncated}" if result.truncated else ""),
+            file=sys.stderr,
+        )
+        for name, err in result.errors.items():
+            print(f"  获取失败 {name}：{err}", file=sys.stderr)
+        if result.stale:
+            print(f"  使用本地缓存：{'、'.join(result.stale)}", file=sys.stderr)
+        if args.out_dir:
+            path = os.path.join(args.out_dir, f"{_safe_filename(tpl.name)}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(result.text)
+        else:
+            outputs.append(result.text)
+
+    if outputs:
+        text = "\n\n".join(outputs)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text + "\n")
+    return 0
+
+
+def _cmd_batch(args: argparse.Namespace) -> int:
+    """批量渲染多个模板；指定 --at 时常驻并每天定时运行。"""
+    cfg = AppConfig.load(args.config)
+    if args.all:
+        indices = list(range(len(cfg.custom_templates)))
+    else:
+        indices = []
+        for name in args.template or []:
+            idx = cfg.find_template(name)
+            if idx == -1:
+                print(f"找不到模板：{name}", file=sys.stderr)
+                return 1
+            indices.append(idx)
+    if not indices:
+        print("请用 -t 指定模板，或使用 --all", file=sys.stderr)
+        return 1
+
+    def _run_once():
+        _resolve_with_index(cfg)
+        date_from, date_to = resolve_range(args.range)
+        stats = run_batch(cfg, indices, date_from, date_to, args.out_dir, args.deadline)
+        print(
+            f"[{stats['started_at']}] {date_from}~{date_to}："
+            f"{len(stats['templates'])} 个模板，{stats['talkers']} 个群聊，"
+            f"少抓 {stats['fetches_saved']} 次，抓取 {stats['fetch_seconds']}s，"
+            f"总计 {stats['total_seconds']}s",
+            file=sys.stderr,
+        )
+        for name in stats["errors"]:
+            print(f"  抓取失败：{name}", file=sys.stderr)
+
+    if not args.at:
+        _run_once()
+        return 0
+
+    while True:
+        target = next_daily_run(args.at)
+        print(f"下次运行：{target:%Y-%m-%d %H:%M}", file=sys.stderr)
+        while datetime.now() < target:
+            # 分段睡眠，系统休眠/改时间后也能尽快对齐
+            time.sleep(min(60.0, (target - datetime.now()).total_seconds() + 0.5))
+        try:
+            _run_once()
+        except Exception as e:
+            print(f"批量运行失败：{e}", file=sys.stderr)
+
+
+def _cmd_list(args: argparse.Namespace) -> int:
+    cfg = AppConfig.load(args.config)
+    for tpl in cfg.custom_templates:
+        n_chats = len(tpl.enabled_chats(cfg.chats))
+        print(f"{tpl.name}\t{n_chats} 个群聊")
+    return 0
+
+
+def _cmd_index(args: argparse.Namespace) -> int:
+    """刷新 / 查询群聊与联系人索引。"""
+    if args.refresh or chat_index.stale:
+        changed = chat_index.refresh(force=True)
+        print(f"索引已刷新，{changed} 条新增或变化", file=sys.stderr)
+    for entry in chat_index.lookup(args.query, args.limit) if args.query else []:
+        print(f"{entry.name}\t{entry.id}\t{entry.kind}")
+    return 0
+
+
+def _cmd_search(args: argparse.Namespace) -> int:
+    """跨群聊检索：先抓取（补齐缓存），再输出最相关的消息窗口。"""
+    cfg = AppConfig.load(args.config)
+    _resolve_with_index(cfg)
+    if args.date_from:
+        cfg.global_date_from = args.date_from
+    if args.date_to:
+        cfg.global_date_to = args.date_to
+    if args.template:
+        idx = cfg.find_template(args.template)
+        if idx == -1:
+            print(f"找不到模板：{args.template}", file=sys.stderr)
+            return 1
+        chats = cfg.custom_templates[idx].enabled_chats(cfg.chats)
+    else:
+        chats = cfg.chats
+    cfg.page_size = cfg.page_size or PAGE_SIZE
+
+    talkers = [chat.talker for chat in chats]
+    logs = fetch_chat_logs(cfg, talkers)
+    tpl = Template("", "", query=args.query, top_k=args.top_k, context=args.context)
+    started = time.perf_counter()
+    found = search_chat_logs(cfg, tpl, talkers, logs)
+    print(
+        f"检索 {search_index.size} 条消息，用时 {(time.perf_counter() - started) * 1000:.1f} ms",
+        file=sys.stderr,
+    )
+    for chat, log in zip(chats, found):
+        if log.error:
+            print(f"获取失败 {chat.name}：{log.error}", file=sys.stderr)
+        if log.text and log.text != "[无相关消息]":
+            sys.stdout.write(f"【群聊：{chat.name}】\n{log.text}\n\n")
+    return 0
+
+
+def _cmd_archive(args: argparse.Namespace) -> int:
+    """查看归档：不带参数列出群聊，指定群聊列出日期，再加 --day 输出该天的记录。"""
+    if not args.talker:
+        for talker in archive.talkers():
+            days = archive.days(talker)
+            print(
+                f"{talker}\t{len(days)} 天\t{sum(days.values())} 条"
+                f"\t{archive.size(talker) / 1024:.1f} KB"
+            )
+        return 0
+    if not args.day:
+        for day, count in archive.days(args.talker).items():
+            print(f"{day}\t{count} 条")
+        return 0
+    raws = archive.get(args.talker, args.day)
+    if raws is None:
+        print(f"未归档：{args.talker} {args.day}", file=sys.stderr)
+        return 1
+    sys.stdout.write(render_messages([Message(raw) for raw in raws], "%H:%M:%S") + "\n")
+    return 0
+
+
+def _run_gui() -> int:
+    from chat_gui import ChatCombinerApp
+
     app = ChatCombinerApp(AppConfig.load())
     app.mainloop()
+    return 0
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="群聊记录汇总；不带子命令时启动图形界面。"
+    )
+    sub = parser.add_subparsers(dest="command")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", default=CONFIG_PATH, help="配置文件路径")
+
+    p_render = sub.add_parser("render", parents=[common], help="无界面渲染模板")
+    p_render.add_argument(
+        "-t", "--template", action="append", required=True, help="模板名称，可重复"
+    )
+    p_render.add_argument("--from", dest="date_from", help="起始日期，默认取配置")
+    p_render.add_argument("--to", dest="date_to", help="结束日期，默认取配置")
+    out = p_render.add_mutually_exclusive_group()
+    out.add_argument("-o", "--output", help="输出文件，默认 stdout")
+    out.add_argument("--out-dir", help="每个模板输出为该目录下的 <模板名>.txt")
+    p_render.set_defaults(func=_cmd_render)
+
+    p_batch = sub.add_parser(
+        "batch", parents=[common], help="批量渲染多个模板，共享抓取结果，可每日定时"
+    )
+    p_batch.add_argument("-t", "--template", action="append", help="模板名称，可重复")
+    p_batch.add_argument("--all", action="store_true", help="渲染全部模板")
+    p_batch.add_argument(
+        "--range",
+        default="yesterday",
+        help="时间范围：today / yesterday / last-Nd / 起~止，默认 yesterday",
+    )
+    p_batch.add_argument("--at", help="每天定时运行的时刻 HH:MM；不指定则只运行一次")
+    p_batch.add_argument("--out-dir", default="outputs", help="输出目录，默认 outputs")
+    p_batch.add_argument(
+        "--deadline",
+        type=float,
+        default=BATCH_FETCH_DEADLINE,
+        help="抓取所有群聊的总时限，秒；默认 0 = 不限",
+    )
+    p_batch.set_defaults(func=_cmd_batch)
+
+    p_list = sub.add_parser("list", parents=[common], help="列出模板")
+    p_list.set_defaults(func=_cmd_list)
+
+    p_index = sub.add_parser("index", help="刷新或查询群聊/联系人索引")
+    p_index.add_argument("query", nargs="?", help="按名称前缀 / 模糊查找")
+    p_index.add_argument("--refresh", action="store_true", help="忽略有效期强制刷新")
+    p_index.add_argument("--limit", type=int, default=10, help="最多显示条数")
+    p_index.set_defaults(func=_cmd_index)
+
+    p_search = sub.add_parser("search", parents=[common], help="跨群聊检索相关消息")
+    p_search.add_argument("query", help="检索词，空格分隔")
+    p_search.add_argument("-t", "--template", help="只检索该模板启用的群聊，默认全部群聊")
+    p_search.add_argument("--from", dest="date_from", help="起始日期，默认取配置")
+    p_search.add_argument("--to", dest="date_to", help="结束日期，默认取配置")
+    p_search.add_argument("--top-k", type=int, default=SEARCH_TOP_K, help="保留的窗口数")
+    p_search.add_argument(
+        "--context", type=int, default=SEARCH_CONTEXT, help="命中消息前后各带几条"
+    )
+    p_search.set_defaults(func=_cmd_search)
+
+    p_archive = sub.add_parser("archive", help="查看本地归档")
+    p_archive.add_argument("talker", nargs="?", help="群聊 ID 或名称（与抓取时一致）")
+    p_archive.add_argument("--day", help="输出该天（YYYY-MM-DD）的记录")
+    p_archive.set_defaults(func=_cmd_archive)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        return _run_gui()
+    return args.func(args)
 
 
 if __name__ == "__main__":
-    main()
+    # 以脚本运行时让 chat_gui 中的 `from chat import ...` 取到同一个模块，
+    # 避免缓存、会话等模块级对象被加载两份
+    sys.modules.setdefault("chat", sys.modules[__name__])
+    sys.exit(main())
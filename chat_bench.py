@@ -0,0 +1,380 @@
+"""
+Chat Log Combiner – 基准测试
+============================
+在子进程中启动一个模拟后端（/api/v1/chatlog，纯文本与 format=json 两种格式，
+支持 limit/offset、逗号分隔的多 talker、可调的响应延迟与逐条 flush），
+不加载 Tk、键盘与剪贴板，直接驱动 combine_template（即 Ctrl+M 的抓取 + 拼接部分），
+按 群聊数 × 历史规模 × 抓取模式 × 冷/热缓存 统计延迟分位数、内存峰值与吞吐。
+
+用法:
+    python chat_bench.py                      # 跑默认矩阵，并与基线比较
+    python chat_bench.py --quick              # 只跑小规模组合
+    python chat_bench.py --save-baseline      # 把本次结果写为基线
+    python chat_bench.py --chats 1,50 --msgs 5000 --latency 0.05
+
+与基线相比 p50 / p95 或内存峰值变差超过 --tolerance 时以退出码 1 结束。
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import parse_qs, urlsplit
+
+import chat
+
+BASELINE_PATH = "chat_bench_baseline.json"
+TOLERANCE = 0.2  # 相对基线变差超过 20% 视为回退
+MIN_DELTA = {"p50": 0.02, "p95": 0.02, "peak_mb": 0.25}  # 绝对变化小于此值视为噪声
+
+_WORDS = "今天 明天 需求 评审 上线 回滚 接口 数据 同步 问题 已解决 收到 好的 请看 附件 ok deploy fix bug".split()
+
+
+# ---------------------------------------------------------------------------
+# 模拟后端
+# ---------------------------------------------------------------------------
+
+@dataclass
+class ServerOptions:
+    msgs_per_day: int = 500     # 每个群聊每天的消息数
+    msg_chars: int = 40         # 单条消息的大致字数
+    latency: float = 0.02       # 返回响应头之前的延迟，秒
+    stream_delay: float = 0.0   # 纯文本逐条 flush 时每条之间的延迟，秒
+
+
+def _time_format(start: date, end: date) -> str:
+    """同后端 util.PerfectTimeFormat：按时间范围决定纯文本里的时间格式。"""
+    if start.year != end.year:
+        return "%Y-%m-%d %H:%M:%S"
+    if start != end:
+        return "%m-%d %H:%M:%S"
+    return "%H:%M:%S"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    opts = ServerOptions()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        q = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path in ("/api/v1/contact", "/api/v1/chatroom"):
+            self._send(200, b'{"items":[]}', "application/json")
+            return
+        if url.path != "/api/v1/chatlog":
+            self._send(404, b"not found", "text/plain")
+            return
+
+        time.sleep(self.opts.latency)
+        start, _, end = q.get("time", "").partition("~")
+        d0 = date.fromisoformat(start)
+        d1 = date.fromisoformat(end or start)
+        talker = q.get("talker", "")
+        limit, offset = int(q.get("limit", 0)), int(q.get("offset", 0))
+        messages = _query(talker, d0, d1, limit, offset)
+
+        if q.get("format", "").lower() == "json":
+            self._send(200, json.dumps(messages, ensure_ascii=False).encode(), "application/json")
+            return
+
+        # 纯文本与后端一致：先发响应头，再逐条写出并 flush（chunked）
+        fmt = _time_format(d0, d1)
+        show_chatroom = "," in talker
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for raw in messages:
+            body = (chat.Message(raw).plain_text(fmt, show_chatroom) + "\n").encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(body), body))
+            if self.opts.stream_delay:
+                self.wfile.flush()
+                time.sleep(self.opts.stream_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send(self, status: int, body: bytes, ctype: str):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@lru_cache(maxsize=4096)
+def _day_messages(talker: str, day: date) -> List[Dict[str, Any]]:
+    """某群聊某天的合成消息，按 (talker, 日期) 固定随机种子，每次请求结果一致。"""
+    opts = _Handler.opts
+    rnd = random.Random(f"{talker}/{day}")
+    base = datetime.combine(day, datetime.min.time())
+    step = 86400 / max(opts.msgs_per_day, 1)
+    out = []
+    for i in range(opts.msgs_per_day):
+        t = base + timedelta(seconds=int(i * step))
+        n = max(1, int(rnd.gauss(opts.msg_chars, opts.msg_chars / 3)) // 3)
+        sender = rnd.randrange(20)
+        out.append(
+            {
+                "seq": int(t.timestamp()) * 1000 + i % 1000,
+                "time": t.strftime("%Y-%m-%dT%H:%M:%S+08:00"),
+                "talker": f"{talker}@chatroom",
+                "talkerName": talker,
+                "isChatRoom": True,
+                "sender": f"wxid_{sender}",
+                "senderName": f"成员{sender}",
+                "isSelf": sender == 0,
+                "type": 1,
+                "subType": 0,
+                "content": " ".join(rnd.choice(_WORDS) for _ in range(n)),
+            }
+        )
+    return out
+
+
+@lru_cache(maxsize=256)
+def _messages(talker: str, d0: date, d1: date) -> List[Dict[str, Any]]:
+    """单个群聊在日期范围内的全部消息，按 seq 有序。"""
+    out: List[Dict[str, Any]] = []
+    day = d0
+    while day <= d1:
+        out += _day_messages(talker, day)
+        day += timedelta(days=1)
+    return out
+
+
+def _query(talker: str, d0: date, d1: date, limit: int, offset: int) -> List[Dict[str, Any]]:
+    """同后端 GetMessages 的分页。
+
+    逗号分隔的 talker 依次收集，凑够 offset + limit 条就只对已收集的部分排序并提前返回，
+    因此多 talker 时 limit/offset 在请求之间并不稳定。
+    """
+    out: List[Dict[str, Any]] = []
+    for name in talker.split(","):
+        out += _messages(name, d0, d1)
+        if limit > 0 and len(out) >= offset + limit:
+            break
+    if "," in talker:
+        out.sort(key=lambda m: m["seq"])
+    return out[offset:offset + limit] if limit > 0 else out
+
+
+def _serve(opts: ServerOptions, port_q: "multiprocessing.Queue[int]") -> None:
+    _Handler.opts = opts
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    port_q.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(opts: ServerOptions) -> tuple[multiprocessing.Process, int]:
+    """在独立进程中启动模拟后端，避免服务端与被测代码争抢 GIL。"""
+    port_q: "multiprocessing.Queue[int]" = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_serve, args=(opts, port_q), daemon=True)
+    proc.start()
+    return proc, port_q.get(timeout=10)
+
+
+# ---------------------------------------------------------------------------
+# 测量
+# ---------------------------------------------------------------------------
+
+@dataclass
+class Scenario:
+    chats: int
+    days: int
+    mode: str   # text = 整段纯文本（page_size=0），json = 分页 JSON，batch = 多 talker 合并请求
+    cache: str  # cold = 每次清空缓存，warm = 预热后只读缓存
+
+    @property
+    def key(self) -> str:
+        return f"{self.mode}/{self.cache}/chats={self.chats}/days={self.days}"
+
+
+def _percentile(values: Sequence[float], p: float) -> float:
+    """线性插值分位数，p 取 0~1。"""
+    s = sorted(values)
+    if not s:
+        return 0.0
+    k = (len(s) - 1) * p
+    lo = int(k)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def _make_config(sc: Scenario) -> chat.AppConfig:
+    # 过去的、已稳定的日期，热缓存场景下不会再请求后端
+    end = date.today() - timedelta(days=2)
+    chats = [chat.Chat(f"bench-{i}") for i in range(sc.chats)]
+    tpl = chat.Template("bench", "基准测试模板", {c.id for c in chats})
+    return chat.AppConfig(
+        chats=chats,
+        custom_templates=[tpl],
+        global_date_from=(end - timedelta(days=sc.days - 1)).isoformat(),
+        global_date_to=end.isoformat(),
+        page_size=0 if sc.mode == "text" else chat.PAGE_SIZE,
+        batch_talkers=sc.mode == "batch",
+    )
+
+
+def run_scenario(sc: Scenario, iterations: int, msgs_per_day: int) -> Dict[str, float]:
+    cfg = _make_config(sc)
+    if sc.cache == "warm":
+        chat.combine_template(cfg, 0)
+
+    latencies, total_bytes = [], 0
+    for _ in range(iterations):
+        if sc.cache == "cold":
+            chat.cache.clear()
+            chat.archive.clear()
+        started = time.perf_counter()
+        result = chat.combine_template(cfg, 0)
+        latencies.append(time.perf_counter() - started)
+        total_bytes += sum(
+            t.bytes for t in chat.distinct_timings(result.timings.values())
+        )
+        if result.errors:
+            raise RuntimeError(f"{sc.key}: 抓取失败 {result.errors}")
+
+    # 内存峰值单独再跑一次，避免 tracemalloc 的开销影响延迟数据
+    if sc.cache == "cold":
+        chat.cache.clear()
+        chat.archive.clear()
+    tracemalloc.start()
+    try:
+        chat.combine_template(cfg, 0)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    elapsed = sum(latencies)
+    messages = sc.chats * sc.days * msgs_per_day * iterations
+    return {
+        "p50": _percentile(latencies, 0.50),
+        "p95": _percentile(latencies, 0.95),
+        "p99": _percentile(latencies, 0.99),
+        "peak_mb": peak / 1024 / 1024,
+        "msgs_per_s": messages / elapsed if elapsed else 0.0,
+        "mb_per_s": total_bytes / 1024 / 1024 / elapsed if elapsed else 0.0,
+    }
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+) -> List[str]:
+    """返回相对基线变差超过 tolerance（且超过 MIN_DELTA）的指标说明。"""
+    regressions = []
+    for key, cur in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for metric, min_delta in MIN_DELTA.items():
+            if not base.get(metric) or cur[metric] - base[metric] < min_delta:
+                continue
+            if cur[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{key} {metric}: {base[metric]:.4f} -> {cur[metric]:.4f} "
+                    f"(+{(cur[metric] / base[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+# ---------------------------------------------------------------------------
+# 入口
+# ---------------------------------------------------------------------------
+
+def _int_list(text: str) -> List[int]:
+    return [int(x) for x in text.split(",") if x]
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="聊天记录抓取 + 拼接的基准测试")
+    parser.add_argument("--chats", type=_int_list, default=[1, 8, 32], help="群聊数，逗号分隔")
+    parser.add_argument("--days", type=_int_list, default=[1, 7], help="历史天数，逗号分隔")
+    parser.add_argument("--modes", default="text,json,batch", help="抓取模式：text,json,batch")
+    parser.add_argument("--caches", default="cold,warm", help="缓存状态：cold,warm")
+    parser.add_argument("--msgs", type=int, default=500, help="每群每天消息数")
+    parser.add_argument("--chars", type=int, default=40, help="单条消息大致字数")
+    parser.add_argument("--latency", type=float, default=0.02, help="后端响应延迟，秒")
+    parser.add_argument("--stream-delay", type=float, default=0.0, help="纯文本逐条 flush 间隔，秒")
+    parser.add_argument("-n", "--iterations", type=int, default=5, help="每个组合的测量次数")
+    parser.add_argument("--quick", action="store_true", help="只跑 1/8 个群聊、1 天")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基线文件路径")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果写为基线")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="允许的相对变差")
+    parser.add_argument("--json", dest="json_out", help="把本次结果另存为 JSON")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.chats, args.days = [1, 8], [1]
+
+    opts = ServerOptions(args.msgs, args.chars, args.latency, args.stream_delay)
+    proc, port = start_server(opts)
+    tmp = tempfile.TemporaryDirectory()
+    chat.API_URL = f"http://127.0.0.1:{port}/api/v1/chatlog"
+    chat.API_BASE = f"http://127.0.0.1:{port}/api/v1"
+    chat.cache = chat.MessageCache(os.path.join(tmp.name, "bench_cache.db"))
+    chat.archive = chat.ChatArchive(os.path.join(tmp.name, "bench_archive"))
+
+    results: Dict[str, Dict[str, float]] = {}
+    try:
+        print(
+            f"{'scenario':<40} {'p50':>8} {'p95':>8} {'p99':>8} "
+            f"{'peakMB':>8} {'msg/s':>10} {'MB/s':>7}"
+        )
+        for mode, cache_state, n_chats, days in itertools.product(
+            args.modes.split(","), args.caches.split(","), args.chats, args.days
+        ):
+            if mode == "batch" and n_chats == 1:
+                continue  # 单个群聊不会走合并请求
+            sc = Scenario(n_chats, days, mode, cache_state)
+            r = results[sc.key] = run_scenario(sc, args.iterations, args.msgs)
+            print(
+                f"{sc.key:<40} {r['p50']:>8.4f} {r['p95']:>8.4f} {r['p99']:>8.4f} "
+                f"{r['peak_mb']:>8.2f} {r['msgs_per_s']:>10.0f} {r['mb_per_s']:>7.2f}",
+                flush=True,
+            )
+    finally:
+        proc.terminate()
+        chat.cache.close()
+        tmp.cleanup()
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        chat.atomic_write(args.baseline, json.dumps(results, indent=2))
+        print(f"基线已保存到 {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"没有基线文件 {args.baseline}，可用 --save-baseline 生成")
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print(f"回退：{line}", file=sys.stderr)
+    if not regressions:
+        print(f"与基线相比无回退（容差 {args.tolerance:.0%}）")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
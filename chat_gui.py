@@ -0,0 +1,956 @@
+"""
+Chat Log Combiner – 图形界面
+============================
+ttkbootstrap 窗口与全局热键，由 chat.py 在未指定子命令时按需导入，
+命令行 / 批处理模式不会加载 Tk、keyboard 与 pyperclip。
+"""
+
+from __future__ import annotations
+
+import copy
+import queue
+import threading
+import tkinter as tk
+from tkinter import filedialog
+
+import keyboard
+import ttkbootstrap as tb
+from ttkbootstrap.constants import *
+
+from chat import (
+    AppConfig,
+    Chat,
+    ChatWatcher,
+    CombineJob,
+    ConfigStore,
+    Template,
+    archive,
+    cache,
+    chat_index,
+    distinct_timings,
+    run_stats,
+)
+
+# ---------------------------------------------------------------------------
+# 主应用类
+# ---------------------------------------------------------------------------
+
+class ChatCombinerApp(tb.Window):
+    """Tk/ttkbootstrap GUI 封装。"""
+
+    CHAT_VISIBLE_ROWS = 14  # 群聊列表一屏的行数，也是实际创建的行控件数
+
+    # -------------------- 初始化 --------------------
+
+    def __init__(self, cfg: AppConfig):
+        super().__init__(themename="cosmo")
+        self.title("信息汇总 - WISMASS内部版")
+        self.geometry("1450x900")
+        self.resizable(False, False)
+        self.configure(bg="#f4f8fc")
+
+        self.cfg = cfg  # AppConfig 对象
+        self.store = ConfigStore()  # 编辑后防抖、后台原子写盘
+
+        # gui 状态变量
+        self.global_date_from_var = tb.StringVar(value=self.cfg.global_date_from)
+        self.global_date_to_var = tb.StringVar(value=self.cfg.global_date_to)
+        for var in (self.global_date_from_var, self.global_date_to_var):
+            var.trace_add("write", lambda *_: self._mark_dirty())
+        self.watch_var = tb.BooleanVar(value=self.cfg.watch)
+
+        # 群聊虚拟列表的可复用行，及当前首行对应的 cfg.chats 下标
+        self._chat_rows: list[dict] = []
+        self._chat_top = 0
+        # 程序回填控件时置位，避免 trace / 事件回调把值再写回 cfg
+        self._binding = False
+        # 名称变动后待刷新的 Listbox 下标，及防抖用的 after id
+        self._dirty_labels: set[int] = set()
+        self._debounce_ids: dict[str, str] = {}
+        self._chat_pos: dict[str, int] = {}  # Chat.id -> cfg.chats 下标
+        self._stats_win: tb.Toplevel | None = None  # 耗时统计窗口，按需创建
+        self._stats_records: list = []
+
+        # 后台汇总任务：同一时间只允许一个在跑
+        self._job: CombineJob | None = None
+        self._job_events: "queue.Queue[tuple[str, dict]]" = queue.Queue()
+        self._busy = threading.Event()  # 供热键线程无锁判断是否有任务在跑
+        self.status_var = tb.StringVar(value="就绪")
+        self._watcher: ChatWatcher | None = None  # 监听模式开启时的后台轮询线程
+
+        self._build_ui()
+        self._load_config_into_ui()
+        self._register_hotkey()
+        self._refresh_index_async()
+        if self.cfg.watch:
+            self._start_watch()
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+        self._poll_job_events()
+
+    # -------------------- 布局 --------------------
+
+    def _build_ui(self):
+        # ---------- 顶部全局日期 ----------
+        date_fr = tb.Frame(self)
+        date_fr.pack(fill="x", padx=18, pady=(10, 0))
+
+        tb.Label(date_fr, text="全局起始日期：").pack(side="left")
+        tb.Entry(date_fr, textvariable=self.global_date_from_var, width=14).pack(
+            side="left", padx=(0, 16)
+        )
+        tb.Label(date_fr, text="全局结束日期：").pack(side="left")
+        tb.Entry(date_fr, textvariable=self.global_date_to_var, width=14).pack(
+            side="left", padx=(0, 16)
+        )
+        tb.Checkbutton(
+            date_fr,
+            text="监听新消息",
+            variable=self.watch_var,
+            bootstyle="round-toggle",
+            command=self._toggle_watch,
+        ).pack(side="left", padx=(16, 0))
+
+        # ---------- 中间双栏 ----------
+        main_fr = tb.Frame(self)
+        main_fr.pack(fill="both", expand=True, padx=18, pady=14)
+        main_fr.grid_rowconfigure(0, weight=1)
+        main_fr.grid_columnconfigure(0, weight=2, minsize=650)
+        main_fr.grid_columnconfigure(1, weight=3, minsize=800)
+
+        # -- 左：群聊列表 --
+        self._build_left(main_fr)
+
+        # -- 右：模板管理 --
+        self._build_right(main_fr)
+
+        # ---------- 任务状态 ----------
+        status_fr = tb.Frame(self)
+        status_fr.pack(fill="x", padx=18)
+        self.progress = tb.Progressbar(status_fr, length=260, mode="determinate")
+        self.progress.pack(side="left")
+        tb.Label(status_fr, textvariable=self.status_var).pack(side="left", padx=12)
+        self.cancel_btn = tb.Button(
+            status_fr,
+            text="取消",
+            width=8,
+            bootstyle="secondary-outline",
+            command=self._cancel_job,
+            state="disabled",
+        )
+        self.cancel_btn.pack(side="right")
+        tb.Button(
+            status_fr,
+            text="📊 耗时",
+            width=8,
+            bootstyle="secondary-outline",
+            command=self._show_stats,
+        ).pack(side="right", padx=8)
+
+        # ---------- 底部提示 ----------
+        tb.Label(
+            self,
+            text="将光标放在目标输入框，点击按钮或按 Ctrl+M 可自动粘贴+发送",
+        ).pack(pady=(4, 2))
+        tb.Label(self, text="—— WISMASS内部版 ——").pack(pady=(0, 8))
+
+    def _build_left(self, parent):
+        lf = tb.Labelframe(
+            parent,
+            text="群聊设置（全局共享）",
+            bootstyle=PRIMARY,
+            padding=(16, 12),
+        )
+        lf.grid(row=0, column=0, sticky="nsew", padx=(0, 24))
+        lf.grid_rowconfigure(0, weight=1)
+        lf.grid_columnconfigure(0, weight=1)
+
+        # 虚拟列表：只创建一屏的行控件，滚动时把它们重新绑定到 cfg.chats 的不同区段
+        self.chat_list = tb.Frame(lf)
+        self.chat_list.grid(row=0, column=0, sticky="nsew")
+        self.chat_list.grid_columnconfigure(0, weight=1)
+        self.chat_sb = tb.Scrollbar(lf, orient="vertical", command=self._on_chat_scroll)
+        self.chat_sb.grid(row=0, column=1, sticky="ns")
+
+        # 表头
+        head = tb.Frame(self.chat_list)
+        head.grid(row=0, column=0, sticky="ew")
+        head.grid_columnconfigure(0, weight=1)
+        for i, tx in enumerate(("群聊名称", "起始日期", "结束日期", "")):
+            tb.Label(head, text=tx, width=(22, 12, 12, 4)[i]).grid(
+                row=0, column=i, padx=3, pady=2, sticky="ew"
+            )
+
+        for slot in range(self.CHAT_VISIBLE_ROWS):
+            self._chat_rows.append(self._build_chat_slot(slot))
+        self._build_suggest_popup()
+
+        # 鼠标滚轮：只在指针位于群聊列表内时滚动
+        self.chat_list.bind_all("<MouseWheel>", self._on_mousewheel, add="+")
+
+        # + 添加群聊 按钮
+        tb.Button(
+            lf,
+            text="＋ 添加群聊",
+            command=self._add_chat_row,
+            bootstyle="primary-outline",
+            width=22,
+        ).grid(row=1, column=0, pady=(12, 0), sticky="we", padx=8)
+
+    def _build_chat_slot(self, slot: int) -> dict:
+        """创建第 slot 个可复用行；显示哪条群聊由 self._chat_top 决定。"""
+        name_var = tb.StringVar()
+
+        row_fr = tb.Frame(self.chat_list)
+        row_fr.grid(row=slot + 1, column=0, sticky="ew", pady=1)
+        row_fr.grid_columnconfigure(0, weight=1)
+
+        entry = tb.Entry(row_fr, width=22, textvariable=name_var)
+        entry.grid(row=0, column=0, padx=(2, 6), pady=2, sticky="ew")
+        entry.bind("<KeyRelease>", lambda e, s=slot: self._on_chat_key(e, s))
+        entry.bind("<FocusOut>", lambda e, s=slot: self._on_chat_focus_out(s))
+        tb.Label(row_fr, textvariable=self.global_date_from_var, width=12).grid(
+            row=0, column=1, padx=2, pady=2
+        )
+        tb.Label(row_fr, textvariable=self.global_date_to_var, width=12).grid(
+            row=0, column=2, padx=2, pady=2
+        )
+        tb.Button(
+            row_fr,
+            text="✖",
+            width=3,
+            command=lambda s=slot: self._del_chat_row(self._chat_top + s),
+        ).grid(row=0, column=3, padx=(6, 2), pady=2)
+
+        name_var.trace_add("write", lambda *_, s=slot: self._on_chat_name_change(s))
+        return {"frame": row_fr, "entry": entry, "name_var": name_var}
+
+    def _build_right(self, parent):
+        rf = tb.Labelframe(parent, text="模板管理", padding=(16, 12))
+        rf.grid(row=0, column=1, sticky="nsew")
+        rf.grid_rowconfigure(1, weight=1)
+        rf.grid_columnconfigure(0, weight=1)
+
+        # 模板选择 & 新建
+        top = tb.Frame(rf)
+        top.grid(row=0, column=0, sticky="ew", pady=(0, 10))
+        tb.Label(top, text="模板选择：").pack(side="left")
+        self.template_select = tb.Combobox(top, state="readonly", width=28)
+        self.template_select.pack(side="left", padx=6)
+        self.template_select.bind("<<ComboboxSelected>>", self._on_select_template)
+        tb.Button(top, text="新建模板", command=self._add_template).pack(
+            side="left", padx=14
+        )
+
+        # 唯一的模板编辑器：切换模板时重新绑定，而不是每个模板各建一套控件
+        fr = tb.Labelframe(rf, text="模板编辑", padding=(16, 12))
+        fr.grid(row=1, column=0, sticky="nsew", padx=12)
+
+        self.tpl_name_var = tb.StringVar()
+        tb.Label(fr, text="模板标题：").pack(anchor="w")
+        tb.Entry(fr, width=50, textvariable=self.tpl_name_var).pack(
+            anchor="w", fill="x", pady=(0, 6)
+        )
+        self.tpl_name_var.trace_add("write", self._on_title_change)
+
+        tb.Label(
+            fr,
+            text="正文内容 / 提示词（可用 {date_range}、{message_count}、{chat_count} 等占位符）：",
+        ).pack(anchor="w")
+        self.tpl_text = tb.Text(fr, width=85, height=9)
+        self.tpl_text.pack(anchor="w", fill="x", pady=(0, 8))
+        self.tpl_text.bind("<<Modified>>", self._on_content_change)
+
+        self.tpl_query_var = tb.StringVar()
+        tb.Label(fr, text="检索词（空格分隔，留空则汇总全部记录）：").pack(anchor="w")
+        tb.Entry(fr, width=50, textvariable=self.tpl_query_var).pack(
+            anchor="w", fill="x", pady=(0, 6)
+        )
+        self.tpl_query_var.trace_add("write", self._on_query_change)
+
+        # 群聊多选：单个 Listbox，群聊再多也只有一个控件
+        tb.Label(fr, text="汇总的群聊（可多选）：").pack(anchor="w")
+        lb_fr = tb.Frame(fr)
+        lb_fr.pack(anchor="w", fill="both", expand=True, pady=(2, 6))
+        self.chat_listbox = tk.Listbox(
+            lb_fr, selectmode="multiple", exportselection=False, height=10
+        )
+        lb_sb = tb.Scrollbar(lb_fr, orient="vertical", command=self.chat_listbox.yview)
+        self.chat_listbox.configure(yscrollcommand=lb_sb.set)
+        self.chat_listbox.pack(side="left", fill="both", expand=True)
+        lb_sb.pack(side="left", fill="y")
+        self.chat_listbox.bind("<<ListboxSelect>>", self._on_chat_select)
+
+        tb.Button(fr, text="🗑 删除该模板", command=self._del_template).pack(
+            anchor="e", pady=(8, 0)
+        )
+
+        # 底部按钮
+        btn_row = tb.Frame(rf)
+        btn_row.grid(row=2, column=0, sticky="ew", pady=(16, 0), padx=4)
+        tb.Button(btn_row, text="💾 保存配置", width=14, command=self._save_config).pack(
+            side="left", padx=16
+        )
+        tb.Button(
+            btn_row,
+            text="🧹 清空缓存",
+            width=12,
+            bootstyle="secondary-outline",
+            command=self._clear_cache,
+        ).pack(side="left")
+        tb.Button(
+            btn_row,
+            text="🗄 清空归档…",
+            width=12,
+            bootstyle="danger-outline",
+            command=self._clear_archive,
+        ).pack(side="left", padx=(8, 0))
+        tb.Button(
+            btn_row,
+            text="🚀 立即粘贴并发送 (Ctrl+M)",
+            width=26,
+            command=self._combine_and_paste,
+        ).pack(side="left", padx=24)
+        tb.Button(
+            btn_row,
+            text="⚡ 只发新消息",
+            width=14,
+            bootstyle="info-outline",
+            command=lambda: self._combine_and_paste(delta=True),
+        ).pack(side="left")
+
+    # -------------------- Chat 行 --------------------
+
+    def _render_chat_rows(self):
+        """把可复用行绑定到 cfg.chats[_chat_top:]，多余的行隐藏。"""
+        chats = self.cfg.chats
+        self._binding = True
+        try:
+            for slot, row in enumerate(self._chat_rows):
+                idx = self._chat_top + slot
+                if idx < len(chats):
+                    row["name_var"].set(chats[idx].name)
+                    row["frame"].grid()
+                else:
+                    row["frame"].grid_remove()
+        finally:
+            self._binding = False
+
+        total = len(chats)
+        if total:
+            self.chat_sb.set(
+                self._chat_top / total,
+                min(1.0, (self._chat_top + self.CHAT_VISIBLE_ROWS) / total),
+            )
+        else:
+            self.chat_sb.set(0.0, 1.0)
+
+    def _scroll_chats_to(self, top: int):
+        self._hide_suggestions()  # 行会换绑到别的群聊，补全列表不再对应
+        max_top = max(0, len(self.cfg.chats) - self.CHAT_VISIBLE_ROWS)
+        self._chat_top = min(max(0, top), max_top)
+        self._render_chat_rows()
+
+    def _on_chat_scroll(self, action: str, value: str, unit: str = "units"):
+        """Scrollbar 回调：moveto <比例> / scroll <n> units|pages。"""
+        if action == "moveto":
+            self._scroll_chats_to(round(float(value) * len(self.cfg.chats)))
+        else:
+            step = self.CHAT_VISIBLE_ROWS if unit == "pages" else 1
+            self._scroll_chats_to(self._chat_top + int(value) * step)
+
+    def _on_mousewheel(self, e):
+        if str(e.widget).startswith(str(self.chat_list)):
+            self._scroll_chats_to(self._chat_top - int(e.delta / 120))
+
+    def _on_chat_name_change(self, slot: int):
+        if self._binding:
+            return
+        idx = self._chat_top + slot
+        if idx < len(self.cfg.chats):
+            chat = self.cfg.chats[idx]
+            chat.name = self._chat_rows[slot]["name_var"].get()
+            # 连续输入只在停顿后刷新一次，且只改这一条标签
+            self._dirty_labels.add(idx)
+            self._debounce("labels", self._flush_chat_labels)
+            # 是否换了群聊等输入停顿或离开输入框时再判断，不在每次按键时改 ID
+            self._debounce(f"rename:{idx}", lambda: self._commit_chat_name(chat), 1000)
+            self._mark_dirty()
+
+    def _on_chat_focus_out(self, slot: int):
+        self.after(150, self._hide_suggestions_unless_focused)
+        idx = self._chat_top + slot
+        if f"rename:{idx}" in self._debounce_ids and idx < len(self.cfg.chats):
+            self._cancel_debounce(f"rename:{idx}")
+            self._commit_chat_name(self.cfg.chats[idx])
+
+    def _commit_chat_name(self, chat: Chat):
+        """名称编辑完成：新名称明确对应另一个群聊时改用它的后端 ID，否则保留原 ID。"""
+        if not any(c is chat for c in self.cfg.chats):
+            return  # 停顿期间这一行已被删除
+        if self.cfg.reresolve_chat(chat, chat_index):
+            self._reindex_chats()
+            self._mark_dirty()
+
+    def _add_chat_row(self):
+        """在群聊列表末尾新增一条，并滚动到它。"""
+        chat = Chat("")
+        self.cfg.chats.append(chat)
+        # 新群聊的 ID 不在任何模板中，模板无需改动
+        idx = len(self.cfg.chats) - 1
+        self._chat_pos[chat.id] = idx
+        self.chat_listbox.insert(tb.END, self._chat_label(idx))
+
+        self._scroll_chats_to(len(self.cfg.chats))
+        self._chat_rows[idx - self._chat_top]["entry"].focus_set()
+        self._mark_dirty()
+
+    def _del_chat_row(self, idx: int):
+        if idx >= len(self.cfg.chats) or len(self.cfg.chats) <= 1:
+            return  # 至少留一行
+
+        self._flush_chat_labels()  # 待刷新的下标在删除后会错位，先落地
+        # 模板里残留的 ID 不再对应任何群聊，保存时统一剔除
+        self.cfg.chats.pop(idx)
+        self._reindex_chats()
+        self.chat_listbox.delete(idx)
+        # 之后未命名群聊的占位标签（群聊N）随下标变化
+        self._dirty_labels.update(
+            i for i in range(idx, len(self.cfg.chats)) if not self.cfg.chats[i].name
+        )
+        self._flush_chat_labels()
+
+        self._scroll_chats_to(self._chat_top)
+        self._mark_dirty()
+
+    # -------------------- 名称自动补全 --------------------
+
+    def _build_suggest_popup(self):
+        """所有行共用一个无边框下拉列表，显示在正在输入的行下方。"""
+        self._suggest = tk.Toplevel(self)
+        self._suggest.overrideredirect(True)
+        self._suggest.withdraw()
+        self._suggest_lb = tk.Listbox(self._suggest, height=8, exportselection=False)
+        self._suggest_lb.pack(fill="both", expand=True)
+        self._suggest_lb.bind("<ButtonRelease-1>", lambda e: self._accept_suggestion())
+        self._suggest_lb.bind("<Return>", lambda e: self._accept_suggestion())
+        self._suggest_lb.bind("<Escape>", lambda e: self._hide_suggestions(refocus=True))
+        self._suggest_items: list = []
+        self._suggest_slot: int | None = None
+
+    def _on_chat_key(self, e, slot: int):
+        if e.keysym == "Escape":
+            self._hide_suggestions()
+        elif e.keysym == "Down":
+            if self._suggest_items:
+                self._suggest_lb.focus_set()
+                self._suggest_lb.selection_clear(0, tb.END)
+                self._suggest_lb.selection_set(0)
+                self._suggest_lb.activate(0)
+        elif e.keysym not in ("Up", "Return", "Tab"):
+            self._debounce("suggest", lambda: self._show_suggestions(slot))
+
+    def _show_suggestions(self, slot: int):
+        row = self._chat_rows[slot]
+        items = chat_index.lookup(row["name_var"].get(), limit=8)
+        if not items:
+            self._hide_suggestions()
+            return
+
+        self._suggest_items, self._suggest_slot = items, slot
+        lb = self._suggest_lb
+        lb.delete(0, tb.END)
+        lb.insert(tb.END, *(f"{e.name}  ·  {e.id}" for e in items))
+        lb.configure(height=len(items))
+
+        entry = row["entry"]
+        self._suggest.geometry(
+            f"{max(entry.winfo_width(), 320)}x{lb.winfo_reqheight()}"
+            f"+{entry.winfo_rootx()}+{entry.winfo_rooty() + entry.winfo_height()}"
+        )
+        self._suggest.deiconify()
+        self._suggest.lift()
+
+    def _accept_suggestion(self):
+        sel = self._suggest_lb.curselection()
+        slot = self._suggest_slot
+        if not sel or slot is None:
+            return
+        entry = self._suggest_items[sel[0]]
+        idx = self._chat_top + slot
+        self._hide_suggestions()
+        if idx >= len(self.cfg.chats):
+            return
+
+        # 选中补全项即确定了后端 ID，之后改显示名也不会影响抓取
+        self.cfg.set_chat_id(self.cfg.chats[idx], entry.id)
+        self._reindex_chats()
+        self._mark_dirty()
+        row = self._chat_rows[slot]
+        row["name_var"].set(entry.name)
+        row["entry"].focus_set()
+        row["entry"].icursor(tb.END)
+
+    def _hide_suggestions(self, refocus: bool = False):
+        self._cancel_debounce("suggest")
+        self._suggest.withdraw()
+        slot, self._suggest_slot, self._suggest_items = self._suggest_slot, None, []
+        if refocus and slot is not None:
+            self._chat_rows[slot]["entry"].focus_set()
+
+    def _hide_suggestions_unless_focused(self):
+        if self.focus_get() is not self._suggest_lb:
+            self._hide_suggestions()
+
+    def _refresh_index_async(self):
+        """后台刷新过期的群聊索引，完成后在主线程把群聊名解析为后端 ID。"""
+        def _worker():
+            try:
+                chat_index.refresh()
+            except Exception:
+                pass  # 后端未启动时沿用本地索引，抓取仍可按名称进行
+            self._job_events.put(("index", {}))
+
+        threading.Thread(target=_worker, daemon=True).start()
+
+    # -------------------- Template --------------------
+
+    def _current_tpl(self) -> Template:
+        return self.cfg.custom_templates[self.cfg.current_template]
+
+    def _add_template(self):
+        """新建模板并切换编辑器到它。"""
+        tpl = Template("新模板", "")
+        self.cfg.custom_templates.append(tpl)
+
+        idx = len(self.cfg.custom_templates) - 1
+        self._refresh_template_select()
+        self.template_select.current(idx)
+        self._show_template(idx)
+
+    def _del_template(self):
+        templates = self.cfg.custom_templates
+        if len(templates) <= 1:
+            return  # 至少留一个模板
+
+        templates.pop(self.cfg.current_template)
+        self.tpl_text.edit_modified(False)  # 编辑器里是被删模板的正文，不再写回
+        idx = self.cfg.current_template = min(
+            self.cfg.current_template, len(templates) - 1
+        )
+        self._refresh_template_select()
+        self.template_select.current(idx)
+        self._show_template(idx)
+
+    # ---- 模板辅助 ----
+
+    def _on_title_change(self, *_):
+        if self._binding:
+            return
+        self._current_tpl().name = self.tpl_name_var.get()
+        self._debounce("template_select", self._refresh_template_select)
+        self._mark_dirty()
+
+    def _on_query_change(self, *_):
+        if self._binding:
+            return
+        self._current_tpl().query = self.tpl_query_var.get().strip()
+        self._mark_dirty()
+
+    def _on_content_change(self, *_):
+        if self.tpl_text.edit_modified():
+            self._current_tpl().content = self.tpl_text.get("1.0", tb.END).rstrip()
+            self.tpl_text.edit_modified(False)
+            self._mark_dirty()
+
+    def _on_chat_select(self, *_):
+        if self._binding:
+            return
+        chats = self.cfg.chats
+        self._current_tpl().chat_ids = {
+            chats[i].id for i in self.chat_listbox.curselection()
+        }
+        self._mark_dirty()
+
+    def _apply_chat_selection(self):
+        """按当前模板的 chat_ids 设置 Listbox 选中项。"""
+        lb = self.chat_listbox
+        lb.selection_clear(0, tb.END)
+        for chat_id in self._current_tpl().chat_ids:
+            idx = self._chat_pos.get(chat_id)
+            if idx is not None:
+                lb.selection_set(idx)
+
+    def _reindex_chats(self):
+        self._chat_pos = {chat.id: i for i, chat in enumerate(self.cfg.chats)}
+
+    def _chat_label(self, idx: int) -> str:
+        return self.cfg.chats[idx].name or f"群聊{idx + 1}"
+
+    def _reload_chat_labels(self):
+        """整体重建 Listbox 中的群聊标签，仅在载入配置时使用。"""
+        self._dirty_labels.clear()
+        lb = self.chat_listbox
+        lb.delete(0, tb.END)
+        lb.insert(tb.END, *(self._chat_label(i) for i in range(len(self.cfg.chats))))
+
+    def _flush_chat_labels(self):
+        """只替换名称变动过的那几条标签，并恢复其选中状态。"""
+        self._cancel_debounce("labels")
+        lb = self.chat_listbox
+        tpl = self._current_tpl()
+        for idx in sorted(self._dirty_labels):
+            if idx >= len(self.cfg.chats):
+                continue
+            lb.delete(idx)
+            lb.insert(idx, self._chat_label(idx))
+            if self.cfg.chats[idx].id in tpl.chat_ids:
+                lb.selection_set(idx)
+        self._dirty_labels.clear()
+
+    def _debounce(self, key: str, fn, delay_ms: int = 150):
+        """delay_ms 内重复调用只执行最后一次。"""
+        self._cancel_debounce(key)
+        self._debounce_ids[key] = self.after(delay_ms, lambda: self._run_debounced(key, fn))
+
+    def _run_debounced(self, key: str, fn):
+        self._debounce_ids.pop(key, None)
+        fn()
+
+    def _cancel_debounce(self, key: str):
+        after_id = self._debounce_ids.pop(key, None)
+        if after_id is not None:
+            self.after_cancel(after_id)
+
+    def _refresh_template_select(self):
+        """刷新顶部下拉列表。"""
+        names = [tpl.name for tpl in self.cfg.custom_templates]
+        self.template_select["values"] = names
+        if not names:
+            return
+        if self.template_select.current() == -1:
+            self.template_select.current(0)
+        else:
+            # 改名后下拉框显示的文字不会自动更新
+            self.template_select.current(self.cfg.current_template)
+
+    def _on_select_template(self, *_):
+        self._show_template(self.template_select.current())
+
+    def _show_template(self, idx: int):
+        """把唯一的编辑器重新绑定到第 idx 个模板。"""
+        self._on_content_change()  # 先把未落盘的正文写回旧模板
+        self.cfg.current_template = idx
+        tpl = self._current_tpl()
+
+        self._binding = True
+        try:
+            self.tpl_name_var.set(tpl.name)
+            self.tpl_text.delete("1.0", tb.END)
+            self.tpl_text.insert(tb.END, tpl.content)
+            self.tpl_text.edit_modified(False)
+            self.tpl_query_var.set(tpl.query)
+            self._apply_chat_selection()
+        finally:
+            self._binding = False
+        self.tpl_text.focus_set()
+        self._mark_dirty()  # current_template 也会写进配置
+
+    # -------------------- Config <-> UI --------------------
+
+    def _load_config_into_ui(self):
+        """把 AppConfig 数据渲染进 UI。"""
+        self._reindex_chats()
+        self._scroll_chats_to(0)
+        self._reload_chat_labels()
+
+        # 同步下拉
+        self._refresh_template_select()
+        self.template_select.current(self.cfg.current_template)
+        self._show_template(self.cfg.current_template)
+
+    def _collect_ui_into_cfg(self):
+        """从 UI 读取所有变量 -> cfg（只能在主线程调用）。
+
+        群聊名称、模板标题与群聊选择在编辑时已实时写回 cfg，
+        这里只需补上正文和全局日期。
+        """
+        self._on_content_change()
+        self.cfg.global_date_from = self.global_date_from_var.get()
+        self.cfg.global_date_to = self.global_date_to_var.get()
+
+    def _mark_dirty(self):
+        """配置有改动：停顿一段时间后再序列化并交给后台写盘。"""
+        if not self._binding:
+            self._debounce("save", self._persist, 500)
+
+    def _persist(self):
+        self._cancel_debounce("save")
+        self._collect_ui_into_cfg()
+        self.store.save_async(self.cfg)
+        if self._watcher is not None:
+            self._watcher.set_talkers(self.cfg.watched_talkers())
+
+    def _save_config(self):
+        """从 UI 读取所有变量 -> cfg -> 立即写盘。"""
+        self._persist()
+        self.store.flush()
+        tb.Messagebox.show_info("配置已保存到 config.json！", "保存成功")
+
+    def _clear_cache(self):
+        # 只清缓存：已稳定的日期会从长期归档回填，归档需单独清除
+        freed = cache.clear()
+        tb.Messagebox.show_info(
+            f"本地聊天记录缓存已清空（释放 {freed / 1024:.1f} KB）。", "清空缓存"
+        )
+
+    def _clear_archive(self):
+        """删除长期归档（供审计留存的历史记录），需二次确认。"""
+        answer = tb.Messagebox.show_question(
+            f"将永久删除 {archive.root} 中全部群聊的历史归档"
+            f"（{archive.size() / 1024 / 1024:.1f} MB），删除后无法恢复。确定继续？",
+            "清空归档",
+            buttons=["取消:secondary", "删除:danger"],
+        )
+        if answer != "删除":
+            return
+        freed = archive.clear()
+        tb.Messagebox.show_info(f"历史归档已删除（释放 {freed / 1024:.1f} KB）。", "清空归档")
+
+    # -------------------- 粘贴逻辑 --------------------
+
+    def _combine_and_paste(self, delta: bool = False):
+        """在后台启动一次汇总粘贴；已有任务在跑时忽略。
+
+        delta 为 True 时只发送监听到的、当前模板上次发送之后的新消息。
+        """
+        if self._job is not None and self._job.is_alive():
+            return
+        if delta and self._watcher is None:
+            self.status_var.set("请先开启“监听新消息”")
+            return
+
+        # 确保 cfg 最新；快照交给后台线程，避免与 UI 编辑互相干扰。
+        # 配置在后台写盘，热键流程中不弹任何对话框
+        self._persist()
+        snapshot = copy.deepcopy(self.cfg)
+
+        self._busy.set()
+        self.progress.configure(value=0, maximum=1)
+        self.status_var.set("正在抓取聊天记录…")
+        self.cancel_btn.configure(state="normal")
+
+        self._job = CombineJob(snapshot, self._job_events, self._watcher, delta)
+        self._job.start()
+
+    def _cancel_job(self):
+        if self._job is not None and self._job.is_alive():
+            self._job.cancel()
+            self.status_var.set("正在取消…")
+
+    def _poll_job_events(self):
+        """主线程定时拉取后台任务事件并刷新界面。"""
+        try:
+            while True:
+                kind, data = self._job_events.get_nowait()
+                self._on_job_event(kind, data)
+        except queue.Empty:
+            pass
+        self.after(100, self._poll_job_events)
+
+    def _on_job_event(self, kind: str, data: dict):
+        if kind == "start":
+            self._combine_and_paste()
+            return
+
+        if kind == "index":
+            if self.cfg.resolve_chat_ids(chat_index):
+                self._reindex_chats()
+                self._mark_dirty()
+            return
+
+        if kind == "progress":
+            self.progress.configure(value=data["finished"], maximum=data["total"])
+            self.status_var.set(
+                f"已完成 {data['finished']}/{data['total']}：{data['chat']}"
+            )
+            return
+
+        if kind == "done":
+            status = f"已粘贴并发送（{data['chars']} 字，约 {data['total_tokens']} tokens"
+            if data["chunks"] > 1:
+                status += f"，分 {data['chunks']} 段"
+            status += "）"
+            if data["tokens"]:
+                status += "；各群聊：" + " / ".join(
+                    f"{name} {n}" for name, n in data["tokens"].items()
+                )
+            if data["over_budget"] and data["chunks"] == 1:
+                status += "；⚠ 超出模板 token 上限"
+            if data["truncated"]:
+                status += "；超出字数预算已截断：" + "、".join(
+                    f"{name} 省略 {n} 字" for name, n in data["truncated"].items()
+                )
+            if data["errors"]:
+                status += "；⚠ 获取失败：" + "、".join(data["errors"])
+            if data["stale"]:
+                status += "；使用本地缓存：" + "、".join(data["stale"])
+            self.status_var.set(status)
+        elif kind == "empty":
+            self.status_var.set("自上次发送以来没有新消息")
+        elif kind == "cancelled":
+            self.status_var.set("已取消")
+        elif kind == "error":
+            self.status_var.set(f"失败：{data['message']}")
+
+        self._job = None
+        self._busy.clear()
+        self.cancel_btn.configure(state="disabled")
+        self._refresh_stats()
+
+    # -------------------- 耗时统计 --------------------
+
+    STAGE_COLUMNS = (
+        ("url_build", "URL"),
+        ("fetch", "抓取"),
+        ("assemble", "拼接"),
+        ("clipboard", "剪贴板"),
+        ("keystrokes", "按键"),
+        ("total", "总计"),
+    )
+
+    def _show_stats(self):
+        """打开（或前置）耗时统计窗口：上方为最近各次运行，下方为选中运行的各群聊抓取明细。"""
+        if self._stats_win is not None and self._stats_win.winfo_exists():
+            self._stats_win.lift()
+            self._refresh_stats()
+            return
+
+        win = self._stats_win = tb.Toplevel(self)
+        win.title("耗时统计")
+        win.geometry("900x560")
+
+        self.stats_summary_var = tb.StringVar()
+        tb.Label(win, textvariable=self.stats_summary_var).pack(
+            anchor="w", padx=12, pady=(10, 4)
+        )
+
+        cols = ("time", "template", "outcome") + tuple(k for k, _ in self.STAGE_COLUMNS) + ("kb",)
+        runs = tb.Treeview(win, columns=cols, show="headings", height=10)
+        heads = ("时间", "模板", "结果") + tuple(t for _, t in self.STAGE_COLUMNS) + ("KB",)
+        for col, head in zip(cols, heads):
+            runs.heading(col, text=head)
+            runs.column(col, width=150 if col in ("time", "template") else 70, anchor="e")
+        runs.pack(fill="both", expand=True, padx=12)
+        runs.bind("<<TreeviewSelect>>", lambda e: self._show_run_chats())
+        self.stats_runs = runs
+
+        chat_cols = ("chat", "seconds", "ttfb", "requests", "kb")
+        chats = tb.Treeview(win, columns=chat_cols, show="headings", height=8)
+        for col, head in zip(chat_cols, ("群聊", "耗时", "TTFB", "请求数", "KB")):
+            chats.heading(col, text=head)
+            chats.column(col, width=300 if col == "chat" else 90, anchor="e")
+        chats.pack(fill="both", expand=True, padx=12, pady=(8, 0))
+        self.stats_chats = chats
+
+        tb.Button(win, text="导出 JSONL", command=self._export_stats).pack(
+            anchor="e", padx=12, pady=10
+        )
+        self._refresh_stats()
+
+    def _refresh_stats(self):
+        if self._stats_win is None or not self._stats_win.winfo_exists():
+            return
+        self._stats_records = run_stats.records()[::-1]  # 最新的在上
+        runs = self.stats_runs
+        runs.delete(*runs.get_children())
+        for i, rec in enumerate(self._stats_records):
+            runs.insert(
+                "",
+                tb.END,
+                iid=str(i),
+                values=(rec.started_at, rec.template, rec.outcome)
+                + tuple(f"{rec.stages.get(k, 0.0):.3f}" for k, _ in self.STAGE_COLUMNS)
+                + (f"{rec.bytes / 1024:.1f}",),
+            )
+        n = len(self._stats_records)
+        self.stats_summary_var.set(
+            f"最近 {n} 次：总计 p50 {run_stats.percentile('total', 0.5):.2f}s / "
+            f"p95 {run_stats.percentile('total', 0.95):.2f}s，"
+            f"抓取 p50 {run_stats.percentile('fetch', 0.5):.2f}s / "
+            f"p95 {run_stats.percentile('fetch', 0.95):.2f}s"
+        )
+        if n:
+            runs.selection_set("0")
+
+    def _show_run_chats(self):
+        sel = self.stats_runs.selection()
+        chats = self.stats_chats
+        chats.delete(*chats.get_children())
+        if not sel:
+            return
+        rec = self._stats_records[int(sel[0])]
+        shared = len(distinct_timings(rec.chats.values())) < len(rec.chats)
+        for name, t in rec.chats.items():
+            chats.insert(
+                "",
+                tb.END,
+                values=(
+                    name + ("（合并请求）" if shared else ""),
+                    f"{t.seconds:.3f}",
+                    f"{t.ttfb:.3f}",
+                    t.requests,
+                    f"{t.bytes / 1024:.1f}",
+                ),
+            )
+
+    def _export_stats(self):
+        path = filedialog.asksaveasfilename(
+            parent=self._stats_win,
+            defaultextension=".jsonl",
+            filetypes=[("JSON Lines", "*.jsonl")],
+            initialfile="run_stats.jsonl",
+        )
+        if path:
+            n = run_stats.export_jsonl(path)
+            self.status_var.set(f"已导出 {n} 条运行耗时到 {path}")
+
+    # -------------------- 监听模式 --------------------
+
+    def _start_watch(self):
+        self._watcher = ChatWatcher(self.cfg.watch_interval, self.cfg.page_size)
+        self._watcher.set_talkers(self.cfg.watched_talkers())
+        self._watcher.start()
+
+    def _toggle_watch(self):
+        self.cfg.watch = self.watch_var.get()
+        if self.cfg.watch and self._watcher is None:
+            self._start_watch()
+            self.status_var.set("已开始监听新消息")
+        elif not self.cfg.watch and self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+            self.status_var.set("已停止监听")
+        self._mark_dirty()
+
+    def _on_close(self):
+        """退出前把尚未写盘的改动同步写出。"""
+        self._persist()
+        self.store.flush()
+        if self._watcher is not None:
+            self._watcher.stop()
+        self.destroy()
+
+    # -------------------- 全局热键 --------------------
+
+    def _register_hotkey(self):
+        def _on_hotkey():
+            # 运行在 keyboard 线程：任务未结束时直接丢弃重复按键，
+            # 否则经队列交给主线程启动，不直接触碰 Tk
+            if not self._busy.is_set():
+                self._job_events.put(("start", {}))
+
+        def _worker():
+            keyboard.add_hotkey("ctrl+m", _on_hotkey)
+            keyboard.wait()
+
+        threading.Thread(target=_worker, daemon=True).start()
@@ -0,0 +1,662 @@
+"""
+chat.py 的单元测试：不依赖后端与 GUI，运行 `python -m pytest -q`。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any, Dict, List
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import chat
+
+
+# ---------------------------------------------------------------------------
+# fetch_pages 续抓与重抓
+# ---------------------------------------------------------------------------
+
+def _msg(seq: int) -> Dict[str, Any]:
+    return {"seq": seq, "time": "2026-10-01T10:00:00+08:00", "content": f"m{seq}"}
+
+
+class _FakeBackend:
+    """按 limit/offset 切片返回当前快照里的消息，记录每次请求的 offset。"""
+
+    def __init__(self, *snapshots: List[Dict[str, Any]]):
+        # 每次请求依次使用下一个快照，最后一个一直沿用；用于模拟请求之间记录发生变化
+        self.snapshots = list(snapshots)
+        self.offsets: List[int] = []
+
+    @contextmanager
+    def get(self, url: str, talker: str = "", **kwargs):
+        q = {k: v[0] for k, v in parse_qs(urlsplit(url).query).items()}
+        limit, offset = int(q.get("limit", 0)), int(q.get("offset", 0))
+        self.offsets.append(offset)
+        data = self.snapshots.pop(0) if len(self.snapshots) > 1 else self.snapshots[0]
+        page = data[offset : offset + limit] if limit else data
+        yield SimpleNamespace(
+            status_code=200,
+            json=lambda: page,
+            content=b"",
+            raise_for_status=lambda: None,
+        )
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    def _install(*snapshots):
+        fake = _FakeBackend(*snapshots)
+        monkeypatch.setattr(chat, "guarded_get", fake.get)
+        return fake
+
+    return _install
+
+
+def _collect(talker="g", offset=0, last_seq=0, page_size=3):
+    pages = []
+    chat.fetch_pages(
+        talker,
+        "2026-10-01",
+        "2026-10-01",
+        page_size,
+        offset,
+        last_seq,
+        on_page=lambda page, restart: pages.append(([m["seq"] for m in page], restart)),
+    )
+    return pages
+
+
+def test_fetch_pages_walks_all_pages(backend):
+    fake = backend([_msg(i) for i in range(1, 8)])
+    assert _collect() == [([1, 2, 3], False), ([4, 5], False), ([6, 7], False)]
+    assert fake.offsets == [0, 2, 4, 6]  # 续抓时多取前一条做校验
+
+
+def test_fetch_pages_resumes_after_high_water_mark(backend):
+    fake = backend([_msg(i) for i in range(1, 8)])
+    assert _collect(offset=4, last_seq=4) == [([5, 6], False), ([7], False)]
+    assert fake.offsets[0] == 3
+
+
+def test_fetch_pages_restarts_when_history_changed(backend):
+    backend([_msg(i) for i in range(1, 6)])
+    # 高水位处的消息对不上：从头重抓，第一页标记为重抓
+    assert _collect(offset=2, last_seq=99) == [([1, 2, 3], True), ([4, 5], False)]
+
+
+def test_fetch_pages_gives_up_after_max_restarts(backend):
+    # 每次请求记录都在变化，续抓永远对不上
+    snapshots = [[_msg(i * 100 + j) for j in range(5)] for i in range(10)]
+    fake = backend(*snapshots)
+    with pytest.raises(RuntimeError):
+        _collect(offset=2, last_seq=-1, page_size=2)
+    assert len(fake.offsets) <= 2 * (chat.FETCH_MAX_RESTARTS + 2)
+
+
+# ---------------------------------------------------------------------------
+# 分片抓取
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def local_store(tmp_path, monkeypatch):
+    """把缓存与归档换成临时目录里的实例。"""
+    store = SimpleNamespace(
+        cache=chat.MessageCache(str(tmp_path / "cache.db")),
+        archive=chat.ChatArchive(str(tmp_path / "archive")),
+    )
+    monkeypatch.setattr(chat, "cache", store.cache)
+    monkeypatch.setattr(chat, "archive", store.archive)
+    yield store
+    store.cache.close()
+
+
+def _day_msg(seq: int, day: str) -> Dict[str, Any]:
+    return {"seq": seq, "time": f"{day}T09:00:00+08:00", "type": 1, "content": f"m{seq}"}
+
+
+def test_fetch_shard_splits_by_day_and_dedupes(backend, local_store):
+    days = [chat.date(2026, 9, d) for d in (1, 2, 3)]
+    # 第 2 天的一条消息被后端在翻页处重复返回
+    fake = backend(
+        [
+            _day_msg(1, "2026-09-01"),
+            _day_msg(2, "2026-09-02"),
+            _day_msg(3, "2026-09-02"),
+            _day_msg(3, "2026-09-02"),
+            _day_msg(4, "2026-09-03"),
+        ]
+    )
+    bodies = chat._fetch_shard("g", days, page_size=3)
+    assert fake.offsets == [0, 2, 4]  # 三天共用同一组分页请求
+
+    assert list(bodies) == ["2026-09-01", "2026-09-02", "2026-09-03"]
+    assert bodies["2026-09-02"].count("m3") == 1
+    entry = local_store.cache.get("g", "2026-09-02")
+    assert entry.kind == "json" and (entry.msg_count, entry.last_seq) == (2, 3)
+    # 早已结束的日期写入缓存时即为稳定，同时归档
+    assert entry.final and local_store.archive.days("g") == {
+        "2026-09-01": 1,
+        "2026-09-02": 2,
+        "2026-09-03": 1,
+    }
+
+
+def test_fetch_shard_records_empty_days(backend, local_store):
+    backend([_day_msg(1, "2026-09-01")])
+    bodies = chat._fetch_shard("g", [chat.date(2026, 9, 1), chat.date(2026, 9, 2)], 10)
+    assert bodies["2026-09-02"] == ""
+    assert local_store.cache.get("g", "2026-09-02").msg_count == 0
+
+
+# ---------------------------------------------------------------------------
+# 按天抓取与字数预算
+# ---------------------------------------------------------------------------
+
+def test_fetch_talker_stops_at_budget_without_fetching_older_days(local_store, monkeypatch):
+    # 只缓存最新两天；更早的日期一旦被请求就会失败
+    days = ["2024-03-09", "2024-03-10"]
+    for day in days:
+        raws = [_day_msg(i, day) | {"content": "x" * 50} for i in range(10)]
+        local_store.cache.put("g", day, _json_entry(raws))
+    rendered = chat._render_entry(local_store.cache.get("g", days[0]))
+
+    @contextmanager
+    def offline(url, talker="", **kwargs):
+        raise AssertionError(f"不应请求 {url}")
+        yield
+
+    monkeypatch.setattr(chat, "guarded_get", offline)
+    log = chat.fetch_talker("g", "2024-03-01", "2024-03-10", page_size=50, budget=len(rendered))
+
+    assert not log.error and len(log.text) <= len(rendered)
+    assert "2024-03-09" not in log.text
+    # 未拼入的 9 天按已拼日期的平均字数估算
+    assert log.dropped >= 9 * len(rendered)
+
+
+def test_fetch_talker_without_budget_joins_days_in_order(local_store):
+    for day in ("2024-03-01", "2024-03-02"):
+        local_store.cache.put("g", day, _json_entry([_day_msg(1, day)]))
+    log = chat.fetch_talker("g", "2024-03-01", "2024-03-02", page_size=50)
+    assert log.dropped == 0
+    assert log.text.index("—— 2024-03-01 ——") < log.text.index("—— 2024-03-02 ——")
+
+
+# ---------------------------------------------------------------------------
+# 消息过滤
+# ---------------------------------------------------------------------------
+
+def _said(seq: int, who: str, content: str, type_: int = 1) -> Dict[str, Any]:
+    return {
+        "seq": seq,
+        "time": "2026-10-01T10:00:00+08:00",
+        "sender": who,
+        "senderName": who,
+        "type": type_,
+        "content": content,
+    }
+
+
+def test_filter_drops_types_and_blocked_senders():
+    filt = chat.MessageFilter(
+        chat.FilterOptions(drop_types=[47, "49:8"], sender_blocklist=["机器人"])
+    )
+    raws = [
+        _said(1, "甲", "保留"),
+        _said(2, "甲", "[动画表情]", 47),
+        _said(3, "甲", "gif", 49) | {"subType": 8},
+        _said(4, "甲", "链接", 49) | {"subType": 5},
+        _said(5, "机器人", "打卡提醒"),
+    ]
+    assert [m.content for m in filt.apply(raws)] == ["保留", "链接"]
+
+
+def test_filter_dedupes_only_within_window():
+    filt = chat.MessageFilter(chat.FilterOptions(dedupe_window=2))
+    contents = ["收到", "a", "收到", "b", "c", "收到", "d", "e", "f", "收到"]
+    raws = [_said(i, c, c) for i, c in enumerate(contents)]
+    # 窗口从上一次出现（含被去掉的那次）算起：前三个“收到”间隔都在 2 条以内
+    assert [m.content for m in filt.apply(raws)] == ["收到", "a", "b", "c", "d", "e", "f", "收到"]
+
+
+def test_filter_collapses_runs_of_short_replies():
+    filt = chat.MessageFilter(chat.FilterOptions(short_reply_len=2))
+    raws = [
+        _said(1, "甲", "今天下午三点评审"),
+        _said(2, "乙", "好的"),
+        _said(3, "丙", "ok"),
+        _said(4, "乙", "好的"),
+        _said(5, "甲", "会议室 A"),
+        _said(6, "丁", "1"),
+    ]
+    out = filt.apply(raws)
+    assert [m.content for m in out] == [
+        "今天下午三点评审",
+        "好的 / ok（3 条简短回复）",
+        "会议室 A",
+        "1",  # 只有一条时原样保留
+    ]
+    assert out[1].sender_name == "乙、丙" and out[1].sender == "多人"
+    assert raws[1]["content"] == "好的"  # 不改动原始消息
+
+
+# ---------------------------------------------------------------------------
+# 熔断
+# ---------------------------------------------------------------------------
+
+def test_circuit_breaker_opens_and_probes(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(chat.time, "monotonic", lambda: now[0])
+    breaker = chat.CircuitBreaker(threshold=2, cooldown=10)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()  # 熔断
+
+    now[0] += 10
+    assert breaker.allow()      # 冷却结束，放行一个试探请求
+    assert not breaker.allow()  # 试探期间其余请求仍被拒绝
+    breaker.release()
+    assert breaker.allow()      # 试探未发出，下一个继续试探
+    breaker.record_failure()
+    assert not breaker.allow()  # 试探失败，重新计时
+
+    now[0] += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.allow()
+
+
+# ---------------------------------------------------------------------------
+# 模板
+# ---------------------------------------------------------------------------
+
+def test_template_renders_vars_conditions_and_chats():
+    tpl = chat.CompiledTemplate(
+        "{template_name}|{#chats}[{chat_name}{?stale}*{/stale}:{text}]{/chats}"
+    )
+    out = tpl.render(
+        {"template_name": "日报"},
+        [
+            {"chat_name": "A", "text": "a", "stale": True},
+            {"chat_name": "B", "text": "b", "stale": False},
+        ],
+    )
+    assert out == "日报|[A*:a][B:b]"
+
+
+def test_template_keeps_unknown_and_unclosed_tags_literal():
+    tpl = chat.CompiledTemplate("{foo} {chat_name} {#chats}{chat_name}")
+    assert tpl.render({}, [{"chat_name": "A"}]) == "{foo} {chat_name} {#chats}{chat_name}"
+
+
+def test_template_nested_content_does_not_recurse():
+    content = chat.CompiledTemplate("正文 {content} {chat_count}")
+    layout = chat.CompiledTemplate("{content}")
+    assert layout.render({"content": content, "chat_count": 2}) == "正文  2"
+
+
+def test_default_layout_matches_fixed_format():
+    layout = chat.compile_template(chat.DEFAULT_LAYOUT)
+    out = layout.render(
+        {"template_name": "T", "content": "C"},
+        [{"chat_name": "A", "text": "x", "truncated": 5}],
+    )
+    assert out == (
+        "T\n\nC\n\n========\n【群聊：A】\n========\n[已截断：省略较早的 5 字]\nx"
+    )
+
+
+# ---------------------------------------------------------------------------
+# 检索
+# ---------------------------------------------------------------------------
+
+def _chat_msg(seq: int, content: str) -> Dict[str, Any]:
+    return {
+        "seq": seq,
+        "time": "2026-10-01T10:00:%02d+08:00" % (seq % 60),
+        "senderName": "张三",
+        "type": 1,
+        "content": content,
+    }
+
+
+def _json_entry(raws, final=True) -> chat.CacheEntry:
+    return chat.CacheEntry(
+        "\n".join(json.dumps(m, ensure_ascii=False) for m in raws),
+        final,
+        kind="json",
+        msg_count=len(raws),
+        last_seq=raws[-1]["seq"] if raws else 0,
+    )
+
+
+def test_tokenize_mixes_words_and_cjk_bigrams():
+    assert chat.tokenize("Deploy 上线了") == ["deploy", "上线", "线了"]
+
+
+def test_search_index_finds_windows_and_dedupes(tmp_path):
+    cache = chat.MessageCache(str(tmp_path / "c.db"))
+    raws = [_chat_msg(i, "闲聊") for i in range(10)]
+    raws[5] = _chat_msg(5, "今天上线 deploy")
+    cache.put("g", "2026-10-01", _json_entry(raws))
+    index = chat.SearchIndex(cache)
+    assert index.sync(["g"], ["2026-10-01"]) == 10
+    assert index.sync(["g"], ["2026-10-01"]) == 0  # 已稳定的日期不再读取
+
+    windows = index.search("上线", ["g"], ["2026-10-01"], top_k=3, context=1)
+    assert [(w.start, w.end) for w in windows] == [(4, 7)]
+    text = index.excerpt(windows)["g"]
+    assert "今天上线" in text and text.startswith("—— 2026-10-01 ——")
+    assert index.search("上线", ["other"], ["2026-10-01"]) == []
+    cache.close()
+
+
+def test_search_index_rescans_rewritten_entry(tmp_path):
+    cache = chat.MessageCache(str(tmp_path / "c.db"))
+    raws = [_chat_msg(1, "甲"), _chat_msg(2, "已撤回的消息"), _chat_msg(3, "丙")]
+    cache.put("g", "2026-10-01", _json_entry(raws, final=False))
+    index = chat.SearchIndex(cache)
+    index.sync(["g"], ["2026-10-01"])
+
+    # 重抓后第 2 条消失，前面插入一条补发的消息，末尾追加一条
+    raws = [_chat_msg(0, "补发 发布"), _chat_msg(1, "甲"), _chat_msg(3, "丙"), _chat_msg(4, "丁")]
+    cache.put("g", "2026-10-01", _json_entry(raws, final=False))
+    assert index.sync(["g"], ["2026-10-01"]) == 2
+    assert index.size == 4
+
+    assert index.search("撤回", ["g"], ["2026-10-01"]) == []
+    windows = index.search("丙", ["g"], ["2026-10-01"], context=0)
+    assert [(w.start, w.end) for w in windows] == [(2, 3)]
+    assert "丙" in index.excerpt(windows)["g"]
+    assert index.search("发布", ["g"], ["2026-10-01"], context=0)[0].start == 0
+    cache.close()
+
+
+# ---------------------------------------------------------------------------
+# 归档
+# ---------------------------------------------------------------------------
+
+def test_archive_roundtrip_and_skip_unchanged(tmp_path):
+    archive = chat.ChatArchive(str(tmp_path / "arch"))
+    raws = [_msg(1), {"seq": 2, "content": "只有部分字段"}]
+    assert archive.append("a/b", "2026-10-01", raws)
+    assert not archive.append("a/b", "2026-10-01", raws)
+    assert archive.get("a/b", "2026-10-01") == raws
+    assert archive.get("a/b", "2026-10-02") is None
+    assert archive.append("a/b", "2026-10-02", [])
+    assert archive.get("a/b", "2026-10-02") == []
+    assert archive.days("a/b") == {"2026-10-01": 2, "2026-10-02": 0}
+    assert archive.talkers() == ["a/b"]
+
+    # 重新打开时从 .idx 读出索引
+    assert chat.ChatArchive(archive.root).get("a/b", "2026-10-01") == raws
+
+
+def test_archive_rewrites_deleted_or_damaged_segment(tmp_path):
+    archive = chat.ChatArchive(str(tmp_path / "arch"))
+    raws = [_msg(1), _msg(2)]
+    archive.append("g", "2026-10-01", raws)
+    seg_path, _ = archive._paths("g", "2026-10")
+
+    os.remove(seg_path)
+    assert archive.append("g", "2026-10-01", raws)
+    assert archive.get("g", "2026-10-01") == raws
+
+    with open(seg_path, "r+b") as f:
+        f.write(b"garbage!")
+    with pytest.raises(Exception):
+        archive.get("g", "2026-10-01")
+    archive.discard("g", "2026-10-01")
+    assert archive.append("g", "2026-10-01", raws)
+    assert archive.get("g", "2026-10-01") == raws
+
+    assert archive.clear() > 0
+    assert archive.get("g", "2026-10-01") is None
+
+
+# ---------------------------------------------------------------------------
+# 配置
+# ---------------------------------------------------------------------------
+
+def test_load_migrates_enabled_chats_to_chat_ids(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(
+        json.dumps(
+            {
+                "chats": [{"name": "甲"}, {"name": "乙"}, {"name": "丙"}],
+                "custom_templates": [
+                    # 旧配置：与 chats 按位置对齐，且可能比 chats 短
+                    {"name": "日报", "content": "x", "enabled_chats": [True, False]},
+                    {"name": "周报", "content": "y", "enabled_chats": [False, True, True]},
+                ],
+            },
+            ensure_ascii=False,
+        ),
+        encoding="utf-8",
+    )
+    cfg = chat.AppConfig.load(str(path))
+    a, b, c = cfg.chats
+    assert not a.resolved and a.talker == "甲"  # 旧配置没有 ID，分配本地 ID
+    assert cfg.custom_templates[0].chat_ids == {a.id}
+    assert cfg.custom_templates[1].chat_ids == {b.id, c.id}
+
+    # 保存后以 chat_ids 形式重新读取，结果不变；已删除群聊的 ID 被剔除
+    cfg.chats.remove(c)
+    cfg.save(str(path))
+    saved = json.loads(path.read_text(encoding="utf-8"))
+    assert "enabled_chats" not in saved["custom_templates"][0]
+    again = chat.AppConfig.load(str(path))
+    assert [x.id for x in again.chats] == [a.id, b.id]
+    assert again.custom_templates[1].chat_ids == {b.id}
+
+
+def _counting_writes(monkeypatch) -> List[str]:
+    writes: List[str] = []
+    real = chat.atomic_write
+
+    def _write(path, text):
+        writes.append(text)
+        real(path, text)
+
+    monkeypatch.setattr(chat, "atomic_write", _write)
+    return writes
+
+
+def test_config_store_coalesces_saves_and_flushes_snapshot(tmp_path, monkeypatch):
+    writes = _counting_writes(monkeypatch)
+    path = tmp_path / "config.json"
+    store = chat.ConfigStore(str(path), delay=60)  # 计时器不会在测试期间触发
+    cfg = chat.AppConfig([chat.Chat("甲")], [chat.Template("日报", "")])
+
+    for name in ("乙", "丙", "丁"):
+        cfg.chats[0].name = name
+        store.save_async(cfg)
+    cfg.chats[0].name = "保存之后才改"  # 快照在调用时生成，不受之后的编辑影响
+
+    assert store.flush()
+    assert len(writes) == 1
+    assert json.loads(path.read_text(encoding="utf-8"))["chats"][0]["name"] == "丁"
+    assert not store.flush()  # 没有待写内容
+
+    cfg.chats[0].name = "丁"
+    store.save_async(cfg)  # 与已写盘内容相同，跳过
+    assert not store.flush() and len(writes) == 1
+
+
+def test_config_store_writes_after_delay(tmp_path, monkeypatch):
+    writes = _counting_writes(monkeypatch)
+    store = chat.ConfigStore(str(tmp_path / "config.json"), delay=0.05)
+    store.save_async(chat.AppConfig([chat.Chat("甲")], [chat.Template("日报", "")]))
+    deadline = time.monotonic() + 2
+    while not writes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(writes) == 1
+
+
+# ---------------------------------------------------------------------------
+# 群聊 ID 解析
+# ---------------------------------------------------------------------------
+
+def _index(tmp_path, *entries) -> chat.ChatIndex:
+    index = chat.ChatIndex(str(tmp_path / "chat_index.json"))
+    index._loaded = True
+    index._install({e.id: e for e in entries})
+    return index
+
+
+def test_reresolve_chat_keeps_id_unless_name_means_another_chat(tmp_path):
+    index = _index(
+        tmp_path,
+        chat.IndexEntry("123@chatroom", "项目群", "chatroom", ["项目群", "123@chatroom"]),
+        chat.IndexEntry("456@chatroom", "运维群", "chatroom", ["运维群", "456@chatroom"]),
+    )
+    pinned = chat.Chat("项目群", "123@chatroom")
+    tpl = chat.Template("日报", "", chat_ids={pinned.id})
+    cfg = chat.AppConfig([pinned], [tpl])
+
+    # 改显示名、删字再补回都不改 ID
+    for name in ("项目群（内部）", "项目", "项目群"):
+        pinned.name = name
+        assert not cfg.reresolve_chat(pinned, index)
+        assert pinned.talker == "123@chatroom"
+
+    # 改成另一个群聊的名称才改用它的 ID，模板跟着改
+    pinned.name = "运维群"
+    assert cfg.reresolve_chat(pinned, index)
+    assert pinned.id == "456@chatroom" and tpl.chat_ids == {"456@chatroom"}
+
+
+def test_index_refresh_rewrites_only_on_change(tmp_path, monkeypatch):
+    rooms = [{"name": "123@chatroom", "nickName": "项目群"}]
+    monkeypatch.setattr(
+        chat, "_list_items", lambda kind: list(rooms) if kind == "chatroom" else []
+    )
+    writes: List[str] = []
+    real = chat.atomic_write
+    monkeypatch.setattr(chat, "atomic_write", lambda p, t: (writes.append(t), real(p, t)))
+    path = str(tmp_path / "chat_index.json")
+
+    index = chat.ChatIndex(path)
+    assert index.refresh(force=True) == 1 and len(writes) == 1
+    # 把索引做旧：文件里的刷新时间与修改时间都回到很久以前
+    raw = json.loads(writes[-1])
+    raw["updated_at"] = 0.0
+    real(path, json.dumps(raw))
+    os.utime(path, (0, 0))
+    assert chat.ChatIndex(path).stale
+
+    assert index.refresh(force=True) == 0 and len(writes) == 1  # 没变化不重写
+    assert not chat.ChatIndex(path).stale  # 修改时间记下了这次刷新
+
+    rooms.append({"name": "456@chatroom", "nickName": "运维群"})
+    assert index.refresh(force=True) == 1 and len(writes) == 2
+    assert chat.ChatIndex(path).resolve("运维群") == "456@chatroom"
+
+
+# ---------------------------------------------------------------------------
+# 实时监听
+# ---------------------------------------------------------------------------
+
+def _watcher_feeding(monkeypatch, arrivals: Dict[str, List[List[Dict[str, Any]]]]) -> chat.ChatWatcher:
+    """不启动线程：每次 _poll 依次交出该群聊的下一批消息，模拟轮询之间的新消息。"""
+
+    def _fetch_pages(talker, date_from, date_to, page_size, on_page=None, **_):
+        batch = arrivals[talker].pop(0) if arrivals[talker] else []
+        on_page(batch, False)
+
+    monkeypatch.setattr(chat, "fetch_pages", _fetch_pages)
+    watcher = chat.ChatWatcher()
+    watcher.set_talkers(arrivals)
+    return watcher
+
+
+def _poll_all(watcher: chat.ChatWatcher) -> None:
+    for cursor in list(watcher._cursors.values()):
+        watcher._poll(cursor)
+
+
+def _seqs(pending: List[List[Dict[str, Any]]]) -> List[List[int]]:
+    return [[m["seq"] for m in msgs] for msgs in pending]
+
+
+def test_watcher_pending_is_per_template_and_mark_sent_advances(monkeypatch):
+    watcher = _watcher_feeding(monkeypatch, {
+        "a": [[_msg(1), _msg(2)], [_msg(2), _msg(3)]],  # 第二批与第一批重叠一条
+        "b": [[_msg(10)]],
+    })
+    _poll_all(watcher)
+
+    pending, marks = watcher.pending("日报", ["a", "b", "未监听"])
+    assert _seqs(pending) == [[1, 2], [10], []]
+    assert marks == {"a": 2, "b": 10}
+    watcher.mark_sent("日报", marks)
+
+    _poll_all(watcher)  # 发送之后到达的消息
+    pending, marks = watcher.pending("日报", ["a", "b"])
+    assert _seqs(pending) == [[3], []]
+    assert marks == {"a": 3, "b": 10}
+    # 其他模板的发送位置互不影响
+    assert _seqs(watcher.pending("周报", ["a", "b"])[0]) == [[1, 2, 3], [10]]
+
+
+def test_watcher_marks_only_what_was_returned(monkeypatch):
+    watcher = _watcher_feeding(monkeypatch, {"a": [[_msg(1)], [_msg(2)]]})
+    _poll_all(watcher)
+    _, marks = watcher.pending("日报", ["a"])
+    _poll_all(watcher)  # 发送期间到达
+    watcher.mark_sent("日报", marks)
+    assert _seqs(watcher.pending("日报", ["a"])[0]) == [[2]]
+
+
+# ---------------------------------------------------------------------------
+# 分段粘贴
+# ---------------------------------------------------------------------------
+
+def _strip_headers(chunks):
+    return [chunk.split("\n", 1)[1] for chunk in chunks]
+
+
+def test_split_for_paste_keeps_short_text_whole():
+    assert chat.split_for_paste("短消息", 100) == ["短消息"]
+
+
+def test_split_for_paste_keeps_separators_of_oversized_block():
+    text = "a" * 100 + "\n" + "b" * 20 + "\n\n" + "c" * 8
+    chunks = _strip_headers(chat.split_for_paste(text, 30))
+    # 硬切的同一行拼回去不多出换行；同一块的行之间是换行，块之间才是空行
+    assert "".join(chunks[:-1]) == "a" * 100
+    assert chunks[-1] == "b" * 20 + "\n\n" + "c" * 8
+
+
+# ---------------------------------------------------------------------------
+# 批量渲染
+# ---------------------------------------------------------------------------
+
+def test_render_combined_marks_missing_chats_only_when_asked():
+    tpl = chat.Template("日报", "")
+    logs = [chat.ChatLog("正常记录"), chat.ChatLog("", error="超过总时限 20s 未返回")]
+
+    pasted = chat.render_combined(tpl, ["A", "B"], logs)
+    assert "【群聊：B】" not in pasted.text and pasted.errors == {"B": logs[1].error}
+
+    written = chat.render_combined(tpl, ["A", "B"], logs, mark_missing=True)
+    assert "【群聊：B】\n========\n[未获取到记录：超过总时限 20s 未返回]" in written.text
+    assert "部分记录获取失败" not in written.text
+
+
+def test_fetch_many_without_deadline_waits_for_slow_items():
+    def slow(item):
+        chat.time.sleep(0.3)
+        return chat.ChatLog(item)
+
+    assert [log.text for log in chat.fetch_many(slow, ["a", "b"], deadline=0)] == ["a", "b"]
+    timed_out = chat.fetch_many(slow, ["a"], deadline=0.05)
+    assert timed_out[0].text == "" and "总时限" in timed_out[0].error